@@ -0,0 +1,64 @@
+""" Shows how CostBaseQueue.get_transactions scales with the number of open lots.
+
+Each run fills a queue with open lots, then performs many small sells that each
+consume a few lots. The time per sell should stay flat as the queue grows
+(or grow with log n for HIFO and LOFO, which consume lots from a heap).
+
+python -m benchmarks.bench_cost_base_queue
+"""
+import argparse
+import time
+from decimal import Decimal
+
+from capitalg.CostBaseQueue import CostBaseQueue, QueueTypes
+from capitalg.Transaction import Transaction
+
+DEFAULT_SIZES = [1_000, 10_000, 100_000, 1_000_000]
+
+
+def bench_queue(queue_type: QueueTypes, open_lots: int, sells: int) -> float:
+    """ Returns the average seconds per sell
+    """
+    queue = CostBaseQueue(queue_type)
+    for i in range(open_lots):
+        queue.add(Transaction(
+            id=f'raw_{i}',
+            exchange='',
+            timestamp=1554422400 + i,
+            tz='UTC',
+            type='buy',
+            base_currency='usd',
+            asset_code='btc',
+            price=Decimal(1000 + i % 100),
+            qty=Decimal('1.5'),
+            fee_currency='usd',
+            fee=Decimal('0.15'),
+            fee_unit=Decimal('0.1'),
+            note='',
+        ))
+
+    # Each sell consumes ~2 lots, with a partial consumption on most sells
+    sale_qty = Decimal('2.7')
+    start = time.perf_counter()
+    for _ in range(sells):
+        queue.get_transactions(sale_qty)
+    return (time.perf_counter() - start) / sells
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--sizes', nargs='+', type=int, default=DEFAULT_SIZES, help='Numbers of open lots to benchmark')
+    parser.add_argument('-s', '--sells', type=int, default=200, help='Number of sells per run')
+    args = parser.parse_args()
+
+    print(f"{'queue':<6}{'open lots':>12}{'us / sell':>12}")
+    for queue_type in QueueTypes:
+        for size in args.sizes:
+            # Keep enough lots in the queue for every sell
+            open_lots = max(size, 2 * args.sells)
+            seconds = bench_queue(queue_type, open_lots, args.sells)
+            print(f'{queue_type.value:<6}{open_lots:>12,}{seconds * 1e6:>12.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+""" Times each stage of a full calculation on generated portfolios (see benchmarks.generator),
+reporting the wall time and peak traced memory of each stage.
+
+Stages:
+- rates: load_rates_store
+- load: TransactionLoader, i.e. read, rebase, sort and write formatted transactions
+- match: CostBaseQueue.get_transactions and calculate_cg_event for every sale
+- write: Writer, i.e. cg events, their cost base transactions and unallocated cost base transactions
+- summary: cg_summary
+- balance: get_balance
+
+python -m benchmarks.bench_pipeline -n 10000 100000
+"""
+import argparse
+import csv
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+from typing import List
+
+from benchmarks.generator import generate_portfolio
+from capitalg.analysis import cg_summary, get_balance
+from capitalg.cg_helpers import calculate_cg_event, write_cg_event
+from capitalg.contstants import (
+    FILE_CG_EVENTS,
+    FILE_COST_BASE_TRANSACTION,
+    FILE_FORMATTED_TRANSACTIONS,
+    FILE_RATES,
+    FILE_TRANSACTIONS,
+    FILE_UNALLOCATED_COST_BASE_TRANSACTION,
+    TRANSACTION_SELL_LABEL,
+)
+from capitalg.CostBaseQueue import CostBaseQueue, QueueTypes
+from capitalg.Profiler import reset_peak_memory
+from capitalg.rates_loader import load_rates_store
+from capitalg.TransactionLoader import TransactionLoader
+from capitalg.utils import get_tax_year_cutoff_date
+from capitalg.Writer import Writer
+
+DEFAULT_SIZES = [10_000, 100_000, 1_000_000, 10_000_000]
+TAX_CURRENCY = 'usd'
+TAX_TIMEZONE = 'UTC'
+# The generated portfolios span 2016 to 2020
+TAX_YEAR_END = '2020-12-31'
+
+RESULT_FIELDS = ['rows', 'stage', 'seconds', 'peak_mib']
+
+
+class StageTimer:
+    """ Records the wall time, and peak memory allocated above the starting point, of each stage
+    """
+
+    def __init__(self, rows: int, trace_memory: bool):
+        self.rows = rows
+        self.trace_memory = trace_memory
+        self.results = []
+
+    @contextmanager
+    def stage(self, name: str):
+        if self.trace_memory:
+            reset_peak_memory()
+            baseline, _ = tracemalloc.get_traced_memory()
+
+        start = time.perf_counter()
+        yield
+        seconds = time.perf_counter() - start
+
+        peak_mib = None
+        if self.trace_memory:
+            _, peak = tracemalloc.get_traced_memory()
+            peak_mib = (peak - baseline) / 2 ** 20
+
+        result = {'rows': self.rows, 'stage': name, 'seconds': seconds, 'peak_mib': peak_mib}
+        self.results.append(result)
+        print_result(result)
+
+
+def bench_pipeline(folder: Path, rows: int, queue_type: QueueTypes, trace_memory: bool = True, **generator_args) -> List[dict]:
+    timer = StageTimer(rows, trace_memory)
+
+    # Generating is not part of a calculation, so memory isn't traced until it's done
+    start = time.perf_counter()
+    generate_portfolio(folder, rows, tax_currency=TAX_CURRENCY, **generator_args)
+    timer.results.append({'rows': rows, 'stage': 'generate', 'seconds': time.perf_counter() - start, 'peak_mib': None})
+    print_result(timer.results[-1])
+
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        with timer.stage('rates'):
+            rates = load_rates_store(folder / FILE_RATES)
+
+        with timer.stage('load'):
+            transactions = TransactionLoader(
+                folder / FILE_TRANSACTIONS,
+                folder / FILE_FORMATTED_TRANSACTIONS,
+                TAX_CURRENCY,
+                get_tax_year_cutoff_date(TAX_YEAR_END, TAX_TIMEZONE),
+                tax_timezone=TAX_TIMEZONE,
+                rates=rates,
+            ).get_transactions
+
+        with timer.stage('match'):
+            queues = {}
+            cg_events = []
+            for transaction in transactions:
+                if transaction.asset_code not in queues:
+                    queues[transaction.asset_code] = CostBaseQueue(queue_type)
+
+                if transaction.type == TRANSACTION_SELL_LABEL:
+                    costs = queues[transaction.asset_code].get_transactions(transaction.qty)
+                    cg_events.append((transaction, costs, calculate_cg_event(transaction, costs)))
+                else:
+                    queues[transaction.asset_code].add(transaction)
+
+        with timer.stage('write'):
+            with Writer(folder / FILE_CG_EVENTS, folder / FILE_COST_BASE_TRANSACTION) as writer:
+                for sale, costs, cost_base in cg_events:
+                    write_cg_event(writer, sale, costs, cost_base)
+                writer.output_unallocted_cost_base_transactions(folder / FILE_UNALLOCATED_COST_BASE_TRANSACTION, queues)
+
+        del transactions, queues, cg_events
+
+        with timer.stage('summary'):
+            cg_summary(folder / FILE_CG_EVENTS, TAX_YEAR_END)
+
+        with timer.stage('balance'):
+            get_balance(TAX_CURRENCY, folder / FILE_TRANSACTIONS, folder / FILE_UNALLOCATED_COST_BASE_TRANSACTION)
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+
+    return timer.results
+
+
+def print_result(result: dict):
+    peak = '' if result['peak_mib'] is None else f"{result['peak_mib']:.1f}"
+    print(f"{result['rows']:>12,}  {result['stage']:<10}{result['seconds']:>10.3f}{peak:>12}", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--sizes', nargs='+', type=int, default=DEFAULT_SIZES, help='Numbers of transactions to benchmark')
+    parser.add_argument('-q', '--queue_type', choices=['fifo', 'lifo', 'hifo', 'lofo'], default='fifo', type=str, help='CG accounting method (defaults to fifo)')
+    parser.add_argument('-a', '--assets', type=int, default=5, help='Number of assets (defaults to 5)')
+    parser.add_argument('--non_tax_share', type=float, default=0.2, help='Share of trades against another asset instead of the tax currency (defaults to 0.2)')
+    parser.add_argument('--fee_currencies', nargs='+', default=['usd', 'bnb'], type=str.lower, help='Currencies fees are paid in (defaults to usd bnb)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed (defaults to 0)')
+    parser.add_argument('--no_memory', action='store_true', help='Skip tracing memory, which slows every stage down')
+    parser.add_argument('-o', '--output', type=Path, help='Append results to this CSV file, to compare runs')
+    args = parser.parse_args()
+
+    print(f"{'rows':>12}  {'stage':<10}{'seconds':>10}{'peak MiB':>12}")
+    results = []
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as folder:
+            results += bench_pipeline(
+                Path(folder),
+                size,
+                QueueTypes(args.queue_type.upper()),
+                trace_memory=not args.no_memory,
+                assets=args.assets,
+                non_tax_share=args.non_tax_share,
+                fee_currencies=args.fee_currencies,
+                seed=args.seed,
+            )
+
+    if args.output is not None:
+        write_header = not args.output.exists()
+        with open(args.output, 'a') as f:
+            writer = csv.DictWriter(f, RESULT_FIELDS)
+            if write_header:
+                writer.writeheader()
+            writer.writerows(results)
+
+
+if __name__ == '__main__':
+    main()
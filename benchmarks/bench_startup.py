@@ -0,0 +1,79 @@
+""" Times the startup of the capitalg CLI, i.e. importing capitalg.commands and each subcommand's imports,
+using python -X importtime in fresh interpreters.
+
+Reports the median cumulative import time of each, and the slowest modules imported by capitalg.commands.
+With --max_ms, exits with an error if importing capitalg.commands takes longer, to catch regressions.
+
+python -m benchmarks.bench_startup -r 20 --max_ms 50
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+# What each subcommand imports when it runs, see capitalg.commands
+TARGETS = {
+    'commands': 'import capitalg.commands',
+    'calculate': 'import capitalg.commands; import capitalg.main, capitalg.Profiler',
+    'summary': 'import capitalg.commands; import capitalg.analysis.summary, capitalg.columnar',
+    'balance': 'import capitalg.commands; import capitalg.analysis.balance, capitalg.columnar',
+}
+
+
+def import_times(code: str) -> List[Tuple[int, str, int]]:
+    """ (depth, module, cumulative microseconds) of every module imported by code, in a fresh interpreter.
+    Modules imported by code itself have depth 0
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        capture_output=True, text=True, check=True,
+    )
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = line[len('import time:'):].split('|')
+        # Nested imports are indented by 2 spaces per level
+        name = module.strip()
+        times.append(((len(module) - len(module.lstrip()) - 1) // 2, name, int(cumulative)))
+    return times
+
+
+def capitalg_import_time(code: str) -> int:
+    """ Total import time of the capitalg modules imported by code, including everything they import
+    """
+    return sum(
+        microseconds for depth, module, microseconds in import_times(code)
+        if depth == 0 and module.split('.')[0] == 'capitalg'
+    )
+
+
+def bench_startup(repeats: int) -> Dict[str, List[int]]:
+    return {name: [capitalg_import_time(code) for _ in range(repeats)] for name, code in TARGETS.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-r', '--repeats', type=int, default=10, help='Number of fresh interpreters per target (defaults to 10)')
+    parser.add_argument('-t', '--top', type=int, default=10, help='Number of slowest modules to list (defaults to 10)')
+    parser.add_argument('--max_ms', type=float, help='Fail if the median time to import capitalg.commands exceeds this')
+    args = parser.parse_args()
+
+    results = bench_startup(args.repeats)
+    print(f"{'target':<12}{'median ms':>12}{'min ms':>10}")
+    for name, times in results.items():
+        print(f'{name:<12}{statistics.median(times) / 1000:>12.1f}{min(times) / 1000:>10.1f}')
+
+    print('\nSlowest modules imported by capitalg.commands (cumulative ms)')
+    times = import_times(TARGETS['commands'])
+    for _, module, microseconds in sorted(times, key=lambda item: -item[2])[:args.top]:
+        print(f'{microseconds / 1000:>8.1f}  {module}')
+
+    median_ms = statistics.median(results['commands']) / 1000
+    if args.max_ms is not None and median_ms > args.max_ms:
+        sys.exit(f'Importing capitalg.commands took {median_ms:.1f}ms, more than --max_ms {args.max_ms}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+""" Seeded generator of synthetic portfolios, i.e. a transactions.csv and a matching rates.csv.
+
+Portfolios trade assets against the tax currency, and (for non_tax_share of trades) against
+other assets, paying fees in any of fee_currencies. Sells never exceed the holdings of an asset,
+so every generated portfolio can be calculated. The same arguments always generate the same files.
+
+python -m benchmarks.generator capitalg_files -n 100000
+"""
+import argparse
+import csv
+import random
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from typing import List, Sequence
+
+from capitalg.contstants import (
+    DATE_INPUT_FORMAT,
+    DATE_RATE_FORMAT,
+    FIELD_ASSET_CODE,
+    FIELD_BASE_CURRENCY,
+    FIELD_DATE,
+    FIELD_EXCHANGE,
+    FIELD_FEE,
+    FIELD_FEE_CURRENCY,
+    FIELD_NOTE,
+    FIELD_PRICE,
+    FIELD_QTY,
+    FIELD_RAW_ID,
+    FIELD_TRANSACTION_TYPE,
+    FIELD_TZ,
+    FILE_RATES,
+    FILE_TRANSACTIONS,
+    TRANSACTION_BUY_LABEL,
+    TRANSACTION_SELL_LABEL,
+)
+
+INPUT_FIELDS = [
+    FIELD_RAW_ID,
+    FIELD_EXCHANGE,
+    FIELD_DATE,
+    FIELD_TZ,
+    FIELD_TRANSACTION_TYPE,
+    FIELD_BASE_CURRENCY,
+    FIELD_ASSET_CODE,
+    FIELD_QTY,
+    FIELD_PRICE,
+    FIELD_FEE_CURRENCY,
+    FIELD_FEE,
+    FIELD_NOTE,
+]
+
+ASSET_CODES = ['btc', 'eth', 'ltc', 'xrp', 'ada', 'dot', 'sol', 'bnb', 'doge', 'link']
+EXCHANGES = ['binance', 'coinbase', 'kraken']
+
+DEFAULT_START_DATE = date(2016, 1, 1)
+DEFAULT_YEARS = 5
+
+# Rows are written in chronological blocks of this size, shuffled within each block,
+# so the loader has to sort without the whole file being shuffled
+SHUFFLE_BLOCK_SIZE = 1000
+
+
+def asset_codes(count: int) -> List[str]:
+    return ASSET_CODES[:count] + [f'asset{i}' for i in range(len(ASSET_CODES), count)]
+
+
+def generate_portfolio(folder: Path, rows: int, assets: int = 5, non_tax_share: float = 0.2,
+                       fee_currencies: Sequence[str] = ('usd', 'bnb'), tax_currency: str = 'usd',
+                       seed: int = 0, start_date: date = DEFAULT_START_DATE, years: int = DEFAULT_YEARS):
+    """ Writes FILE_TRANSACTIONS and FILE_RATES to folder.
+    Transactions are spread evenly over the given number of years from start_date, with rates for every day
+    """
+    rng = random.Random(seed)
+    codes = asset_codes(assets)
+    days = (start_date.replace(year=start_date.year + years) - start_date).days
+
+    # Daily rates in the tax currency, as a random walk per asset
+    rates_codes = sorted(set(codes) | {code for code in fee_currencies if code != tax_currency})
+    rates = {code: [] for code in rates_codes}
+    for code in rates_codes:
+        rate = rng.uniform(1, 10_000)
+        for _ in range(days):
+            rate = max(0.01, rate * rng.uniform(0.95, 1.05))
+            rates[code].append(rate)
+
+    folder.mkdir(parents=True, exist_ok=True)
+    with open(folder / FILE_RATES, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['date', *rates_codes])
+        for day in range(days):
+            writer.writerow([
+                (start_date + timedelta(days=day)).strftime(DATE_RATE_FORMAT),
+                *(f'{rates[code][day]:.4f}' for code in rates_codes)
+            ])
+
+    # Stay a day clear of the end, and keep timestamps strictly increasing,
+    # so sells always come after the buys they draw from
+    step = (days - 1) * 86400 // max(rows, 1)
+    if step < 1:
+        raise ValueError(f'{rows} rows do not fit in {years} years, use more years')
+
+    start = datetime.combine(start_date, datetime.min.time())
+    holdings = {code: 0.0 for code in codes}
+
+    with open(folder / FILE_TRANSACTIONS, 'w') as f:
+        writer = csv.DictWriter(f, INPUT_FIELDS)
+        writer.writeheader()
+        block = []
+
+        for i in range(rows):
+            offset = i * step + rng.randrange(step)
+            day = offset // 86400
+            asset_code = rng.choice(codes)
+            qty = round(rng.uniform(0.01, 10), 4)
+            transaction_type = TRANSACTION_SELL_LABEL \
+                if holdings[asset_code] > qty * 1.001 and rng.random() < 0.45 else TRANSACTION_BUY_LABEL
+
+            base_currency = tax_currency
+            price = rates[asset_code][day] * rng.uniform(0.99, 1.01)
+            if len(codes) > 1 and rng.random() < non_tax_share:
+                base_currency = rng.choice([code for code in codes if code != asset_code])
+                base_price = round(price / rates[base_currency][day], 6)
+                # Buying with another asset sells it, so only do so when enough of it is held
+                if base_price > 0 and (
+                    transaction_type == TRANSACTION_SELL_LABEL or holdings[base_currency] > qty * base_price * 1.001
+                ):
+                    price = base_price
+                else:
+                    base_currency = tax_currency
+
+            if base_currency != tax_currency:
+                base_qty = qty * price
+                holdings[base_currency] += base_qty if transaction_type == TRANSACTION_SELL_LABEL else -base_qty
+            else:
+                price = round(price, 2)
+            holdings[asset_code] += qty if transaction_type == TRANSACTION_BUY_LABEL else -qty
+
+            fee_currency = rng.choice(fee_currencies)
+            fee = qty * price * 0.001
+            if fee_currency != base_currency:
+                base_rate = 1 if base_currency == tax_currency else rates[base_currency][day]
+                fee_rate = 1 if fee_currency == tax_currency else rates[fee_currency][day]
+                fee = fee * base_rate / fee_rate
+
+            block.append({
+                FIELD_RAW_ID: f'raw_{i}',
+                FIELD_EXCHANGE: rng.choice(EXCHANGES),
+                FIELD_DATE: (start + timedelta(seconds=offset)).strftime(DATE_INPUT_FORMAT),
+                FIELD_TZ: 'UTC',
+                FIELD_TRANSACTION_TYPE: transaction_type,
+                FIELD_BASE_CURRENCY: base_currency,
+                FIELD_ASSET_CODE: asset_code,
+                FIELD_QTY: f'{qty:.4f}',
+                FIELD_PRICE: f'{price:.6f}' if base_currency != tax_currency else f'{price:.2f}',
+                FIELD_FEE_CURRENCY: fee_currency,
+                FIELD_FEE: f'{fee:.6f}',
+                FIELD_NOTE: '',
+            })
+
+            if len(block) == SHUFFLE_BLOCK_SIZE:
+                rng.shuffle(block)
+                writer.writerows(block)
+                block = []
+
+        rng.shuffle(block)
+        writer.writerows(block)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('folder', type=Path, help='Folder to write transactions.csv and rates.csv to')
+    parser.add_argument('-n', '--rows', type=int, required=True, help='Number of transactions')
+    parser.add_argument('-a', '--assets', type=int, default=5, help='Number of assets (defaults to 5)')
+    parser.add_argument('--non_tax_share', type=float, default=0.2, help='Share of trades against another asset instead of the tax currency (defaults to 0.2)')
+    parser.add_argument('--fee_currencies', nargs='+', default=['usd', 'bnb'], type=str.lower, help='Currencies fees are paid in (defaults to usd bnb)')
+    parser.add_argument('-c', '--tax_currency', default='usd', type=str.lower, help='Tax currency (defaults to usd)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed (defaults to 0)')
+    args = parser.parse_args()
+
+    generate_portfolio(
+        args.folder,
+        args.rows,
+        assets=args.assets,
+        non_tax_share=args.non_tax_share,
+        fee_currencies=args.fee_currencies,
+        tax_currency=args.tax_currency,
+        seed=args.seed,
+    )
+
+
+if __name__ == '__main__':
+    main()
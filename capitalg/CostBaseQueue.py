@@ -1,62 +1,166 @@
 import enum
+import heapq
+from collections import deque
+from itertools import count
+from operator import itemgetter
 from decimal import Decimal
-from typing import Dict
+from typing import List
 
 from capitalg.contstants import FIELD_QTY
+from capitalg.Transaction import Transaction
 
 
 class QueueTypes(enum.Enum):
     LIFO = 'LIFO'
     FIFO = 'FIFO'
+    # Highest and lowest unit cost (price plus fee_unit) first
+    HIFO = 'HIFO'
+    LOFO = 'LOFO'
+
+
+# Queue types which consume lots in order of unit cost
+COST_QUEUE_TYPES = (QueueTypes.HIFO, QueueTypes.LOFO)
+
+
+class Lot:
+    """ An open (or partially consumed) purchase held in a CostBaseQueue.
+    Only the fields needed for matching are copied out of the purchase transaction,
+    the transaction itself is referenced, not copied.
+    """
+    __slots__ = ('qty', 'price', 'fee_unit', 'timestamp', 'transaction')
+
+    def __init__(self, qty: Decimal, price: Decimal, fee_unit: Decimal,
+                 timestamp: int, transaction: Transaction):
+        self.qty = qty
+        self.price = price
+        self.fee_unit = fee_unit
+        self.timestamp = timestamp
+        self.transaction = transaction
+
+    @classmethod
+    def from_transaction(cls, transaction: Transaction) -> 'Lot':
+        return cls(
+            qty=transaction.qty,
+            price=transaction.price,
+            fee_unit=transaction.fee_unit,
+            timestamp=transaction.timestamp,
+            transaction=transaction,
+        )
+
+    def to_dict(self) -> dict:
+        """ The purchase transaction, with qty set to the qty of this lot
+        """
+        return {**self.transaction.to_dict(), FIELD_QTY: self.qty}
+
+    def __repr__(self):
+        return f'Lot({self.to_dict()})'
 
 
 class CostBaseQueue:
     """ NOTE The queue does not validate transaction order
     The order of the queue is simply the order in which .add is called
+
+    FIFO and LIFO lots are held in a deque, so consumption costs time
+    in proportion to the number of lots touched, not the size of the queue.
+
+    HIFO and LOFO lots are held in a heap keyed on unit cost, then on the order they were added,
+    so lots of equal unit cost are consumed first in, first out. Adding a lot and fully consuming one cost
+    O(log n), partially consuming the top lot costs O(1)
     """
 
     def __init__(self, queue_type: QueueTypes):
         self.type = queue_type
-        self.queue = []
+        self.by_cost = queue_type in COST_QUEUE_TYPES
+        if self.by_cost:
+            # [(unit cost key, order added, lot)]
+            self.queue = []
+            self.order = count()
+        else:
+            self.queue = deque()
 
-    def add(self, row: Dict[str, Decimal]):
+    def empty_like(self) -> 'CostBaseQueue':
+        """ An empty queue of the same type (and storage)
+        """
+        return CostBaseQueue(self.type)
+
+    def add(self, transaction: Transaction):
         """ Add a transaction for asset purchase
         """
-        self.queue.append(row)
+        self.add_lot(Lot.from_transaction(transaction))
 
-    def get_transactions(self, sale_qty: Decimal):
-        transactions = []
-        consumed_rows = 0
+    def add_lot(self, lot: Lot):
+        """ Add an open lot, e.g. one taken from another queue
+        """
+        if self.by_cost:
+            unit_cost = lot.price + lot.fee_unit
+            heapq.heappush(self.queue, (-unit_cost if self.type == QueueTypes.HIFO else unit_cost, next(self.order), lot))
+        else:
+            self.queue.append(lot)
+
+    def get_transactions(self, sale_qty: Decimal) -> List[Lot]:
+        """ Consume sale_qty from the queue.
+        Fully consumed lots are removed from the queue and returned as is.
+        A partially consumed lot stays in the queue with a reduced qty, and a new lot is returned for the consumed qty.
+        """
+        if self.by_cost:
+            return self._get_transactions_by_cost(sale_qty)
+
+        lots = []
         qty = sale_qty
+        queue = self.queue
 
-        queue = reversed(
-            self.queue) if self.type == QueueTypes.LIFO else self.queue
+        # The consuming end of the queue
+        if self.type == QueueTypes.LIFO:
+            end, pop = -1, queue.pop
+        else:
+            end, pop = 0, queue.popleft
 
-        for i, row in enumerate(queue):
+        while queue:
+            lot = queue[end]
 
-            if qty < row[FIELD_QTY]:
-                copied_row = row.copy()
-                copied_row[FIELD_QTY] = qty
-                row[FIELD_QTY] -= qty
-                transactions.append(copied_row)
+            if qty < lot.qty:
+                lots.append(Lot(qty, lot.price, lot.fee_unit, lot.timestamp, lot.transaction))
+                lot.qty -= qty
                 break
 
-            elif qty >= row[FIELD_QTY]:
-                copied_row = row.copy()
-                consumed_rows += 1
-                qty -= copied_row[FIELD_QTY]
-                transactions.append(copied_row)
-                continue
+            # Remove fully sold purchases from queue
+            qty -= lot.qty
+            lots.append(pop())
+
+        return lots
+
+    def _get_transactions_by_cost(self, sale_qty: Decimal) -> List[Lot]:
+        """ As per get_transactions, consuming the top of the heap. A partially consumed lot
+        keeps its unit cost, so stays at the top of the heap
+        """
+        lots = []
+        qty = sale_qty
+        heap = self.queue
+
+        while heap:
+            lot = heap[0][2]
+
+            if qty < lot.qty:
+                lots.append(Lot(qty, lot.price, lot.fee_unit, lot.timestamp, lot.transaction))
+                lot.qty -= qty
+                break
 
-        # Remove fully sold purchases from queue
-        if consumed_rows > 0:
-            if self.type == QueueTypes.LIFO:
-                del self.queue[-consumed_rows:]
-            else:
-                del self.queue[:consumed_rows]
+            qty -= lot.qty
+            lots.append(heapq.heappop(heap)[2])
 
-        return transactions
+        return lots
 
     @property
     def get_queue(self):
+        """ The open lots, in the order they were added
+        """
+        if self.by_cost:
+            return [lot for _, _, lot in sorted(self.queue, key=itemgetter(1))]
         return self.queue
+
+    def __len__(self):
+        return len(self.queue)
+
+    def close(self):
+        """ Releases anything the queue holds besides memory, see SpillingCostBaseQueue
+        """
@@ -0,0 +1,178 @@
+""" Records where the time and memory of a calculation go, see calculate_cg(profiler=...)
+"""
+import json
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, Optional
+
+# Counters reported for every calculation, even if they were never incremented
+COUNTER_ROWS_READ = 'rows_read'
+COUNTER_ROWS_REBASED = 'rows_rebased'
+COUNTER_RATE_LOOKUPS = 'rate_lookups'
+COUNTER_LOTS_CONSUMED = 'lots_consumed'
+
+STAGE_RATES = 'rates'
+STAGE_PARSE = 'parse'
+STAGE_CONVERT_TIMEZONE = 'convert_timezone'
+STAGE_REBASE = 'rebase'
+STAGE_SORT = 'sort'
+STAGE_MATCH = 'match'
+STAGE_WRITE = 'write'
+STAGE_SNAPSHOT = 'snapshot'
+
+
+def reset_peak_memory():
+    """ Resets the peak traced memory to the current traced memory.
+    tracemalloc.reset_peak is new in Python 3.9, before which the peak can't be reset
+    """
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+
+
+class Profiler:
+    """ Wall time and peak memory of each stage, plus counters.
+
+    Stages nest, e.g. parsing happens while sorting pulls rows from the reader.
+    Time is exclusive, i.e. time spent in a nested stage is not counted towards the enclosing stage.
+    Peak memory is the highest traced memory (in use by Python) seen while the stage was running.
+    NOTE before Python 3.9, it is the highest traced memory since tracing started (see reset_peak_memory)
+    """
+
+    def __init__(self, trace_memory: bool = True):
+        self.trace_memory = trace_memory
+        self.seconds: Dict[str, float] = {}
+        self.peak_memory: Dict[str, int] = {}
+        self.counters: Dict[str, int] = dict.fromkeys(
+            (COUNTER_ROWS_READ, COUNTER_ROWS_REBASED, COUNTER_RATE_LOOKUPS, COUNTER_LOTS_CONSUMED), 0
+        )
+        self.max_queue_depth: Dict[str, int] = {}
+        self._stack = []
+        self._last = None
+        self._tracing = False
+        self._started_tracing = False
+
+    def start(self):
+        """ Starts tracing memory, unless it is already being traced
+        """
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        self._tracing = self.trace_memory
+
+    def stop(self):
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+        self._tracing = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _switch(self):
+        """ Charges the time (and peak memory) since the last switch to the running stage
+        """
+        now = time.perf_counter()
+        if self._stack:
+            stage = self._stack[-1]
+            self.seconds[stage] += now - self._last
+            if self._tracing:
+                _, peak = tracemalloc.get_traced_memory()
+                self.peak_memory[stage] = max(self.peak_memory[stage], peak)
+        if self._tracing:
+            reset_peak_memory()
+        self._last = now
+
+    @contextmanager
+    def stage(self, name: str):
+        if name not in self.seconds:
+            self.seconds[name] = 0.0
+            self.peak_memory[name] = 0
+
+        self._switch()
+        self._stack.append(name)
+        try:
+            yield
+        finally:
+            self._switch()
+            self._stack.pop()
+
+    def timed(self, name: str, function: Callable) -> Callable:
+        """ Wraps function, so every call is a stage
+        """
+        def timed_function(*args, **kwargs):
+            with self.stage(name):
+                return function(*args, **kwargs)
+        return timed_function
+
+    def timed_iter(self, name: str, iterable: Iterable) -> Iterator:
+        """ Wraps iterable, so producing every item is a stage
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def count(self, name: str, n: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def record_queue_depth(self, asset_code: str, depth: int):
+        if depth > self.max_queue_depth.get(asset_code, 0):
+            self.max_queue_depth[asset_code] = depth
+
+    def report(self) -> dict:
+        return {
+            'stages': {
+                name: {
+                    'seconds': round(seconds, 6),
+                    'peak_memory_mib': round(self.peak_memory[name] / 2 ** 20, 3) if self.trace_memory else None,
+                }
+                for name, seconds in self.seconds.items()
+            },
+            'counters': dict(self.counters),
+            'max_queue_depth': dict(self.max_queue_depth),
+        }
+
+    def write_report(self, output_path: Optional[Path] = None):
+        """ Writes the report as JSON to output_path, or stderr if output_path is None
+        """
+        report = json.dumps(self.report(), indent=2)
+        if output_path is None:
+            print(report, file=sys.stderr)
+        else:
+            with open(output_path, 'w') as f:
+                f.write(report + '\n')
+
+
+def profile_stage(profiler: Optional[Profiler], name: str):
+    """ profiler.stage, or a no-op if not profiling
+    """
+    return nullcontext() if profiler is None else profiler.stage(name)
+
+
+def profile_function(profiler: Optional[Profiler], name: str, function: Callable) -> Callable:
+    """ profiler.timed, or function as is if not profiling
+    """
+    return function if profiler is None else profiler.timed(name, function)
+
+
+def profile_iter(profiler: Optional[Profiler], name: str, iterable: Iterable) -> Iterable:
+    """ profiler.timed_iter, or iterable as is if not profiling
+    """
+    return iterable if profiler is None else profiler.timed_iter(name, iterable)
+
+
+def profiling(profiler: Optional[Profiler]):
+    """ Starts the profiler for the duration of a with block, or a no-op if not profiling
+    """
+    return nullcontext() if profiler is None else profiler
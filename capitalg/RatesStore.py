@@ -0,0 +1,178 @@
+import logging
+import struct
+import sys
+from array import array
+from datetime import date, datetime
+from decimal import Decimal
+from pathlib import Path
+from typing import Dict, Optional
+
+from capitalg.contstants import DATE_RATE_FORMAT
+
+logger = logging.getLogger(__name__)
+
+CACHE_MAGIC = b'CGRATES1'
+# magic, source mtime_ns, source size, first day ordinal, number of days, number of assets
+CACHE_HEADER = struct.Struct('<8sqqiii')
+CACHE_ASSET_NAME = struct.Struct('<H')
+
+# Exponent of a day without a rate
+MISSING = -128
+
+
+class RatesStore:
+    """ Daily exchange rates, decoded once into a compact pair of arrays per asset, indexed by day.
+
+    Each rate is stored as an integer coefficient and a decimal exponent, so the Decimal
+    returned by get_rate is exactly the Decimal of the rates file (including trailing zeros).
+    Rates that don't fit in the arrays are kept as Decimals in overflow.
+    """
+
+    def __init__(self, first_day: int, days: int):
+        self.first_day = first_day
+        self.days = days
+        self.coefficients: Dict[str, array] = {}
+        self.exponents: Dict[str, array] = {}
+        self.overflow: Dict[tuple, Decimal] = {}
+        self._decoded: Dict[tuple, Decimal] = {}
+
+    @classmethod
+    def from_rates(cls, rates: dict) -> 'RatesStore':
+        """ From the {date: {asset_code: rate}} dict returned by rates_loader.load_rates
+        """
+        days = {datetime.strptime(date_key, DATE_RATE_FORMAT).toordinal(): daily_rates for date_key, daily_rates in rates.items()}
+        first_day = min(days, default=0)
+        store = cls(first_day, max(days, default=first_day - 1) - first_day + 1)
+
+        for day, daily_rates in days.items():
+            for asset_code, rate in daily_rates.items():
+                if asset_code == 'date' or not rate:
+                    continue
+                store._set_rate(asset_code, day - first_day, Decimal(rate))
+
+        return store
+
+    def _set_rate(self, asset_code: str, index: int, rate: Decimal):
+        if asset_code not in self.coefficients:
+            self.coefficients[asset_code] = array('q', bytes(8 * self.days))
+            self.exponents[asset_code] = array('b', [MISSING]) * self.days
+
+        sign, digits, exponent = rate.as_tuple()
+        coefficient = int(''.join(map(str, digits))) if isinstance(exponent, int) else 0
+        if isinstance(exponent, int) and -2 ** 63 <= coefficient < 2 ** 63 and MISSING < exponent < 128:
+            self.coefficients[asset_code][index] = -coefficient if sign else coefficient
+            self.exponents[asset_code][index] = exponent
+        else:
+            self.overflow[(asset_code, index)] = rate
+
+    def get_rate(self, day: date, asset_code: str) -> Optional[Decimal]:
+        """ Returns None if there is no rate for asset_code on day
+        """
+        index = day.toordinal() - self.first_day
+        key = (asset_code, index)
+        rate = self._decoded.get(key)
+        if rate is not None:
+            return rate
+
+        if key in self.overflow:
+            return self.overflow[key]
+
+        exponents = self.exponents.get(asset_code)
+        if exponents is None or not 0 <= index < self.days or exponents[index] == MISSING:
+            return None
+
+        coefficient = self.coefficients[asset_code][index]
+        rate = Decimal((1 if coefficient < 0 else 0, tuple(map(int, str(abs(coefficient)))), exponents[index]))
+        self._decoded[key] = rate
+        return rate
+
+    def write_cache(self, cache_path: Path, source_path: Path) -> bool:
+        """ Writes the store to a binary cache file, stamped with the source file's mtime and size.
+        Returns False if the store can't be cached (i.e. some rates overflow the arrays)
+        """
+        if self.overflow:
+            logger.info(f'Not caching rates, {len(self.overflow)} rates are too large for the cache')
+            return False
+
+        source_stat = source_path.stat()
+        tmp_path = cache_path.with_name(cache_path.name + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(CACHE_HEADER.pack(
+                CACHE_MAGIC, source_stat.st_mtime_ns, source_stat.st_size,
+                self.first_day, self.days, len(self.coefficients)
+            ))
+            for asset_code, coefficients in self.coefficients.items():
+                name = asset_code.encode()
+                f.write(CACHE_ASSET_NAME.pack(len(name)))
+                f.write(name)
+                f.write(_to_little_endian(coefficients).tobytes())
+                f.write(self.exponents[asset_code].tobytes())
+        tmp_path.replace(cache_path)
+        return True
+
+    @classmethod
+    def read_cache(cls, cache_path: Path, source_path: Path) -> Optional['RatesStore']:
+        """ Returns None if there is no cache, it is out of date with the source file,
+        or its arrays aren't the lengths given by its header (e.g. it was truncated)
+        """
+        if cache_path.exists() is False:
+            return None
+
+        with open(cache_path, 'rb') as f:
+            data = f.read()
+
+        if len(data) < CACHE_HEADER.size:
+            return None
+
+        source_stat = source_path.stat()
+        magic, mtime_ns, size, first_day, days, asset_count = CACHE_HEADER.unpack_from(data)
+        if magic != CACHE_MAGIC or mtime_ns != source_stat.st_mtime_ns or size != source_stat.st_size:
+            return None
+
+        if days < 0 or asset_count < 0:
+            return _corrupt_cache(cache_path)
+
+        store = cls(first_day, days)
+        offset = CACHE_HEADER.size
+        for _ in range(asset_count):
+            if offset + CACHE_ASSET_NAME.size > len(data):
+                return _corrupt_cache(cache_path)
+            name_length, = CACHE_ASSET_NAME.unpack_from(data, offset)
+            offset += CACHE_ASSET_NAME.size
+            # The name, then an 8 byte coefficient and a 1 byte exponent per day
+            if offset + name_length + 9 * days > len(data):
+                return _corrupt_cache(cache_path)
+            try:
+                asset_code = data[offset:offset + name_length].decode()
+            except UnicodeDecodeError:
+                return _corrupt_cache(cache_path)
+            offset += name_length
+
+            coefficients = array('q')
+            coefficients.frombytes(data[offset:offset + 8 * days])
+            offset += 8 * days
+            exponents = array('b')
+            exponents.frombytes(data[offset:offset + days])
+            offset += days
+
+            store.coefficients[asset_code] = _to_little_endian(coefficients)
+            store.exponents[asset_code] = exponents
+
+        if offset != len(data):
+            return _corrupt_cache(cache_path)
+
+        return store
+
+
+def _corrupt_cache(cache_path: Path) -> None:
+    logger.warning(f'Ignoring corrupt rates cache {cache_path}, it will be rebuilt')
+    return None
+
+
+def _to_little_endian(values: array) -> array:
+    """ Cache files are little endian. Swapping is its own inverse, so this also converts back to native order
+    """
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values
@@ -0,0 +1,208 @@
+""" Stores the results of a calculation in a SQLite database, indexed for summary and balance queries.
+
+Values are stored as text, exactly as they are written to CSV, and summed as Decimals
+by the decimal_sum aggregate, so totals are exact.
+"""
+from contextlib import nullcontext
+from decimal import Decimal
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, Optional, Sequence
+
+from capitalg.contstants import (
+    FIELD_ASSET_CODE,
+    FIELD_CAPITAL_GAIN_LT,
+    FIELD_CAPITAL_GAIN_ST,
+    FIELD_CAPITAL_GAIN_TOTAL,
+    FIELD_COST_BASE_ID,
+    FIELD_DATE,
+    FIELD_FEE,
+    FIELD_FEE_CURRENCY,
+    FIELD_QTY,
+    FIELD_SALE_ID,
+    OUTPUT_FIELDS_CGT_EVENTS,
+    OUTPUT_FIELDS_COST_BASE,
+    OUTPUT_FIELDS_UNALLOCATED_COST_BASE,
+)
+
+SQLITE_SUFFIX = '.sqlite'
+
+TABLE_CG_EVENTS = 'cg_events'
+TABLE_COST_BASE = 'cost_base_transactions'
+TABLE_UNALLOCATED_COST_BASE = 'unallocated_cost_base_transactions'
+# Total fees of the raw transactions, by (raw) fee currency
+TABLE_FEES = 'fees'
+
+TABLE_FIELDS = {
+    TABLE_CG_EVENTS: OUTPUT_FIELDS_CGT_EVENTS,
+    TABLE_COST_BASE: OUTPUT_FIELDS_COST_BASE,
+    TABLE_UNALLOCATED_COST_BASE: OUTPUT_FIELDS_UNALLOCATED_COST_BASE,
+    TABLE_FEES: [FIELD_FEE_CURRENCY, FIELD_FEE],
+}
+
+TABLE_INDEXES = {
+    TABLE_CG_EVENTS: [[FIELD_DATE], [FIELD_ASSET_CODE, FIELD_DATE], [FIELD_SALE_ID]],
+    TABLE_COST_BASE: [[FIELD_COST_BASE_ID]],
+    TABLE_UNALLOCATED_COST_BASE: [[FIELD_ASSET_CODE]],
+    TABLE_FEES: [[FIELD_FEE_CURRENCY]],
+}
+
+# Tables which are appended to by incremental calculations. The others are rewritten by every calculation
+APPEND_TABLES = [TABLE_CG_EVENTS, TABLE_COST_BASE]
+
+
+class DecimalSum:
+    """ SQLite aggregate summing text values as Decimals. Returns the total as text
+    """
+
+    def __init__(self):
+        self.total = Decimal(0)
+
+    def step(self, value):
+        if value is not None and value != '':
+            self.total += Decimal(value)
+
+    def finalize(self):
+        return str(self.total)
+
+
+def is_result_store(path: Path) -> bool:
+    return Path(path).suffix == SQLITE_SUFFIX
+
+
+def open_result_store(path: Optional[Path]):
+    """ A ResultStore for the duration of a with block, or a no-op if path is None
+    """
+    return nullcontext() if path is None else ResultStore(path)
+
+
+class ResultStore:
+
+    def __init__(self, path: Path):
+        # Imported on first use, so reading other output formats doesn't import sqlite3
+        import sqlite3
+
+        self.path = path
+        # A pipelined calculation writes cg events from its write thread (see pipeline.py).
+        # Only one thread uses the connection at a time
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.create_aggregate('decimal_sum', 1, DecimalSum)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def create_table(self, table: str, replace: bool = False):
+        """ Creates table (and its indexes) if it doesn't exist. If replace is True, any existing table is dropped first
+        """
+        if replace is True:
+            self.connection.execute(f'DROP TABLE IF EXISTS {table}')
+
+        columns = ', '.join(f'"{field}" TEXT' for field in TABLE_FIELDS[table])
+        self.connection.execute(f'CREATE TABLE IF NOT EXISTS {table} ({columns})')
+        for fields in TABLE_INDEXES[table]:
+            index = f'{table}_{"_".join(fields)}'
+            columns = ', '.join(f'"{field}"' for field in fields)
+            self.connection.execute(f'CREATE INDEX IF NOT EXISTS {index} ON {table} ({columns})')
+
+    def insert_rows(self, table: str, rows: Iterable[tuple]):
+        """ rows are tuples in TABLE_FIELDS order
+        """
+        placeholders = ', '.join('?' * len(TABLE_FIELDS[table]))
+        self.connection.executemany(
+            f'INSERT INTO {table} VALUES ({placeholders})',
+            (tuple('' if value is None else str(value) for value in row) for row in rows)
+        )
+
+    def replace_fees(self, fee_totals: Dict[str, Decimal]):
+        self.create_table(TABLE_FEES, replace=True)
+        self.insert_rows(TABLE_FEES, fee_totals.items())
+        self.connection.commit()
+
+    def row_counts(self) -> Dict[str, int]:
+        """ The number of rows in each of the APPEND_TABLES, see truncate
+        """
+        counts = {}
+        for table in APPEND_TABLES:
+            self.create_table(table)
+            counts[table] = self.connection.execute(f'SELECT COALESCE(MAX(rowid), 0) FROM {table}').fetchone()[0]
+        self.connection.commit()
+        return counts
+
+    def truncate(self, row_counts: Dict[str, int]):
+        """ Deletes rows added to the APPEND_TABLES since row_counts were taken
+        """
+        for table, count in row_counts.items():
+            self.connection.execute(f'DELETE FROM {table} WHERE rowid > ?', (count,))
+        self.connection.commit()
+
+    def cg_summary(self, tax_year_start: str, tax_year_cutoff: str) -> Dict[str, Dict[str, Decimal]]:
+        """ Capital gains by asset, for cg events dated from tax_year_start up to (but excluding) tax_year_cutoff.
+        Assets are in order of their first cg event
+        """
+        rows = self.connection.execute(f'''
+            SELECT "{FIELD_ASSET_CODE}",
+                decimal_sum("{FIELD_CAPITAL_GAIN_TOTAL}"),
+                decimal_sum("{FIELD_CAPITAL_GAIN_LT}"),
+                decimal_sum("{FIELD_CAPITAL_GAIN_ST}")
+            FROM {TABLE_CG_EVENTS}
+            WHERE "{FIELD_DATE}" >= ? AND "{FIELD_DATE}" < ?
+            GROUP BY "{FIELD_ASSET_CODE}"
+            ORDER BY MIN(rowid)
+        ''', (tax_year_start, tax_year_cutoff))
+
+        return {
+            asset_code: {
+                FIELD_CAPITAL_GAIN_TOTAL: Decimal(total),
+                FIELD_CAPITAL_GAIN_LT: Decimal(lt),
+                FIELD_CAPITAL_GAIN_ST: Decimal(st),
+            }
+            for asset_code, total, lt, st in rows
+        }
+
+    def read_rows(self, table: str, fields: Sequence[str]) -> Iterator[tuple]:
+        """ Yields the named fields of every row of table, in the order they were written
+        """
+        columns = ', '.join(f'"{field}"' for field in fields)
+        yield from self.connection.execute(f'SELECT {columns} FROM {table} ORDER BY rowid')
+
+    def unallocated_cost_base(self) -> Dict[str, Decimal]:
+        """ Total unallocated qty by asset
+        """
+        rows = self.connection.execute(f'''
+            SELECT "{FIELD_ASSET_CODE}", decimal_sum("{FIELD_QTY}")
+            FROM {TABLE_UNALLOCATED_COST_BASE}
+            GROUP BY "{FIELD_ASSET_CODE}"
+            ORDER BY MIN(rowid)
+        ''')
+        return {asset_code: Decimal(qty) for asset_code, qty in rows}
+
+    def fees(self, exclude_currency: Optional[str] = None) -> Dict[str, Decimal]:
+        """ Total fees of the raw transactions by fee currency, excluding exclude_currency (e.g. the tax currency)
+        """
+        rows = self.connection.execute(
+            f'SELECT "{FIELD_FEE_CURRENCY}", "{FIELD_FEE}" FROM {TABLE_FEES} WHERE "{FIELD_FEE_CURRENCY}" != ?',
+            (exclude_currency or '',)
+        )
+        return {fee_currency: Decimal(fee) for fee_currency, fee in rows}
+
+
+class SqliteSink:
+    """ Writes rows to a table of a ResultStore, in the same way as the file sinks in Writer
+    """
+
+    def __init__(self, result_store: ResultStore, table: str, append: bool = False):
+        self.result_store = result_store
+        self.table = table
+        result_store.create_table(table, replace=not append)
+
+    def write_rows(self, rows: Sequence[tuple]):
+        self.result_store.insert_rows(self.table, rows)
+
+    def close(self):
+        self.result_store.connection.commit()
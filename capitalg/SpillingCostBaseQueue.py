@@ -0,0 +1,212 @@
+""" A CostBaseQueue that holds at most about buffer_size open lots in memory, spilling the rest to a temporary file.
+
+Only the consuming end of the queue is kept in memory: the oldest lots of a FIFO queue, the newest of a LIFO queue.
+Lots further from the consuming end are pickled to the file in chunks, and read back a chunk at a time
+once the lots in memory have been consumed. Consumption is the same as CostBaseQueue's,
+including across chunk boundaries.
+
+A FIFO queue reads chunks from the start of the file while spilling to its end, so once the chunks already read
+take up more of the file than those still to read, the rest are moved to the start of the file.
+The file is then at most about twice the size of the lots spilled.
+
+FIFO: [lots in memory] [spilled chunks, oldest first] [newest lots, until there are a chunk's worth to spill]
+LIFO: [spilled chunks, oldest first] [lots in memory]
+"""
+import pickle
+import tempfile
+from collections import deque
+from decimal import Decimal
+from operator import attrgetter
+from typing import IO, Iterator, List, Optional, Tuple
+
+from capitalg.CostBaseQueue import COST_QUEUE_TYPES, CostBaseQueue, Lot, QueueTypes
+from capitalg.Transaction import Transaction
+
+# Lots are pickled as tuples of their fields, and their transaction's fields in Transaction() argument order,
+# which is much faster than pickling objects with __slots__
+_lot_fields = attrgetter('qty', 'price', 'fee_unit', 'timestamp')
+_transaction_fields = attrgetter(*Transaction.__slots__)
+
+# A FIFO spill file isn't compacted until the chunks already read take up at least this many bytes
+COMPACT_MIN_BYTES = 1 << 20
+
+# Spill files are copied in blocks of this many bytes
+_COPY_BLOCK_SIZE = 1 << 20
+
+
+class SpillingCostBaseQueue(CostBaseQueue):
+    """ NOTE the unit cost ordered queue types (HIFO and LOFO) can't be spilled.
+    Lots read back from the file reference copies of their purchase transactions
+    """
+
+    def __init__(self, queue_type: QueueTypes, buffer_size: int, temp_dir: Optional[str] = None):
+        if buffer_size < 1:
+            raise ValueError(f'buffer_size must be at least 1, got {buffer_size}')
+        if queue_type in COST_QUEUE_TYPES:
+            raise ValueError(f'{queue_type.value} queues can not be spilled to disk')
+
+        super().__init__(queue_type)
+        self.buffer_size = buffer_size
+        self.temp_dir = temp_dir
+        # Lots are spilled (and read back) a quarter of the buffer at a time
+        self.chunk_size = max(1, buffer_size // 4)
+        # The newest lots of a FIFO queue, once lots have been spilled
+        self.tail = []
+        # (offset, number of lots) of each spilled chunk, oldest first
+        self.chunks = deque()
+        self.spilled = 0
+        self.file: Optional[IO[bytes]] = None
+        self.file_end = 0
+
+    def empty_like(self) -> 'SpillingCostBaseQueue':
+        return SpillingCostBaseQueue(self.type, self.buffer_size, self.temp_dir)
+
+    def add_lot(self, lot: Lot):
+        if self.type == QueueTypes.LIFO:
+            self.queue.append(lot)
+            if len(self.queue) > self.buffer_size:
+                # Spill the oldest lots, which are consumed last
+                self._spill([self.queue.popleft() for _ in range(self.chunk_size)])
+            return
+
+        # Lots are only added to memory while nothing has been spilled, so they are consumed in order
+        if not self.chunks and not self.tail and len(self.queue) < self.buffer_size - self.chunk_size:
+            self.queue.append(lot)
+            return
+
+        self.tail.append(lot)
+        if len(self.tail) >= self.chunk_size:
+            self._spill(self.tail)
+            self.tail = []
+
+    def get_transactions(self, sale_qty: Decimal) -> List[Lot]:
+        lots = []
+        qty = sale_qty
+        while self._refill():
+            consumed = super().get_transactions(qty)
+            lots += consumed
+            if self.queue:
+                # The sale ended on a partially consumed lot
+                break
+            qty -= sum(lot.qty for lot in consumed)
+        return lots
+
+    @property
+    def get_queue(self) -> Iterator[Lot]:
+        """ The open lots, in the order they were added. Spilled lots are read a chunk at a time
+        """
+        if self.type == QueueTypes.LIFO:
+            yield from self._read_chunks()
+            yield from self.queue
+        else:
+            yield from self.queue
+            yield from self._read_chunks()
+            yield from self.tail
+
+    def __len__(self):
+        return len(self.queue) + self.spilled + len(self.tail)
+
+    def close(self):
+        """ Deletes the temporary file
+        """
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def dump(self, f: IO[bytes]) -> Tuple[List[Lot], List[Tuple[int, int]], List[Lot]]:
+        """ Copies the spilled chunks to f, from its current position, without reading their lots.
+        Returns the lots in memory before the spilled chunks, the (offset in f, number of lots) of each chunk,
+        and the lots in memory after them, in the order they were added (see read_chunk)
+        """
+        chunks = []
+        if self.chunks:
+            start = self.chunks[0][0]
+            position = f.tell()
+            _copy_bytes(self.file, start, self.file_end, f, position)
+            f.seek(position + self.file_end - start)
+            chunks = [(offset - start + position, count) for offset, count in self.chunks]
+
+        if self.type == QueueTypes.LIFO:
+            return [], chunks, list(self.queue)
+        return list(self.queue), chunks, list(self.tail)
+
+    def _spill(self, lots: List[Lot]):
+        if self.file is None:
+            self.file = tempfile.TemporaryFile(dir=self.temp_dir)
+        self.file.seek(self.file_end)
+        pickle.dump([(*_lot_fields(lot), _transaction_fields(lot.transaction)) for lot in lots], self.file,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+        self.chunks.append((self.file_end, len(lots)))
+        self.spilled += len(lots)
+        self.file_end = self.file.tell()
+
+    def _read_chunks(self) -> Iterator[Lot]:
+        for offset, _ in list(self.chunks):
+            yield from read_chunk(self.file, offset)
+
+    def _compact(self):
+        """ Moves the FIFO chunks still to be read to the start of the file,
+        once the chunks already read take up at least as much of it
+        """
+        start = self.chunks[0][0]
+        if start < COMPACT_MIN_BYTES or start < self.file_end - start:
+            return
+
+        _copy_bytes(self.file, start, self.file_end, self.file, 0)
+        self.file_end -= start
+        self.file.truncate(self.file_end)
+        self.chunks = deque((offset - start, count) for offset, count in self.chunks)
+
+    def _refill(self) -> bool:
+        """ Moves the next lots to be consumed into memory, if there are none. Returns whether there are lots to consume
+        """
+        if self.queue:
+            return True
+
+        if self.chunks:
+            if self.type == QueueTypes.LIFO:
+                # The newest spilled chunk. The file is used as a stack
+                offset, count = self.chunks.pop()
+                self.queue.extend(read_chunk(self.file, offset))
+                self.file.truncate(offset)
+                self.file_end = offset
+            else:
+                offset, count = self.chunks.popleft()
+                self.queue.extend(read_chunk(self.file, offset))
+                if not self.chunks:
+                    # Every spilled lot has been read, so the file can be reused from the start
+                    self.file.truncate(0)
+                    self.file_end = 0
+                else:
+                    self._compact()
+            self.spilled -= count
+        elif self.tail:
+            self.queue.extend(self.tail)
+            self.tail = []
+
+        return bool(self.queue)
+
+
+def read_chunk(f: IO[bytes], offset: int) -> List[Lot]:
+    """ The lots of the chunk spilled to f at offset
+    """
+    f.seek(offset)
+    return [
+        Lot(qty, price, fee_unit, timestamp, Transaction(*transaction))
+        for qty, price, fee_unit, timestamp, transaction in pickle.load(f)
+    ]
+
+
+def _copy_bytes(source: IO[bytes], start: int, end: int, target: IO[bytes], position: int):
+    """ Copies bytes start to end of source to position in target, a block at a time.
+    target can be source, if position is not after start
+    """
+    while start < end:
+        source.seek(start)
+        block = source.read(min(_COPY_BLOCK_SIZE, end - start))
+        if not block:
+            raise EOFError(f'Spill file ended at {start}, expected {end} bytes')
+        target.seek(position)
+        target.write(block)
+        start += len(block)
+        position += len(block)
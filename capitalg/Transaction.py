@@ -0,0 +1,93 @@
+from decimal import Decimal
+
+from capitalg.contstants import (
+    FIELD_ASSET_CODE,
+    FIELD_BASE_CURRENCY,
+    FIELD_DATE,
+    FIELD_EXCHANGE,
+    FIELD_FEE,
+    FIELD_FEE_CURRENCY,
+    FIELD_FEE_UNIT,
+    FIELD_NOTE,
+    FIELD_PRICE,
+    FIELD_QTY,
+    FIELD_RAW_ID,
+    FIELD_TRANSACTION_TYPE,
+    FIELD_TZ,
+)
+from capitalg.utils import format_timestamp
+
+
+class Transaction:
+    """ A formatted transaction, denominated in the tax currency.
+
+    timestamp is the wall clock time of the transaction in the tax timezone (tz),
+    as whole seconds since 1970-01-01T00:00:00 (see utils.to_timestamp).
+    Numeric fields are Decimal. Strings are only produced when the transaction is written out.
+    """
+    __slots__ = (
+        'id',
+        'exchange',
+        'timestamp',
+        'tz',
+        'type',
+        'base_currency',
+        'asset_code',
+        'price',
+        'qty',
+        'fee_currency',
+        'fee',
+        'fee_unit',
+        'note',
+    )
+
+    def __init__(self, id: str, exchange: str, timestamp: int, tz: str, type: str,
+                 base_currency: str, asset_code: str, price: Decimal, qty: Decimal,
+                 fee_currency: str, fee: Decimal, fee_unit: Decimal, note: str):
+        self.id = id
+        self.exchange = exchange
+        self.timestamp = timestamp
+        self.tz = tz
+        self.type = type
+        self.base_currency = base_currency
+        self.asset_code = asset_code
+        self.price = price
+        self.qty = qty
+        self.fee_currency = fee_currency
+        self.fee = fee
+        self.fee_unit = fee_unit
+        self.note = note
+
+    @property
+    def date(self) -> str:
+        return format_timestamp(self.timestamp)
+
+    def to_dict(self) -> dict:
+        """ Row in OUTPUT_FIELDS_FORMATTED_TRANSACTIONS order
+        """
+        return {
+            FIELD_RAW_ID: self.id,
+            FIELD_EXCHANGE: self.exchange,
+            FIELD_DATE: self.date,
+            FIELD_TZ: self.tz,
+            FIELD_TRANSACTION_TYPE: self.type,
+            FIELD_BASE_CURRENCY: self.base_currency,
+            FIELD_ASSET_CODE: self.asset_code,
+            FIELD_PRICE: self.price,
+            FIELD_QTY: self.qty,
+            FIELD_FEE_CURRENCY: self.fee_currency,
+            FIELD_FEE: self.fee,
+            FIELD_FEE_UNIT: self.fee_unit,
+            FIELD_NOTE: self.note,
+        }
+
+    def _values(self) -> tuple:
+        return tuple(getattr(self, field) for field in self.__slots__)
+
+    def __eq__(self, other):
+        if not isinstance(other, Transaction):
+            return NotImplemented
+        return self._values() == other._values()
+
+    def __repr__(self):
+        return f'Transaction({self.to_dict()})'
@@ -1,20 +1,24 @@
 import csv
+import glob
+import heapq
 import logging
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from decimal import Decimal
-from operator import itemgetter
+from itertools import islice
+from operator import attrgetter
 from pathlib import Path
-from typing import List, Optional
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
 
 from capitalg.contstants import (
-    DATE_INPUT_FORMAT,
     DATE_RATE_FORMAT,
+    DEFAULT_SORT_BUFFER_SIZE,
     FIELD_ASSET_CODE,
     FIELD_BASE_CURRENCY,
     FIELD_FEE_CURRENCY,
     FIELD_DATE,
     FIELD_EXCHANGE,
-    FIELD_FEE_UNIT,
     FIELD_FEE,
     FIELD_NOTE,
     FIELD_PRICE,
@@ -22,72 +26,307 @@ from capitalg.contstants import (
     FIELD_RAW_ID,
     FIELD_TRANSACTION_TYPE,
     FIELD_TZ,
+    FILL_ID_SEPARATOR,
     TRANSACTION_BUY_LABEL,
     TRANSACTION_SELL_LABEL,
 )
 from capitalg.errors import InputValidationError
-from capitalg.utils import convert_timezone
+from capitalg.external_sort import external_sort, read_run_file, write_run_file
+from capitalg.Profiler import (
+    COUNTER_RATE_LOOKUPS,
+    COUNTER_ROWS_READ,
+    COUNTER_ROWS_REBASED,
+    STAGE_CONVERT_TIMEZONE,
+    STAGE_PARSE,
+    STAGE_REBASE,
+    STAGE_SORT,
+    STAGE_WRITE,
+    Profiler,
+    profile_function,
+    profile_iter,
+    profile_stage,
+)
+from capitalg.rate_providers import CachedRates, RateKey, RateProvider
+from capitalg.RatesStore import RatesStore
+from capitalg.Transaction import Transaction
+from capitalg.utils import convert_timezone, to_timestamp
+from capitalg.Writer import Writer
 
 logger = logging.getLogger(__name__)
 
+InputPaths = Union[Path, str, Sequence[Union[Path, str]]]
+
+
+def resolve_input_paths(input_path: InputPaths) -> List[Path]:
+    """ A path, glob pattern, or list of them, as a list of paths. Each pattern is expanded in sorted order
+    """
+    patterns = [input_path] if isinstance(input_path, (str, Path)) else list(input_path)
+    paths = []
+    for pattern in patterns:
+        if any(char in str(pattern) for char in '*?['):
+            matches = sorted(glob.glob(str(pattern)))
+            if not matches:
+                raise InputValidationError(f'No input files match {pattern}')
+            paths += [Path(match) for match in matches]
+        else:
+            paths.append(Path(pattern))
+
+    if not paths:
+        raise InputValidationError('No input files given')
+    return paths
+
+
+def merge_fills(rows: Iterable[Tuple[int, dict, datetime]]) -> Iterator[Tuple[int, dict, datetime]]:
+    """ Merges the fills of an order, i.e. consecutive (row index, standardized row, date) rows with the same date,
+    asset, base currency, type, price, exchange and raw fee currency, into a single row. Its qty and fee are
+    the totals of the fills, and its id is the raw ids of the fills joined with FILL_ID_SEPARATOR,
+    for the audit trail. Other fields are those of the first fill.
+
+    Rows are merged before they are rebased, so fills paid in different fee currencies are kept apart,
+    and the base currency transactions of different orders are never merged. Rows keep their file order
+    """
+    fills = []
+    key = None
+    for row in rows:
+        _, transaction, transaction_date = row
+        row_key = (
+            transaction_date,
+            transaction[FIELD_ASSET_CODE],
+            transaction[FIELD_BASE_CURRENCY],
+            transaction[FIELD_TRANSACTION_TYPE],
+            Decimal(transaction[FIELD_PRICE]),
+            transaction[FIELD_EXCHANGE],
+            transaction[FIELD_FEE_CURRENCY],
+        )
+        if row_key != key and fills:
+            yield _merged(fills)
+            fills = []
+        key = row_key
+        fills.append(row)
+    if fills:
+        yield _merged(fills)
+
+
+def _merged(fills: List[Tuple[int, dict, datetime]]) -> Tuple[int, dict, datetime]:
+    if len(fills) == 1:
+        return fills[0]
+
+    i, first, transaction_date = fills[0]
+    transactions = [transaction for _, transaction, _ in fills]
+    fees = [transaction[FIELD_FEE] for transaction in transactions if transaction[FIELD_FEE]]
+    return i, {
+        **first,
+        FIELD_RAW_ID: FILL_ID_SEPARATOR.join(transaction[FIELD_RAW_ID] for transaction in transactions),
+        FIELD_QTY: str(sum(Decimal(transaction[FIELD_QTY]) for transaction in transactions)),
+        FIELD_FEE: str(sum(Decimal(fee) for fee in fees)) if fees else first[FIELD_FEE],
+    }, transaction_date
+
+
 class TransactionLoader:
 
     def __init__(
         self,
-        input_path: Path,
+        input_path: InputPaths,
         output_path: Path,
         tax_currency: str,
         tax_year_cutoff: datetime,
         tax_timezone: Optional[str] = 'UTC',
-        rates: Optional[dict] = None
+        rates: Optional[Union[dict, RatesStore, RateProvider, CachedRates]] = None,
+        streaming: bool = False,
+        sort_buffer_size: int = DEFAULT_SORT_BUFFER_SIZE,
+        profiler: Optional[Profiler] = None,
+        track_fees: bool = False,
+        workers: int = 1,
+        coalesce_fills: bool = False,
     ):
+        """ By default all transactions are loaded into memory on init.
+        If streaming is True, nothing is loaded until .stream() is iterated, and at most
+        sort_buffer_size transactions are held in memory while sorting.
+
+        rates can be a RatesStore, or a dict as returned by rates_loader.load_rates, or a RateProvider
+        or CachedRates (see rate_providers). Rates are then fetched as needed: before a batch of rows is rebased,
+        the rates it references that aren't cached are fetched together
+
+        If a profiler is given, loading stages and counters are recorded to it
+
+        If track_fees is True, fee_totals holds the total raw fee of every input row (including rows after
+        the tax year cutoff) by fee currency, once the transactions have been read
+
+        input_path can be a list of files and/or glob patterns, e.g. one export per exchange.
+        Each file is sorted on its own, and the sorted files are merged, so there is no sort of all transactions.
+        If workers > 1, files are read, rebased and sorted in worker processes. Transactions on the same date
+        keep the order of the files, as if they were concatenated
+
+        If coalesce_fills is True, consecutive fills of the same order in a file are merged into one row before it is rebased
+        (see merge_fills)
+        """
         self.input_path = input_path
+        self.input_paths = resolve_input_paths(input_path)
+        self.workers = workers
         self.output_path = output_path
         self.tax_currency = tax_currency
         self.tax_year_cutoff = tax_year_cutoff
         self.tax_timezone = tax_timezone
         self.transactions = []
+        if isinstance(rates, dict):
+            rates = RatesStore.from_rates(rates)
+        elif isinstance(rates, RateProvider):
+            rates = CachedRates(rates)
         self.rates = rates
-        self._load()
+        self.streaming = streaming
+        self.sort_buffer_size = sort_buffer_size
+        self.profiler = profiler
+        self.track_fees = track_fees
+        self.coalesce_fills = coalesce_fills
+        self.fee_totals: Dict[str, Decimal] = {}
+        if streaming is False:
+            self._load()
 
     @property
     def get_transactions(self):
         return self.transactions
 
-    def _format_transaction(self, transaction: dict, transaction_date: datetime) -> dict:
-        """ Converts numeric strings to decimal fields and format dates
+    def stream(self) -> Iterator[Transaction]:
+        """ Lazily yields formatted transactions in date order.
+        Out-of-order input is sorted with a bounded-memory external merge sort.
+        """
+        transactions = profile_iter(self.profiler, STAGE_SORT, self._sorted())
+        yield from profile_iter(self.profiler, STAGE_WRITE, self._write_formatted_transactions(transactions))
+
+    def _format_transaction(self, transaction: dict, transaction_date: datetime) -> Transaction:
+        """ Converts numeric strings to decimal fields and dates to timestamps
         """
         fee = self._rebase_fee(transaction, transaction_date)
-        return {
-            FIELD_RAW_ID: transaction[FIELD_RAW_ID],
-            FIELD_EXCHANGE: transaction[FIELD_EXCHANGE],
-            FIELD_DATE: transaction_date.strftime(DATE_INPUT_FORMAT),
-            FIELD_TZ: self.tax_timezone,
-            FIELD_TRANSACTION_TYPE: transaction[FIELD_TRANSACTION_TYPE],
-            FIELD_BASE_CURRENCY: self.tax_currency,
-            FIELD_ASSET_CODE: transaction[FIELD_ASSET_CODE],
-            FIELD_PRICE: Decimal(transaction[FIELD_PRICE]),
-            FIELD_QTY: Decimal(transaction[FIELD_QTY]),
-            FIELD_FEE_CURRENCY: self.tax_currency,
-            FIELD_FEE: fee,
-            FIELD_FEE_UNIT: round(fee / Decimal(transaction[FIELD_QTY]), 2) if Decimal(transaction[FIELD_QTY]) > 0 else Decimal(0),
-            FIELD_NOTE: transaction[FIELD_NOTE],
+        qty = Decimal(transaction[FIELD_QTY])
+        return Transaction(
+            id=transaction[FIELD_RAW_ID],
+            exchange=transaction[FIELD_EXCHANGE],
+            timestamp=to_timestamp(transaction_date),
+            tz=self.tax_timezone,
+            type=transaction[FIELD_TRANSACTION_TYPE],
+            base_currency=self.tax_currency,
+            asset_code=transaction[FIELD_ASSET_CODE],
+            price=Decimal(transaction[FIELD_PRICE]),
+            qty=qty,
+            fee_currency=self.tax_currency,
+            fee=fee,
+            fee_unit=round(fee / qty, 2) if qty > 0 else Decimal(0),
+            note=transaction[FIELD_NOTE],
+        )
+
+    def _load(self):
+        with profile_stage(self.profiler, STAGE_SORT):
+            transactions = self._sorted()
+
+        self.transactions = list(profile_iter(
+            self.profiler, STAGE_WRITE, self._write_formatted_transactions(transactions)
+        ))
+
+    def _sorted(self) -> Iterable[Transaction]:
+        """ All transactions in date order. A list, unless streaming
+        """
+        self.fee_totals = {}
+        in_memory = self.streaming is False
+
+        if len(self.input_paths) == 1:
+            return self._sort_file(self.input_paths[0], in_memory)
+
+        if self.workers > 1:
+            transactions = self._sort_files_in_parallel(in_memory)
+        else:
+            # heapq.merge favours earlier files on equal dates, like a stable sort of the concatenated files
+            transactions = heapq.merge(
+                *[self._sort_file(input_path, in_memory) for input_path in self.input_paths],
+                key=attrgetter('timestamp')
+            )
+        return list(transactions) if in_memory else transactions
+
+    def _sort_file(self, input_path: Path, in_memory: bool) -> Iterable[Transaction]:
+        if in_memory:
+            return sorted(self._read(input_path), key=attrgetter('timestamp'))
+        return external_sort(self._read(input_path), key=attrgetter('timestamp'), buffer_size=self.sort_buffer_size)
+
+    def _sort_files_in_parallel(self, in_memory: bool) -> Iterator[Transaction]:
+        """ Each file is sorted into a run file by a worker process (see _sort_input_file), and the run files are merged
+        """
+        settings = {
+            'tax_currency': self.tax_currency,
+            'tax_year_cutoff': self.tax_year_cutoff,
+            'tax_timezone': self.tax_timezone,
+            'rates': self.rates,
+            'sort_buffer_size': self.sort_buffer_size,
+            'track_fees': self.track_fees,
+            'coalesce_fills': self.coalesce_fills,
         }
 
-    def _load(self) -> List[dict]:
-        with open(self.input_path) as f:
-            reader = csv.DictReader(f)
-            transactions = []
+        with tempfile.TemporaryDirectory() as temp_dir:
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                futures = [
+                    executor.submit(_sort_input_file, settings, input_path, Path(temp_dir, f'{i}.run'),
+                                    in_memory, self.profiler is not None)
+                    for i, input_path in enumerate(self.input_paths)
+                ]
+                results = [future.result() for future in futures]
+
+            for _, fee_totals, counters in results:
+                for fee_currency, fee in fee_totals.items():
+                    self.fee_totals[fee_currency] = self.fee_totals.get(fee_currency, 0) + fee
+                for name, n in counters.items():
+                    self.profiler.count(name, n)
+
+            yield from heapq.merge(*[read_run_file(run_path) for run_path, _, _ in results], key=attrgetter('timestamp'))
+
+    def _read(self, input_path: Path) -> Iterator[Transaction]:
+        """ Yields the formatted transactions of input_path in file order
+        """
+        rebase_transaction = profile_function(self.profiler, STAGE_REBASE, self._rebase_transaction)
+        format_transaction = profile_function(self.profiler, STAGE_REBASE, self._format_transaction)
+
+        rows = self._dated_rows(input_path)
+        if self.coalesce_fills is True:
+            rows = merge_fills(rows)
+        if isinstance(self.rates, CachedRates):
+            rows = self._prefetch_rates(rows)
+
+        for i, transaction, transaction_date in rows:
+            try:
+                if self.tax_currency != transaction[FIELD_BASE_CURRENCY]:
+                    formatted_transactions = rebase_transaction(transaction, transaction_date)
+                    if self.profiler is not None:
+                        self.profiler.count(COUNTER_ROWS_REBASED)
+                else:
+                    formatted_transactions = [format_transaction(transaction, transaction_date)]
+            except Exception as e:
+                logger.error(f'There was an error on row { i + 1 } of {input_path}')
+                logger.error(transaction)
+                raise (e)
+
+            yield from formatted_transactions
+
+    def _dated_rows(self, input_path: Path) -> Iterator[Tuple[int, dict, datetime]]:
+        """ Yields (row index, standardized row, date in the tax timezone) of the rows of input_path
+        before the tax year cutoff
+        """
+        convert = profile_function(self.profiler, STAGE_CONVERT_TIMEZONE, convert_timezone)
+
+        with open(input_path) as f:
+            reader = profile_iter(self.profiler, STAGE_PARSE, csv.DictReader(f))
             for i, raw_transaction in enumerate(reader):
-                
+                if self.profiler is not None:
+                    self.profiler.count(COUNTER_ROWS_READ)
+
                 self._validate_transaction(raw_transaction)
                 transaction = self._standardize_transaction(raw_transaction)
+                if self.track_fees is True and raw_transaction[FIELD_FEE]:
+                    # Keyed by the raw fee currency, like analysis.balance.total_fees
+                    fee_currency = raw_transaction[FIELD_FEE_CURRENCY]
+                    self.fee_totals[fee_currency] = self.fee_totals.get(fee_currency, 0) + Decimal(raw_transaction[FIELD_FEE])
 
                 # Allow for zulu time, since it is a common export format
                 # If zulu time is detected, we drop the Z and override the tz to be UTC
                 uses_zulu_time = transaction[FIELD_DATE][-1].lower() == 'z'
 
-                transaction_date = convert_timezone(
+                transaction_date = convert(
                     date_str=transaction[FIELD_DATE][:-1] if uses_zulu_time is True else transaction[FIELD_DATE],
                     source_tz='UTC' if uses_zulu_time is True else transaction[FIELD_TZ],
                     dest_tz=self.tax_timezone
@@ -97,35 +336,38 @@ class TransactionLoader:
                     # Ignore transactions that have occurred after the tax year
                     continue
 
-                try:
-                    if self.tax_currency != transaction[FIELD_BASE_CURRENCY]:
-                        transactions.extend(
-                            self._rebase_transaction(transaction, transaction_date)
-                        )
-                    else:
-                        transactions.append(
-                            self._format_transaction(transaction, transaction_date)
-                        )
-                except Exception as e:
-                    logger.error(f'There was an error on row { i + 1 } of {self.input_path}')
-                    logger.error(transaction)
-                    raise (e)
-
-        self.transactions = sorted(transactions, key=itemgetter(FIELD_DATE))
-        self._write_formatted_transactions()
-
-    def _write_formatted_transactions(self):
+                yield i, transaction, transaction_date
+
+    def _prefetch_rates(self, rows: Iterator[Tuple[int, dict, datetime]]) -> Iterator[Tuple[int, dict, datetime]]:
+        """ Yields rows a batch at a time, once the rates the batch will look up have been fetched
+        """
+        while True:
+            batch = list(islice(rows, self.rates.batch_size))
+            if not batch:
+                return
+            self.rates.prefetch(
+                key for _, transaction, transaction_date in batch for key in self._rate_keys(transaction, transaction_date)
+            )
+            yield from batch
+
+    def _rate_keys(self, transaction: dict, transaction_date: datetime) -> List[RateKey]:
+        """ The (date, asset code) rates that _rebase_transaction and _rebase_fee look up for transaction
+        """
+        day = transaction_date.date()
+        keys = []
+        if self.tax_currency != transaction[FIELD_BASE_CURRENCY]:
+            keys.append((day, transaction[FIELD_BASE_CURRENCY]))
+        if transaction[FIELD_FEE] and transaction[FIELD_FEE] != '0' and self.tax_currency != transaction[FIELD_FEE_CURRENCY]:
+            keys.append((day, transaction[FIELD_FEE_CURRENCY]))
+        return keys
+
+    def _write_formatted_transactions(self, transactions: Iterator[Transaction]) -> Iterator[Transaction]:
         if self.output_path == '':
             raise ValueError(f'Cannot write formatted transactions, output_path missing')
-        
-        headers = list(self.transactions[0].keys())
-        with open(self.output_path, 'w') as file_handler:
-            writer = csv.DictWriter(file_handler, headers)
-            writer.writeheader()
-            for transaction in self.transactions:
-                writer.writerow(transaction)
-
-    def _rebase_transaction(self, transaction: dict, transaction_date: datetime) -> List[dict]:
+
+        return Writer.output_formatted_transactions(self.output_path, transactions)
+
+    def _rebase_transaction(self, transaction: dict, transaction_date: datetime) -> List[Transaction]:
         """ Splits a non-tax currency transaction into 2 transactions 
             denominated in the tax currency
         """
@@ -186,13 +428,16 @@ class TransactionLoader:
         if self.rates is None:
             raise InputValidationError(f'No exchange rates provided')
 
-        date_key = transaction_date.strftime(DATE_RATE_FORMAT)
-        if self.rates.get(date_key) is None or self.rates[date_key].get(asset_code) is None:
+        if self.profiler is not None:
+            self.profiler.count(COUNTER_RATE_LOOKUPS)
+
+        rate = self.rates.get_rate(transaction_date.date(), asset_code)
+        if rate is None:
             raise InputValidationError(
-                f'Conversion rate missing from rates file for {asset_code} on {date_key}'
+                f'Conversion rate missing from rates for {asset_code} on {transaction_date.strftime(DATE_RATE_FORMAT)}'
             )
 
-        return Decimal(self.rates[date_key][asset_code])
+        return rate
 
 
     def _validate_transaction(self, transaction: dict):
@@ -206,3 +451,14 @@ class TransactionLoader:
             FIELD_BASE_CURRENCY: transaction[FIELD_BASE_CURRENCY].lower(),
             FIELD_FEE_CURRENCY: transaction[FIELD_FEE_CURRENCY].lower(),
         }
+
+
+def _sort_input_file(settings: dict, input_path: Path, run_path: Path, in_memory: bool,
+                     count: bool) -> Tuple[Path, Dict[str, Decimal], Dict[str, int]]:
+    """ Reads, rebases and sorts input_path into run_path. Runs in a worker process.
+    Returns run_path, the file's fee totals and (if count is True) its profiler counters
+    """
+    profiler = Profiler(trace_memory=False) if count is True else None
+    loader = TransactionLoader(input_path, '', streaming=True, profiler=profiler, **settings)
+    write_run_file(loader._sort_file(input_path, in_memory), run_path)
+    return run_path, loader.fee_totals, {} if profiler is None else profiler.counters
@@ -1,49 +1,127 @@
 """ Outputs CG events to CSV, and outputs each CG event's corresponding cost base(s) to a separate CSV.
+CG events, cost bases and unallocated cost bases can also be written in the columnar format (see columnar.py),
+next to or instead of CSV, and to a SQLite result store (see ResultStore.py).
 """
 import csv
+import json
+from decimal import Decimal
 from pathlib import Path
-from typing import List
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence
 
 from capitalg.contstants import (
-    FIELD_BASE_CURRENCY,
-    FIELD_EXCHANGE,
-    FIELD_FEE,
+    DECIMAL_OUTPUT_FIELDS,
+    DEFAULT_WRITE_BUFFER_SIZE,
     FIELD_CAPITAL_GAIN_LT,
-    FIELD_CAPITAL_GAIN_ST,
     FIELD_CAPITAL_GAIN_TOTAL,
     FIELD_COST_BASE_AMOUNT,
     FIELD_COST_BASE_ID,
-    FIELD_ASSET_CODE,
-    FIELD_DATE,
-    FIELD_FEE_CURRENCY,
-    FIELD_FEE_UNIT,
-    FIELD_NOTE,
-    FIELD_PRICE,
-    FIELD_QTY,
-    FIELD_RAW_ID,
-    FIELD_SALE_AMOUNT,
-    FIELD_SALE_BROKERAGE,
-    FIELD_SALE_ID,
-    FIELD_TRANSACTION_TYPE,
-    FIELD_TZ,
     OUTPUT_FIELDS_CGT_EVENTS,
     OUTPUT_FIELDS_COST_BASE,
+    OUTPUT_FIELDS_FORMATTED_TRANSACTIONS,
     OUTPUT_FIELDS_UNALLOCATED_COST_BASE,
+    OUTPUT_FORMAT_BOTH,
+    OUTPUT_FORMAT_COLUMNAR,
+    OUTPUT_FORMAT_CSV,
+    OUTPUT_FORMATS,
 )
+from capitalg.columnar import TYPE_DECIMAL, TYPE_STR, ColumnarWriter, columnar_path
+from capitalg.CostBaseQueue import Lot
+from capitalg.ResultStore import (
+    TABLE_CG_EVENTS,
+    TABLE_COST_BASE,
+    TABLE_UNALLOCATED_COST_BASE,
+    ResultStore,
+    SqliteSink,
+)
+from capitalg.Transaction import Transaction
+
+
+class CsvSink:
+
+    def __init__(self, path: Path, fields: Sequence[str], append: bool = False):
+        self.handler = open(path, 'a' if append is True else 'w')
+        self.writer = csv.writer(self.handler)
+        if append is False:
+            self.writer.writerow(fields)
+
+    def write_rows(self, rows: Sequence[tuple]):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.handler.close()
+
+
+class ColumnarSink:
+    """ Writes to the columnar file next to path, a row group per call to write_rows
+    """
+
+    def __init__(self, path: Path, fields: Sequence[str], append: bool = False):
+        schema = [(field, TYPE_DECIMAL if field in DECIMAL_OUTPUT_FIELDS else TYPE_STR) for field in fields]
+        self.writer = ColumnarWriter(columnar_path(path), schema, append=append)
+
+    def write_rows(self, rows: Sequence[tuple]):
+        self.writer.write_rows(rows)
+
+    def close(self):
+        self.writer.close()
+
+
+def open_sinks(path: Path, fields: Sequence[str], output_format: str = OUTPUT_FORMAT_CSV, append: bool = False,
+               result_store: Optional[ResultStore] = None, table: Optional[str] = None) -> list:
+    """ If a result_store is given, rows are also written to its table
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f'Unknown output format {output_format}')
+
+    sinks = []
+    if output_format in (OUTPUT_FORMAT_CSV, OUTPUT_FORMAT_BOTH):
+        sinks.append(CsvSink(path, fields, append))
+    if output_format in (OUTPUT_FORMAT_COLUMNAR, OUTPUT_FORMAT_BOTH):
+        sinks.append(ColumnarSink(path, fields, append))
+    if result_store is not None:
+        sinks.append(SqliteSink(result_store, table, append))
+    return sinks
+
+
+def output_paths(path: Path, output_format: str = OUTPUT_FORMAT_CSV) -> List[Path]:
+    """ The files written for the output file path in output_format
+    """
+    paths = []
+    if output_format in (OUTPUT_FORMAT_CSV, OUTPUT_FORMAT_BOTH):
+        paths.append(Path(path))
+    if output_format in (OUTPUT_FORMAT_COLUMNAR, OUTPUT_FORMAT_BOTH):
+        paths.append(columnar_path(path))
+    return paths
 
 
 class Writer:
+    """ Rows are buffered as tuples, in OUTPUT_FIELDS_* order, and written to each sink
+    once buffer_size rows have been collected (and when the writer is cleaned up)
+    """
 
-    def __init__(self, cgt_events_path: str, cost_base_path: str):
-        self.cgt_events_handler = open(cgt_events_path, 'w')
-        self.cgt_events_writer = csv.DictWriter(self.cgt_events_handler, OUTPUT_FIELDS_CGT_EVENTS)
-        self.cgt_events_writer.writeheader()
+    def __init__(self, cgt_events_path: str, cost_base_path: str, append: bool = False,
+                 buffer_size: int = DEFAULT_WRITE_BUFFER_SIZE, output_format: str = OUTPUT_FORMAT_CSV,
+                 result_store: Optional[ResultStore] = None):
+        """ If append is True, rows are appended to existing output files (which already have headers)
+        output_format is one of OUTPUT_FORMATS. Columnar files are named after the CSV paths, see columnar.columnar_path
+        If a result_store is given, cg events and cost bases are also written to it
+        """
+        if buffer_size < 1:
+            raise ValueError(f'buffer_size must be at least 1, got {buffer_size}')
 
-        # Cost base handler is used as an audit trail
+        self.buffer_size = buffer_size
+
+        self.cgt_events_sinks = open_sinks(
+            cgt_events_path, OUTPUT_FIELDS_CGT_EVENTS, output_format, append, result_store, TABLE_CG_EVENTS
+        )
+        self.cgt_events_rows = []
+
+        # Cost base file is used as an audit trail
         # It provides a bridge between the cost base of cgt event, and the raw transactions
-        self.cost_base_handler = open(cost_base_path, 'w')
-        self.cost_base_writer = csv.DictWriter(self.cost_base_handler, OUTPUT_FIELDS_COST_BASE)
-        self.cost_base_writer.writeheader()
+        self.cost_base_sinks = open_sinks(
+            cost_base_path, OUTPUT_FIELDS_COST_BASE, output_format, append, result_store, TABLE_COST_BASE
+        )
+        self.cost_base_rows = []
 
     def __enter__(self):
         return self
@@ -51,54 +129,154 @@ class Writer:
     def __exit__(self, exc_type, exc_value, traceback):
         self.cleanup()
 
+    def flush(self):
+        _flush_rows(self.cgt_events_sinks, self.cgt_events_rows)
+        _flush_rows(self.cost_base_sinks, self.cost_base_rows)
+
     def cleanup(self):
-        self.cgt_events_handler.close()
-        self.cost_base_handler.close()
-
-    def write_cgt_event(self, cost_base: dict, sale: dict):
-        self.cgt_events_writer.writerow({
-            FIELD_DATE: sale[FIELD_DATE],
-            FIELD_SALE_ID: sale[FIELD_RAW_ID],
-            FIELD_EXCHANGE: sale[FIELD_EXCHANGE],
-            FIELD_COST_BASE_ID: cost_base[FIELD_COST_BASE_ID],
-            FIELD_ASSET_CODE: sale[FIELD_ASSET_CODE],
-            FIELD_QTY: sale[FIELD_QTY],
-            FIELD_PRICE: sale[FIELD_PRICE],
-            FIELD_SALE_AMOUNT: sale[FIELD_QTY] * sale[FIELD_PRICE],
-            FIELD_SALE_BROKERAGE: sale[FIELD_FEE],
-            FIELD_COST_BASE_AMOUNT: cost_base[FIELD_COST_BASE_AMOUNT],
-            FIELD_CAPITAL_GAIN_TOTAL: cost_base[FIELD_CAPITAL_GAIN_TOTAL],
-            FIELD_CAPITAL_GAIN_LT: cost_base[FIELD_CAPITAL_GAIN_LT],
-            FIELD_CAPITAL_GAIN_ST: cost_base[FIELD_CAPITAL_GAIN_TOTAL] - cost_base[FIELD_CAPITAL_GAIN_LT],
-            FIELD_NOTE:sale[FIELD_NOTE],
-        })
-
-    def write_cost_base_transactions(self, cost_base_id: str, cost_transactions: List[dict]):
-        for cost_transaction in cost_transactions:
-            self.cost_base_writer.writerow({
-                FIELD_COST_BASE_ID: cost_base_id,
-                **cost_transaction,
-            })
+        try:
+            self.flush()
+        finally:
+            _close_sinks(self.cgt_events_sinks + self.cost_base_sinks)
+
+    def write_cgt_event(self, cost_base: dict, sale: Transaction):
+        # OUTPUT_FIELDS_CGT_EVENTS order
+        self.cgt_events_rows.append((
+            sale.asset_code,
+            cost_base[FIELD_CAPITAL_GAIN_LT],
+            cost_base[FIELD_CAPITAL_GAIN_TOTAL] - cost_base[FIELD_CAPITAL_GAIN_LT],
+            cost_base[FIELD_CAPITAL_GAIN_TOTAL],
+            cost_base[FIELD_COST_BASE_AMOUNT],
+            cost_base[FIELD_COST_BASE_ID],
+            sale.date,
+            sale.exchange,
+            sale.note,
+            sale.price,
+            sale.qty,
+            sale.qty * sale.price,
+            sale.fee,
+            sale.id,
+        ))
+        if len(self.cgt_events_rows) >= self.buffer_size:
+            self.flush()
+
+    def write_cost_base_transactions(self, cost_base_id: str, cost_transactions: List[Lot]):
+        for lot in cost_transactions:
+            transaction = lot.transaction
+            # OUTPUT_FIELDS_COST_BASE order. Cost base rows have no amount
+            self.cost_base_rows.append((
+                '',
+                transaction.asset_code,
+                transaction.base_currency,
+                cost_base_id,
+                transaction.date,
+                transaction.exchange,
+                transaction.fee_unit,
+                transaction.fee,
+                transaction.fee_currency,
+                transaction.note,
+                transaction.price,
+                lot.qty,
+                transaction.id,
+                transaction.type,
+                transaction.tz,
+            ))
+        if len(self.cost_base_rows) >= self.buffer_size:
+            self.flush()
 
     @staticmethod
-    def output_unallocted_cost_base_transactions(output_file: Path, queues: dict):
-        with open(output_file, 'w') as f:
-            writer = csv.DictWriter(f, OUTPUT_FIELDS_UNALLOCATED_COST_BASE)
-            writer.writeheader()
+    def output_formatted_transactions(output_file: Path, transactions: Iterable[Transaction],
+                                      buffer_size: int = DEFAULT_WRITE_BUFFER_SIZE) -> Iterator[Transaction]:
+        """ Writes transactions to output_file as they are passed through
+        """
+        sinks = [CsvSink(output_file, OUTPUT_FIELDS_FORMATTED_TRANSACTIONS)]
+        rows = []
+        try:
+            for transaction in transactions:
+                # OUTPUT_FIELDS_FORMATTED_TRANSACTIONS order
+                rows.append((
+                    transaction.id,
+                    transaction.exchange,
+                    transaction.date,
+                    transaction.tz,
+                    transaction.type,
+                    transaction.base_currency,
+                    transaction.asset_code,
+                    transaction.price,
+                    transaction.qty,
+                    transaction.fee_currency,
+                    transaction.fee,
+                    transaction.fee_unit,
+                    transaction.note,
+                ))
+                if len(rows) >= buffer_size:
+                    _flush_rows(sinks, rows)
+                yield transaction
+            _flush_rows(sinks, rows)
+        finally:
+            _close_sinks(sinks)
 
+    @staticmethod
+    def output_unallocted_cost_base_transactions(output_file: Path, queues: dict,
+                                                 buffer_size: int = DEFAULT_WRITE_BUFFER_SIZE,
+                                                 output_format: str = OUTPUT_FORMAT_CSV,
+                                                 result_store: Optional[ResultStore] = None):
+        sinks = open_sinks(
+            output_file, OUTPUT_FIELDS_UNALLOCATED_COST_BASE, output_format,
+            result_store=result_store, table=TABLE_UNALLOCATED_COST_BASE
+        )
+        rows = []
+        try:
             for asset, queue in queues.items():
-                for transaction in queue.get_queue:
-                    writer.writerow({
-                        FIELD_RAW_ID: transaction[FIELD_RAW_ID],
-                        FIELD_EXCHANGE: transaction[FIELD_EXCHANGE],
-                        FIELD_DATE: transaction[FIELD_DATE],
-                        FIELD_TZ: transaction[FIELD_TZ],
-                        FIELD_TRANSACTION_TYPE: transaction[FIELD_TRANSACTION_TYPE],
-                        FIELD_BASE_CURRENCY: transaction[FIELD_BASE_CURRENCY],
-                        FIELD_ASSET_CODE: transaction[FIELD_ASSET_CODE],
-                        FIELD_QTY: transaction[FIELD_QTY],
-                        FIELD_PRICE: transaction[FIELD_PRICE],
-                        FIELD_FEE_CURRENCY: transaction[FIELD_FEE_CURRENCY],
-                        FIELD_FEE: transaction[FIELD_FEE],
-                        FIELD_NOTE: transaction[FIELD_NOTE],
-                    })
+                for lot in queue.get_queue:
+                    transaction = lot.transaction
+                    # OUTPUT_FIELDS_UNALLOCATED_COST_BASE order
+                    rows.append((
+                        transaction.id,
+                        transaction.exchange,
+                        transaction.date,
+                        transaction.tz,
+                        transaction.type,
+                        transaction.base_currency,
+                        transaction.asset_code,
+                        lot.qty,
+                        transaction.price,
+                        transaction.fee_currency,
+                        transaction.fee,
+                        transaction.note,
+                    ))
+                    if len(rows) >= buffer_size:
+                        _flush_rows(sinks, rows)
+
+            _flush_rows(sinks, rows)
+        finally:
+            _close_sinks(sinks)
+
+    @staticmethod
+    def output_balance(output_file: Path, queues: dict, fee_totals: Dict[str, Decimal]):
+        """ Writes the open qty of each asset (i.e. the total of its unallocated cost base) and fee_totals
+        (the total raw fees by fee currency) as JSON, so balances can be worked out without reading
+        the unallocated cost base or transactions files. Decimals are written as strings
+        """
+        unallocated = {}
+        for asset, queue in queues.items():
+            for lot in queue.get_queue:
+                unallocated[asset] = unallocated.get(asset, 0) + lot.qty
+
+        with open(output_file, 'w') as f:
+            json.dump({
+                'unallocated': {asset: str(qty) for asset, qty in unallocated.items()},
+                'fees': {fee_currency: str(fee) for fee_currency, fee in fee_totals.items()},
+            }, f, indent=2)
+
+
+def _flush_rows(sinks: list, rows: list):
+    if rows:
+        for sink in sinks:
+            sink.write_rows(rows)
+    rows.clear()
+
+
+def _close_sinks(sinks: list):
+    for sink in sinks:
+        sink.close()
@@ -1,3 +1,10 @@
-from capitalg.main import calculate_cg
+__all__ = ["calculate_cg"]
 
-__all__ = ["calculate_cg"]
\ No newline at end of file
+
+def __getattr__(name):
+    # calculate_cg is imported on first use, so importing a submodule (e.g. capitalg.commands)
+    # doesn't import the whole calculation
+    if name == 'calculate_cg':
+        from capitalg.main import calculate_cg
+        return calculate_cg
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
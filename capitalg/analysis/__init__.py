@@ -1,4 +1,16 @@
-from .balance import get_balance
-from .summary import cg_summary
+import importlib
 
-__ALL__ = ['cg_summary', 'get_balance']
+__ALL__ = ['cg_rollup', 'cg_summary', 'get_balance']
+
+# Exports are imported from their module on first use, so e.g. get_balance doesn't import the summary module
+_EXPORTS = {
+    'cg_rollup': 'summary',
+    'cg_summary': 'summary',
+    'get_balance': 'balance',
+}
+
+
+def __getattr__(name):
+    if name in _EXPORTS:
+        return getattr(importlib.import_module(f'.{_EXPORTS[name]}', __name__), name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
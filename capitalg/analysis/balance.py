@@ -1,20 +1,34 @@
 import csv
+import json
 from decimal import Decimal
 from pathlib import Path
+from typing import Tuple
 
 from ..contstants import (
     FIELD_ASSET_CODE,
     FIELD_FEE,
     FIELD_FEE_CURRENCY,
     FIELD_QTY,
+    FILE_BALANCE,
     FILE_DIR,
     FILE_TRANSACTIONS,
     FILE_UNALLOCATED_COST_BASE_TRANSACTION,
 )
+from ..columnar import COLUMNAR_SUFFIX, ColumnarReader
+from ..ResultStore import ResultStore, is_result_store
+
+BALANCE_SUFFIX = Path(FILE_BALANCE).suffix
 
 
 def total_unallocated_cost_base(cost_base_file: Path) -> dict:
+    """ cost_base_file can be a CSV or a columnar unallocated cost base file
+    """
     assets = {}
+    if Path(cost_base_file).suffix == COLUMNAR_SUFFIX:
+        for asset_code, qty in ColumnarReader(cost_base_file).read_columns([FIELD_ASSET_CODE, FIELD_QTY]):
+            assets[asset_code] = assets.get(asset_code, 0) + qty
+        return assets
+
     with open(cost_base_file) as f:
         reader = csv.DictReader(f)
         for _, row in enumerate(reader):
@@ -39,10 +53,34 @@ def total_fees(tax_currency: str, transactions_file_path: Path) -> dict:
     return assets
 
 
+def read_balance_file(balance_file: Path) -> Tuple[dict, dict]:
+    """ The unallocated qty by asset, and the total fees by fee currency, from a balance file (see Writer.output_balance)
+    """
+    with open(balance_file) as f:
+        balance = json.load(f)
+    return (
+        {asset: Decimal(qty) for asset, qty in balance['unallocated'].items()},
+        {fee_currency: Decimal(fee) for fee_currency, fee in balance['fees'].items()},
+    )
+
+
 def get_balance(tax_currency: str, transactions_file_path: Path,
                 cost_base_file: Path):
-    unallocated_cost_base = total_unallocated_cost_base(cost_base_file)
-    fees = total_fees(tax_currency, transactions_file_path)
+    """ cost_base_file can be a CSV or a columnar unallocated cost base file, a result store (see ResultStore)
+    or the balance file written by calculate_cg (FILE_BALANCE).
+    Result stores and balance files hold the fee totals of the transactions file they were calculated from,
+    so transactions_file_path is not read
+    """
+    if Path(cost_base_file).suffix == BALANCE_SUFFIX:
+        unallocated_cost_base, fees = read_balance_file(cost_base_file)
+        fees = {fee_currency: fee for fee_currency, fee in fees.items() if fee_currency != tax_currency}
+    elif is_result_store(cost_base_file):
+        with ResultStore(cost_base_file) as result_store:
+            unallocated_cost_base = result_store.unallocated_cost_base()
+            fees = result_store.fees(exclude_currency=tax_currency)
+    else:
+        unallocated_cost_base = total_unallocated_cost_base(cost_base_file)
+        fees = total_fees(tax_currency, transactions_file_path)
     # NOTE this does not factor it withdrawal fees.
     #   To include, add each withdrawal as a separate sell transaction for price=0
     #   These will automatically draw from the cost base
@@ -1,6 +1,8 @@
 import csv
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 from decimal import Decimal
+from pathlib import Path
+from typing import Dict, Iterator, Sequence, Tuple
 
 from capitalg.contstants import (
     DATE_INPUT_FORMAT,
@@ -8,35 +10,76 @@ from capitalg.contstants import (
     FIELD_CAPITAL_GAIN_LT,
     FIELD_CAPITAL_GAIN_ST,
     FIELD_CAPITAL_GAIN_TOTAL,
+    FIELD_DATE,
+    PERIOD_MONTH,
+    PERIOD_QUARTER,
+    PERIOD_TAX_YEAR,
+    PERIODS,
     TAX_YEAR_INPUT_FORMAT,
 )
+from capitalg.columnar import COLUMNAR_SUFFIX, ColumnarReader
+from capitalg.ResultStore import TABLE_CG_EVENTS, ResultStore, is_result_store
+
+SUMMARY_FIELDS = [FIELD_DATE, FIELD_ASSET_CODE, FIELD_CAPITAL_GAIN_ST, FIELD_CAPITAL_GAIN_LT, FIELD_CAPITAL_GAIN_TOTAL]
+
+FIELD_PERIOD_TYPE = 'period_type'
+FIELD_PERIOD = 'period'
+ROLLUP_FIELDS = [FIELD_PERIOD_TYPE, FIELD_PERIOD, FIELD_ASSET_CODE,
+                 FIELD_CAPITAL_GAIN_ST, FIELD_CAPITAL_GAIN_LT, FIELD_CAPITAL_GAIN_TOTAL]
+
+
+def read_cg_events(cg_events_path: str) -> Iterator[tuple]:
+    """ Yields the SUMMARY_FIELDS of every cg event, from either a CSV or a columnar (see columnar.py) cg events file,
+    or a result store (see ResultStore). Capital gains are Decimal in columnar files, and str otherwise
+    """
+    if is_result_store(cg_events_path):
+        with ResultStore(cg_events_path) as result_store:
+            yield from result_store.read_rows(TABLE_CG_EVENTS, SUMMARY_FIELDS)
+        return
+
+    if Path(cg_events_path).suffix == COLUMNAR_SUFFIX:
+        yield from ColumnarReader(cg_events_path).read_columns(SUMMARY_FIELDS)
+        return
+
+    with open(cg_events_path, 'r') as f:
+        reader = csv.DictReader(f)
+        for _, row in enumerate(reader):
+            yield tuple(row[field] for field in SUMMARY_FIELDS)
 
 
 def cg_summary(cg_events_path: str, tax_year_end: str) -> dict:
+    """ cg_events_path can be a CSV or a columnar cg events file, or a result store (see ResultStore),
+    which sums capital gains with an indexed query instead of reading every cg event
+    """
 
     tax_year_cutoff_obj = datetime.strptime(tax_year_end, TAX_YEAR_INPUT_FORMAT) + timedelta(days=1)
     tax_year_start_obj = datetime(year=tax_year_cutoff_obj.year - 1, month=tax_year_cutoff_obj.month, day=tax_year_cutoff_obj.day)
 
+    # Dates are fixed width, so they can be compared as strings without parsing each row
+    tax_year_cutoff = tax_year_cutoff_obj.strftime(DATE_INPUT_FORMAT)
+    tax_year_start = tax_year_start_obj.strftime(DATE_INPUT_FORMAT)
+
     cg_template = {
         FIELD_CAPITAL_GAIN_TOTAL: 0,
         FIELD_CAPITAL_GAIN_LT: 0,
         FIELD_CAPITAL_GAIN_ST: 0,
     }
 
-    assets = {}
-    with open(cg_events_path, 'r') as f:
-        reader = csv.DictReader(f)
-        for _, row in enumerate(reader):
-            cg_date = datetime.strptime(row['date'], DATE_INPUT_FORMAT)
-            if cg_date < tax_year_start_obj or cg_date >= tax_year_cutoff_obj:
+    if is_result_store(cg_events_path):
+        with ResultStore(cg_events_path) as result_store:
+            assets = result_store.cg_summary(tax_year_start, tax_year_cutoff)
+    else:
+        assets = {}
+        for cg_date, asset_code, cg_st, cg_lt, cg_total in read_cg_events(cg_events_path):
+            if cg_date < tax_year_start or cg_date >= tax_year_cutoff:
                 continue
 
-            if row[FIELD_ASSET_CODE] not in assets:
-                assets[row[FIELD_ASSET_CODE]] = cg_template.copy()
+            if asset_code not in assets:
+                assets[asset_code] = cg_template.copy()
 
-            assets[row[FIELD_ASSET_CODE]][FIELD_CAPITAL_GAIN_ST] += Decimal(row[FIELD_CAPITAL_GAIN_ST])
-            assets[row[FIELD_ASSET_CODE]][FIELD_CAPITAL_GAIN_LT] += Decimal(row[FIELD_CAPITAL_GAIN_LT])
-            assets[row[FIELD_ASSET_CODE]][FIELD_CAPITAL_GAIN_TOTAL] += Decimal(row[FIELD_CAPITAL_GAIN_TOTAL])
+            assets[asset_code][FIELD_CAPITAL_GAIN_ST] += Decimal(cg_st)
+            assets[asset_code][FIELD_CAPITAL_GAIN_LT] += Decimal(cg_lt)
+            assets[asset_code][FIELD_CAPITAL_GAIN_TOTAL] += Decimal(cg_total)
 
     total = cg_template.copy()
     for asset, cg in assets.items():
@@ -46,3 +89,94 @@ def cg_summary(cg_events_path: str, tax_year_end: str) -> dict:
 
     assets.update(total=total)
     return assets
+
+
+def parse_tax_year_end(tax_year_end: str) -> Tuple[int, int]:
+    """ (month, day) of the last day of every tax year, from MM-DD or YYYY-MM-DD (the year is ignored)
+    """
+    month_day = tax_year_end[-5:]
+    # A non leap year, so every tax year has the same end
+    parsed = datetime.strptime(f'2001-{month_day}', TAX_YEAR_INPUT_FORMAT)
+    return parsed.month, parsed.day
+
+
+def get_periods(day: date, tax_year_end: Tuple[int, int]) -> Dict[str, str]:
+    """ The tax year, quarter and month day falls in, by PERIODS.
+    Tax years are named after the year they end in, and quarters are quarters of the tax year (e.g. 2021-Q1)
+    """
+    end_year = day.year if (day.month, day.day) <= tax_year_end else day.year + 1
+    start = date(end_year - 1, *tax_year_end) + timedelta(days=1)
+    months = (day.year - start.year) * 12 + day.month - start.month - (1 if day.day < start.day else 0)
+    return {
+        PERIOD_TAX_YEAR: str(end_year),
+        PERIOD_QUARTER: f'{end_year}-Q{months // 3 + 1}',
+        PERIOD_MONTH: day.strftime('%Y-%m'),
+    }
+
+
+def cg_rollup(cg_events_path: str, tax_year_end: str, periods: Sequence[str] = PERIODS) -> dict:
+    """ Capital gains by asset for every period of each of periods (see PERIODS), in a single pass over cg_events_path.
+    tax_year_end is the last day of every tax year, as MM-DD or YYYY-MM-DD.
+
+    Returns {period type: {period: {asset: gains, ..., 'total': gains}}}, with periods in date order,
+    where gains are in the same format as cg_summary
+    cg_events_path can be a CSV or a columnar cg events file, or a result store (see ResultStore)
+    """
+    for period in periods:
+        if period not in PERIODS:
+            raise ValueError(f'Unknown period {period}')
+    tax_year_end = parse_tax_year_end(tax_year_end)
+
+    cg_template = {
+        FIELD_CAPITAL_GAIN_TOTAL: 0,
+        FIELD_CAPITAL_GAIN_LT: 0,
+        FIELD_CAPITAL_GAIN_ST: 0,
+    }
+
+    # Gains are totalled by day first, so each period only has to add up days
+    days = {}
+    for cg_date, asset_code, cg_st, cg_lt, cg_total in read_cg_events(cg_events_path):
+        key = (cg_date[:10], asset_code)
+        if key not in days:
+            days[key] = [Decimal(cg_st), Decimal(cg_lt), Decimal(cg_total)]
+        else:
+            gains = days[key]
+            gains[0] += Decimal(cg_st)
+            gains[1] += Decimal(cg_lt)
+            gains[2] += Decimal(cg_total)
+
+    rollup = {period: {} for period in periods}
+    period_cache = {}
+    for (day, asset_code), (cg_st, cg_lt, cg_total) in days.items():
+        if day not in period_cache:
+            period_cache[day] = get_periods(date.fromisoformat(day), tax_year_end)
+
+        for period in periods:
+            assets = rollup[period].setdefault(period_cache[day][period], {})
+            if asset_code not in assets:
+                assets[asset_code] = cg_template.copy()
+            assets[asset_code][FIELD_CAPITAL_GAIN_ST] += cg_st
+            assets[asset_code][FIELD_CAPITAL_GAIN_LT] += cg_lt
+            assets[asset_code][FIELD_CAPITAL_GAIN_TOTAL] += cg_total
+
+    for period in periods:
+        rollup[period] = {name: rollup[period][name] for name in sorted(rollup[period])}
+        for assets in rollup[period].values():
+            total = cg_template.copy()
+            for cg in assets.values():
+                total[FIELD_CAPITAL_GAIN_ST] += cg[FIELD_CAPITAL_GAIN_ST]
+                total[FIELD_CAPITAL_GAIN_LT] += cg[FIELD_CAPITAL_GAIN_LT]
+                total[FIELD_CAPITAL_GAIN_TOTAL] += cg[FIELD_CAPITAL_GAIN_TOTAL]
+            assets.update(total=total)
+    return rollup
+
+
+def rollup_rows(rollup: dict) -> Iterator[tuple]:
+    """ Flattens a cg_rollup into ROLLUP_FIELDS tuples
+    """
+    for period_type, periods in rollup.items():
+        for period, assets in periods.items():
+            for asset_code, gains in assets.items():
+                yield (period_type, period, asset_code, gains[FIELD_CAPITAL_GAIN_ST],
+                       gains[FIELD_CAPITAL_GAIN_LT], gains[FIELD_CAPITAL_GAIN_TOTAL])
+
@@ -1,28 +1,59 @@
 import uuid
-from datetime import datetime
 from decimal import Decimal
-from typing import Dict, List
+from typing import Callable, Dict, List, Optional
 
 from capitalg.contstants import (
-    DATE_INPUT_FORMAT,
     FIELD_CAPITAL_GAIN_LT,
     FIELD_CAPITAL_GAIN_TOTAL,
     FIELD_COST_BASE_AMOUNT,
     FIELD_COST_BASE_ID,
-    FIELD_DATE,
-    FIELD_FEE_UNIT,
-    FIELD_FEE,
-    FIELD_PRICE,
     FIELD_QTY,
 )
+from capitalg.CostBaseQueue import Lot
+from capitalg.Transaction import Transaction
 from capitalg.Writer import Writer
 
+# An asset held for at least this many seconds (of wall clock time) is held long term
+LONG_TERM_SECONDS = 365 * 24 * 60 * 60
 
-def register_cg_event(writer: Writer, sale: dict, costs: List[dict]):
+# Namespace of deterministic cost base ids, see SequentialCostBaseIds
+COST_BASE_ID_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, 'https://github.com/dleber/capitalg/cost_base_id')
+
+
+class SequentialCostBaseIds:
+    """ Makes deterministic cost base ids, a UUID (version 5) of the number of ids made so far.
+    Since cg events are always written in date order, the same transactions always get the same ids.
+    start continues an earlier sequence (e.g. one restored from a snapshot)
+    """
+
+    def __init__(self, start: int = 0):
+        self.count = start
+
+    def __call__(self) -> str:
+        cost_base_id = str(uuid.uuid5(COST_BASE_ID_NAMESPACE, str(self.count)))
+        self.count += 1
+        return cost_base_id
+
+
+def register_cg_event(writer: Writer, sale: Transaction, costs: List[Lot]):
+    cost_base = calculate_cg_event(sale, costs)
+    write_cg_event(writer, sale, costs, cost_base)
+
+
+def calculate_cg_event(sale: Transaction, costs: List[Lot]) -> Dict[str, Decimal]:
+    """ Calculates and validates the cost base of a sale.
+    Does not write anything, so it can run away from the Writer (e.g. in a worker process)
+    """
     cost_base = calculate_cg_transaction(sale, costs)
-    validate_cgt_qty(sale['qty'], cost_base['qty'], sale, costs)
+    validate_cgt_qty(sale.qty, cost_base[FIELD_QTY], sale, costs)
+    return cost_base
 
-    cost_base_id = make_cost_base_id()
+
+def write_cg_event(writer: Writer, sale: Transaction, costs: List[Lot], cost_base: Dict[str, Decimal],
+                   make_id: Optional[Callable[[], str]] = None):
+    """ make_id makes the cost base id, e.g. a SequentialCostBaseIds. Defaults to make_cost_base_id (random ids)
+    """
+    cost_base_id = make_cost_base_id() if make_id is None else make_id()
     writer.write_cost_base_transactions(cost_base_id, costs)
     writer.write_cgt_event(
         cost_base={
@@ -33,14 +64,10 @@ def register_cg_event(writer: Writer, sale: dict, costs: List[dict]):
     )
 
 
-def calculate_cg_transaction(sale: dict, costs: List[dict]) -> Dict[str, Decimal]:
-    """ Reduce list of purchase transactions to a total qty and purchase amount
+def calculate_cg_transaction(sale: Transaction, costs: List[Lot]) -> Dict[str, Decimal]:
+    """ Reduce list of purchase lots to a total qty and purchase amount
     Brokerage is portioned based on qty.
     Brokerage is always included. If you don't want brokerage, 0 it out before calling this method
-
-    sale_date must be in format YYYY-MM-DDTHH:MM:SS
-    cost_transactions must contain keys FIELD_DATE in format YYYY-MM-DDTHH:MM:SS
-
     """
     qty = 0
     cost_base_amount = 0
@@ -48,30 +75,30 @@ def calculate_cg_transaction(sale: dict, costs: List[dict]) -> Dict[str, Decimal
 
     for cost in costs:
         transaction_cost_base = calculate_cost_amount(cost)
-        proceeds_from_qty = cost[FIELD_QTY] * (sale[FIELD_PRICE] - sale[FIELD_FEE_UNIT])
+        proceeds_from_qty = cost.qty * (sale.price - sale.fee_unit)
         transaction_cap_gain = proceeds_from_qty - transaction_cost_base
-        qty += cost[FIELD_QTY]
+        qty += cost.qty
         cost_base_amount += transaction_cost_base
 
-        if is_long_term(sale[FIELD_DATE], cost[FIELD_DATE]) == True:
+        if is_long_term(sale.timestamp, cost.timestamp) == True:
             cap_gain_lt += transaction_cap_gain
 
-    total_cost_base_amount = cost_base_amount + sale[FIELD_FEE]
+    total_cost_base_amount = cost_base_amount + sale.fee
 
     return {
         FIELD_QTY: qty,
         FIELD_COST_BASE_AMOUNT: total_cost_base_amount,
-        FIELD_CAPITAL_GAIN_TOTAL: qty * sale[FIELD_PRICE] - total_cost_base_amount,
+        FIELD_CAPITAL_GAIN_TOTAL: qty * sale.price - total_cost_base_amount,
         FIELD_CAPITAL_GAIN_LT: cap_gain_lt,
     }
 
 
-def calculate_cost_amount(transaction: dict) -> Decimal:
-    return transaction[FIELD_QTY] * (transaction[FIELD_PRICE] + transaction[FIELD_FEE_UNIT])
+def calculate_cost_amount(lot: Lot) -> Decimal:
+    return lot.qty * (lot.price + lot.fee_unit)
 
 
 def validate_cgt_qty(sell_qty: Decimal, cost_qty: Decimal,
-                     sell_transaction: dict, cost_transactions: List[dict]):
+                     sell_transaction: Transaction, cost_transactions: List[Lot]):
     if sell_qty > cost_qty:
         raise Exception(
             f'qty sold exceeds qty purchased. You may be missing cost transactions. Sell transaction: {sell_transaction}, cost transactions" {cost_transactions}'
@@ -87,9 +114,7 @@ def make_cost_base_id() -> str:
     return str(uuid.uuid4())
 
 
-def is_long_term(sale_date_raw: str,
-                 cost_date_raw: str,
-                 date_format: str = DATE_INPUT_FORMAT) -> bool:
-    sale_date = datetime.strptime(sale_date_raw, date_format)
-    cost_date = datetime.strptime(cost_date_raw, date_format)
-    return (sale_date - cost_date).days >= 365
+def is_long_term(sale_timestamp: int, cost_timestamp: int) -> bool:
+    """ Timestamps as per utils.to_timestamp
+    """
+    return sale_timestamp - cost_timestamp >= LONG_TERM_SECONDS
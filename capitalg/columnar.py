@@ -0,0 +1,198 @@
+""" A simple columnar file format for output files, which can be read back one column at a time.
+
+A file is a sequence of row groups, followed by a JSON footer:
+
+    MAGIC | row group | row group | ... | footer | footer length (8 bytes, little endian) | MAGIC
+
+Each row group holds one zlib compressed chunk per column. A chunk holds the length of every value
+(in characters, as little endian uint32s) followed by the values, as one UTF-8 string.
+The footer holds the schema, i.e. the name and type of each column, and the offset and length of every chunk,
+so readers only read the chunks of the columns they need.
+
+Decimal columns are stored as the exact str() of each Decimal, and read back as Decimals.
+"""
+import json
+import struct
+import sys
+import zlib
+from array import array
+from decimal import Decimal
+from itertools import accumulate
+from pathlib import Path
+from typing import Iterator, List, Sequence, Tuple
+
+from capitalg.utils import latest_file
+
+COLUMNAR_SUFFIX = '.cgcol'
+
+MAGIC = b'CGCOL1\0\0'
+FOOTER_LENGTH = struct.Struct('<Q')
+FORMAT_VERSION = 1
+
+TYPE_STR = 'str'
+TYPE_DECIMAL = 'decimal'
+COLUMN_TYPES = {
+    TYPE_STR: str,
+    TYPE_DECIMAL: Decimal,
+}
+
+
+def columnar_path(path: Path) -> Path:
+    """ The columnar file written alongside (or instead of) a CSV output file
+    """
+    return Path(path).with_suffix(COLUMNAR_SUFFIX)
+
+
+def latest_output(csv_path: Path) -> Path:
+    """ The columnar version of csv_path if it is at least as recent as csv_path (or there is no csv_path), otherwise csv_path
+    """
+    csv_path = Path(csv_path)
+    return latest_file([csv_path, columnar_path(csv_path)]) or csv_path
+
+
+class ColumnarWriter:
+    """ Writes rows (tuples in schema order) to a columnar file, a row group per call to write_rows.
+    If append is True, row groups are added to an existing file with the same schema.
+    """
+
+    def __init__(self, path: Path, schema: Sequence[Tuple[str, str]], append: bool = False):
+        for name, column_type in schema:
+            if column_type not in COLUMN_TYPES:
+                raise ValueError(f'Unknown type {column_type} for column {name}')
+
+        self.schema = [list(column) for column in schema]
+        self.row_groups = []
+
+        if append is True and Path(path).exists():
+            footer, data_end = _read_footer(path)
+            if footer['columns'] != self.schema:
+                raise ValueError(f'Cannot append to {path}, it has different columns')
+            self.row_groups = footer['row_groups']
+            self.handler = open(path, 'r+b')
+            self.handler.truncate(data_end)
+            self.handler.seek(data_end)
+        else:
+            self.handler = open(path, 'wb')
+            self.handler.write(MAGIC)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write_rows(self, rows: Sequence[tuple]):
+        if not rows:
+            return
+
+        chunks = []
+        for values in zip(*rows):
+            values = ['' if value is None else str(value) for value in values]
+            lengths = array('I', map(len, values))
+            if lengths.itemsize != 4:
+                raise RuntimeError('uint32 arrays are not 4 bytes on this platform')
+            chunk = zlib.compress(_to_little_endian(lengths).tobytes() + ''.join(values).encode(), 1)
+
+            chunks.append([self.handler.tell(), len(chunk)])
+            self.handler.write(chunk)
+
+        self.row_groups.append({'rows': len(rows), 'columns': chunks})
+
+    def close(self):
+        footer = json.dumps({
+            'version': FORMAT_VERSION,
+            'columns': self.schema,
+            'row_groups': self.row_groups,
+        }).encode()
+        self.handler.write(footer)
+        self.handler.write(FOOTER_LENGTH.pack(len(footer)))
+        self.handler.write(MAGIC)
+        self.handler.close()
+
+
+class ColumnarReader:
+
+    def __init__(self, path: Path):
+        self.path = path
+        footer, _ = _read_footer(path)
+        self.schema = [tuple(column) for column in footer['columns']]
+        self.row_groups = footer['row_groups']
+
+    @property
+    def columns(self) -> List[str]:
+        return [name for name, _ in self.schema]
+
+    @property
+    def num_rows(self) -> int:
+        return sum(row_group['rows'] for row_group in self.row_groups)
+
+    def read_columns(self, names: Sequence[str]) -> Iterator[tuple]:
+        """ Yields a tuple of the values of the named columns for every row.
+        Only the chunks of the named columns are read
+        """
+        indexes = []
+        for name in names:
+            if name not in self.columns:
+                raise KeyError(f'{self.path} has no column {name}')
+            indexes.append(self.columns.index(name))
+
+        with open(self.path, 'rb') as f:
+            for row_group in self.row_groups:
+                columns = []
+                for index in indexes:
+                    offset, length = row_group['columns'][index]
+                    f.seek(offset)
+                    column_type = COLUMN_TYPES[self.schema[index][1]]
+                    columns.append(_decode_chunk(f.read(length), row_group['rows'], column_type))
+                yield from zip(*columns)
+
+    def read_column(self, name: str) -> Iterator:
+        for values in self.read_columns([name]):
+            yield values[0]
+
+
+def _decode_chunk(chunk: bytes, rows: int, column_type: type) -> list:
+    data = zlib.decompress(chunk)
+    lengths = array('I')
+    lengths.frombytes(data[:4 * rows])
+    text = data[4 * rows:].decode()
+
+    ends = accumulate(_to_little_endian(lengths))
+    start = 0
+    values = []
+    for end in ends:
+        values.append(text[start:end])
+        start = end
+
+    return values if column_type is str else [column_type(value) for value in values]
+
+
+def _read_footer(path: Path) -> Tuple[dict, int]:
+    """ Returns the footer, and the offset at which it starts (i.e. the end of the row groups)
+    """
+    with open(path, 'rb') as f:
+        f.seek(0, 2)
+        size = f.tell()
+        tail_size = FOOTER_LENGTH.size + len(MAGIC)
+        if size < len(MAGIC) + tail_size:
+            raise ValueError(f'{path} is not a columnar file')
+
+        f.seek(size - tail_size)
+        footer_length, = FOOTER_LENGTH.unpack(f.read(FOOTER_LENGTH.size))
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a columnar file, or was not closed')
+
+        footer_start = size - tail_size - footer_length
+        f.seek(footer_start)
+        footer = json.loads(f.read(footer_length))
+
+    if footer.get('version') != FORMAT_VERSION:
+        raise ValueError(f'{path} has unsupported version {footer.get("version")}')
+    return footer, footer_start
+
+
+def _to_little_endian(values: array) -> array:
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values
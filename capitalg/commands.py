@@ -1,11 +1,15 @@
 import argparse
+import csv
+import sys
+from contextlib import nullcontext
 from pathlib import Path
 
-from capitalg.main import calculate_cg
-from capitalg.contstants import FILE_DIR, FILE_CG_EVENTS, FILE_UNALLOCATED_COST_BASE_TRANSACTION, FILE_TRANSACTIONS
-from capitalg.analysis.balance import get_balance
-from capitalg.analysis.summary import cg_summary
-from capitalg.contstants import FILE_DIR
+from capitalg.contstants import DEFAULT_SORT_BUFFER_SIZE, FILE_BALANCE, FILE_DIR, FILE_CG_EVENTS, FILE_RESULTS_DB, FILE_UNALLOCATED_COST_BASE_TRANSACTION, FILE_TRANSACTIONS, OUTPUT_FORMAT_CSV, OUTPUT_FORMATS, PERIODS
+from capitalg.utils import latest_file
+
+# Each subcommand imports what it needs when it runs, so e.g. summary and balance don't import
+# the calculation (and pytz). The CLI is often called many times from scripts, where import time adds up.
+# See benchmarks/bench_startup.py
 
 def main():
     parser = argparse.ArgumentParser(prog='capitalg')
@@ -13,17 +17,39 @@ def main():
 
     cg_parser = subparsers.add_parser('calculate', prog='capitalg calculate', description='Calculate captial gains from transactions.csv and rates.csv files')
     cg_parser.add_argument('-t', '--timezone', default='UTC', type=str, required=False, help='Tax reporting timezone. Valid timezones: https://gist.github.com/heyalexej/8bf688fd67d7199be4a1682b3eec7568')
-    cg_parser.add_argument('-q', '--queue_type', choices=['fifo', 'lifo'], help='CG accounting method', required=True, type=str)
+    cg_parser.add_argument('-q', '--queue_type', choices=['fifo', 'lifo', 'hifo', 'lofo'], help='CG accounting method: first in, last in, highest cost or lowest cost first out', required=True, type=str)
     cg_parser.add_argument('-c', '--tax_currency', help='Currency in which tax is to be paid', required=True, type=str.lower)
     cg_parser.add_argument('-d', '--tax_year_end', help='The last day of the tax year, in YYYY-MM-DD format. Use the latest available compplete tax year. Capital gains will be calculated for all prior years as well', required=True, type=str)
     cg_parser.add_argument('-p', '--folder_path', help='Path to folder containing input and output files', default=FILE_DIR, type=str)
-    cg_parser.set_defaults(func=cg)
+    cg_parser.add_argument('-s', '--streaming', action='store_true', help='Stream transactions through the calculation instead of loading them all into memory. Recommended for very large transaction files')
+    cg_parser.add_argument('--sort_buffer_size', default=DEFAULT_SORT_BUFFER_SIZE, type=int, help=f'Max number of transactions held in memory while sorting in streaming mode (defaults to {DEFAULT_SORT_BUFFER_SIZE})')
+    cg_parser.add_argument('-w', '--workers', default=1, type=int, help='Number of worker processes used to match assets in parallel (defaults to 1)')
+    cg_parser.add_argument('--incremental', action='store_true', help='Save a snapshot of the calculation at the tax year end, and resume from a previous snapshot if the earlier transactions have not changed')
+    cg_parser.add_argument('--profile', nargs='?', const='-', default=None, type=str, metavar='PATH', help='Report the time and peak memory of each stage, and row/lot counters, as JSON. Written to PATH if given, otherwise stderr')
+    cg_parser.add_argument('-f', '--output_format', choices=OUTPUT_FORMATS, default=OUTPUT_FORMAT_CSV, type=str, help='Write cg events, cost base and unallocated cost base files as csv, columnar (.cgcol) files, or both (defaults to csv)')
+    cg_parser.add_argument('--sqlite', action='store_true', help=f'Also write the results to {FILE_RESULTS_DB}, an indexed SQLite database that summary and balance query instead of scanning the output files')
+    cg_parser.add_argument('--deterministic_ids', action='store_true', help='Number cost base ids in date order instead of making random ids, so the same transactions always produce identical output files')
+    cg_parser.add_argument('-i', '--input', nargs='+', type=str, help=f'Transactions files or glob patterns to read, e.g. one export per exchange (defaults to {FILE_TRANSACTIONS} in the folder path). Each file is sorted separately and the files are merged. With -w, files are read in parallel')
+    cg_parser.add_argument('--pipelined', action='store_true', help='Read transactions, match lots and write the results concurrently, in threads connected by bounded queues. Transactions are streamed, as with -s')
+    cg_parser.add_argument('--lot_buffer_size', type=int, metavar='LOTS', help='Max number of open lots held in memory per asset. The rest are spilled to a temporary file and read back as they are sold. FIFO and LIFO only, with one worker')
+    cg_parser.add_argument('--coalesce_fills', action='store_true', help='Merge fills of the same order, i.e. consecutive rows of an input file with the same date, asset, base currency, type, price, exchange and fee currency, into one transaction before matching. Merged transactions keep the ids of their fills')
+    rates_group = cg_parser.add_mutually_exclusive_group()
+    rates_group.add_argument('--rates_db', type=str, metavar='PATH', help='Fetch rates from a SQLite database with a rates table of (date, asset_code, rate) rows instead of reading rates.csv. Only the rates the transactions need are fetched')
+    rates_group.add_argument('--rates_url', type=str, metavar='URL', help='Fetch rates from an HTTP rates service instead of reading rates.csv, e.g. python -m capitalg.rate_providers rates.csv. Only the rates the transactions need are fetched')
+    cg_parser.set_defaults(func=cg, parser=cg_parser)
 
     sumamry_subparser = subparsers.add_parser('summary', prog='capitalg summary', description='Print a summary of capital gains for a given tax year. "capitalg calculate" must be run beforehand')
     sumamry_subparser.add_argument('-d', '--tax_year_end', help='The last day of the tax year, in YYYY-MM-DD format', required=True, type=str)
     sumamry_subparser.add_argument('-p', '--folder_path', help='Path to folder containing output files', default=FILE_DIR, type=str)
     sumamry_subparser.set_defaults(func=summary)
 
+    rollup_subparser = subparsers.add_parser('rollup', prog='capitalg rollup', description='Print capital gains by asset for every tax year, quarter and month as CSV, in a single pass over the cg events. "capitalg calculate" must be run beforehand')
+    rollup_subparser.add_argument('-d', '--tax_year_end', help='The last day of every tax year, in MM-DD (or YYYY-MM-DD) format', required=True, type=str)
+    rollup_subparser.add_argument('-p', '--folder_path', help='Path to folder containing output files', default=FILE_DIR, type=str)
+    rollup_subparser.add_argument('--periods', nargs='+', choices=PERIODS, default=PERIODS, help='Periods to total capital gains by (defaults to all)')
+    rollup_subparser.add_argument('-o', '--output', type=str, help='Write the rollup to this CSV file instead of printing it')
+    rollup_subparser.set_defaults(func=rollup)
+
     balance_subparser = subparsers.add_parser('balance', prog='capitalg balance', description='Print an approximate asset balance. "capitalg calculate" must be run beforehand. The balance will be as at the tax_year_end used in the calculate command.')
     balance_subparser.add_argument('-c', '--tax_currency', help='Currency in which tax is to be paid', required=True, type=str.lower)
     balance_subparser.add_argument('-p', '--folder_path', help='Path to folder containing output files', default=FILE_DIR, type=str)
@@ -34,23 +60,83 @@ def main():
 
 
 def cg(args):
+    from capitalg.main import calculate_cg
+    from capitalg.Profiler import Profiler
+    from capitalg.rate_providers import HttpRateProvider, SqliteRateProvider
+
+    if args.pipelined and args.profile is not None:
+        args.parser.error('--pipelined calculations can not be profiled')
+    if args.lot_buffer_size is not None and (args.workers > 1 or args.queue_type not in ('fifo', 'lifo')):
+        args.parser.error('--lot_buffer_size can only be used with fifo and lifo queues, with one worker')
+
     print('Calcualting capital gains...')
-    calculate_cg(Path(args.folder_path), args.tax_currency, args.queue_type, args.timezone, args.tax_year_end)
+    profiler = Profiler() if args.profile is not None else None
+    rate_provider = None
+    if args.rates_db is not None:
+        rate_provider = SqliteRateProvider(Path(args.rates_db))
+    elif args.rates_url is not None:
+        rate_provider = HttpRateProvider(args.rates_url)
+    calculate_cg(
+        Path(args.folder_path),
+        args.tax_currency,
+        args.queue_type,
+        args.timezone,
+        args.tax_year_end,
+        streaming=args.streaming,
+        sort_buffer_size=args.sort_buffer_size,
+        workers=args.workers,
+        incremental=args.incremental,
+        profiler=profiler,
+        output_format=args.output_format,
+        sqlite=args.sqlite,
+        deterministic_ids=args.deterministic_ids,
+        input_paths=args.input,
+        pipelined=args.pipelined,
+        lot_buffer_size=args.lot_buffer_size,
+        coalesce_fills=args.coalesce_fills,
+        rate_provider=rate_provider,
+    )
+    if profiler is not None:
+        profiler.write_report(None if args.profile == '-' else Path(args.profile))
     print(f'Finished calculating capital gains. Output files are available in the {args.folder_path} folder')
 
 def summary(args):
-    assets = cg_summary(Path(args.folder_path) / FILE_CG_EVENTS, args.tax_year_end)
+    from capitalg.analysis.summary import cg_summary
+
+    assets = cg_summary(latest_result(Path(args.folder_path), FILE_CG_EVENTS), args.tax_year_end)
     for asset, cgs in assets.items():
         print(asset)
         for k, v in cgs.items():
             print(f"{k}: { '{:,}'.format(round(v, 0)) }")
         print()
 
+def rollup(args):
+    from capitalg.analysis.summary import ROLLUP_FIELDS, cg_rollup, rollup_rows
+
+    rows = rollup_rows(cg_rollup(latest_result(Path(args.folder_path), FILE_CG_EVENTS), args.tax_year_end, args.periods))
+    with (open(args.output, 'w') if args.output is not None else nullcontext(sys.stdout)) as f:
+        writer = csv.writer(f)
+        writer.writerow(ROLLUP_FIELDS)
+        writer.writerows(rows)
+
 def balance(args):
-    balances = get_balance(args.tax_currency, Path(args.folder_path) / FILE_TRANSACTIONS, Path(args.folder_path) / FILE_UNALLOCATED_COST_BASE_TRANSACTION)
+    from capitalg.analysis.balance import get_balance
+
+    folder_path = Path(args.folder_path)
+    # The balance file is written at the end of every calculation, so is only older than the other outputs
+    # if they were written by an older version
+    balance_file = latest_file([latest_result(folder_path, FILE_UNALLOCATED_COST_BASE_TRANSACTION), folder_path / FILE_BALANCE])
+    balances = get_balance(args.tax_currency, folder_path / FILE_TRANSACTIONS, balance_file or folder_path / FILE_UNALLOCATED_COST_BASE_TRANSACTION)
     for asset, balance in balances.items():
         print(f"{asset}: { '{:,}'.format(round(balance, 4)) }")
     print()
 
+def latest_result(folder_path: Path, output_file: str) -> Path:
+    """ The most recently written of output_file (CSV or columnar) and the result store
+    """
+    from capitalg.columnar import latest_output
+
+    return latest_file([latest_output(folder_path / output_file), folder_path / FILE_RESULTS_DB]) or folder_path / output_file
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
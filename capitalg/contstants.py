@@ -5,6 +5,13 @@ DATE_INPUT_FORMAT = "%Y-%m-%dT%H:%M:%S"
 DATE_RATE_FORMAT = '%Y-%m-%d'
 TAX_YEAR_INPUT_FORMAT = '%Y-%m-%d'
 
+# Max number of transactions held in memory while sorting in streaming mode
+DEFAULT_SORT_BUFFER_SIZE = 100_000
+DEFAULT_WRITE_BUFFER_SIZE = 10_000
+# Max number of (date, asset) rates cached from a rate provider, and the number fetched per request
+DEFAULT_RATES_CACHE_SIZE = 100_000
+DEFAULT_RATES_BATCH_SIZE = 500
+
 FIELD_AMOUNT = 'amount'
 FIELD_BASE_CURRENCY = 'base_currency'
 FIELD_FEE = 'fee'
@@ -28,6 +35,22 @@ FIELD_SALE_ID = 'sale_id'
 FIELD_TRANSACTION_TYPE = 'type'
 FIELD_TZ = 'tz'
 
+OUTPUT_FIELDS_FORMATTED_TRANSACTIONS = [
+    FIELD_RAW_ID,
+    FIELD_EXCHANGE,
+    FIELD_DATE,
+    FIELD_TZ,
+    FIELD_TRANSACTION_TYPE,
+    FIELD_BASE_CURRENCY,
+    FIELD_ASSET_CODE,
+    FIELD_PRICE,
+    FIELD_QTY,
+    FIELD_FEE_CURRENCY,
+    FIELD_FEE,
+    FIELD_FEE_UNIT,
+    FIELD_NOTE,
+]
+
 OUTPUT_FIELDS_CGT_EVENTS = [
     FIELD_ASSET_CODE,
     FIELD_CAPITAL_GAIN_LT,
@@ -78,14 +101,46 @@ OUTPUT_FIELDS_UNALLOCATED_COST_BASE = [
     FIELD_NOTE,
 ]
 
+# Output fields holding Decimals, which are typed as such in columnar output files
+DECIMAL_OUTPUT_FIELDS = {
+    FIELD_CAPITAL_GAIN_LT,
+    FIELD_CAPITAL_GAIN_ST,
+    FIELD_CAPITAL_GAIN_TOTAL,
+    FIELD_COST_BASE_AMOUNT,
+    FIELD_FEE,
+    FIELD_FEE_UNIT,
+    FIELD_PRICE,
+    FIELD_QTY,
+    FIELD_SALE_AMOUNT,
+    FIELD_SALE_BROKERAGE,
+}
+
+OUTPUT_FORMAT_CSV = 'csv'
+OUTPUT_FORMAT_COLUMNAR = 'columnar'
+OUTPUT_FORMAT_BOTH = 'both'
+OUTPUT_FORMATS = [OUTPUT_FORMAT_CSV, OUTPUT_FORMAT_COLUMNAR, OUTPUT_FORMAT_BOTH]
+
+# Periods capital gains can be rolled up by, see analysis.summary.cg_rollup
+PERIOD_TAX_YEAR = 'tax_year'
+PERIOD_QUARTER = 'quarter'
+PERIOD_MONTH = 'month'
+PERIODS = [PERIOD_TAX_YEAR, PERIOD_QUARTER, PERIOD_MONTH]
+
 # FIELD_TRANSACTION_TYPE must be one of these
 TRANSACTION_BUY_LABEL = 'buy'
 TRANSACTION_SELL_LABEL = 'sell'
 
+# The raw ids of coalesced fills are joined with this, see TransactionLoader.merge_fills
+FILL_ID_SEPARATOR = ';'
+
 FILE_DIR = Path(os.environ.get('FILE_DIR', './capitalg_files'))
 FILE_TRANSACTIONS = 'transactions.csv'
 FILE_FORMATTED_TRANSACTIONS = 'formatted_transactions.csv'
 FILE_CG_EVENTS = 'cg_events.csv'
 FILE_COST_BASE_TRANSACTION = 'cost_base_transactions.csv'
 FILE_RATES = 'rates.csv'
+FILE_RATES_CACHE = 'rates.cache'
 FILE_UNALLOCATED_COST_BASE_TRANSACTION = 'unallocated_cost_base_transactions.csv'
+FILE_QUEUE_SNAPSHOT = 'queue_snapshot.pickle'
+FILE_RESULTS_DB = 'results.sqlite'
+FILE_BALANCE = 'balance.json'
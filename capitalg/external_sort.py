@@ -0,0 +1,92 @@
+""" Bounded-memory sorting of transaction streams that are too large to sort in memory.
+"""
+import heapq
+import pickle
+import tempfile
+from itertools import islice
+from pathlib import Path
+from typing import IO, Any, Callable, Iterable, Iterator, List, Optional
+
+# Rows are pickled to (and read back from) a run file in chunks of this many rows
+SPILL_CHUNK_SIZE = 1000
+
+_END = object()
+
+
+def external_sort(rows: Iterable[Any], key: Callable, buffer_size: int,
+                  temp_dir: Optional[str] = None) -> Iterator[Any]:
+    """ Lazily sort rows by key, holding at most buffer_size rows (and one row read ahead) in memory while sorting.
+    Rows are sorted in runs of buffer_size, spilled to temporary files and then k-way merged.
+    If all rows fit in a single run, nothing is spilled to disk.
+
+    The sort is stable, i.e. it yields rows in the same order as sorted(rows, key=key)
+    """
+    if buffer_size < 1:
+        raise ValueError(f'buffer_size must be at least 1, got {buffer_size}')
+
+    rows = iter(rows)
+    run = list(islice(rows, buffer_size))
+    # One row is read ahead, to tell whether every row fits in a single run
+    first = next(rows, _END)
+
+    if first is _END:
+        run.sort(key=key)
+        yield from run
+        return
+
+    run_files = []
+    try:
+        while True:
+            run.sort(key=key)
+            run_files.append(_spill_run(run, temp_dir))
+            # The previous run is released before the next one is read
+            run = None
+            if first is _END:
+                break
+            run = [first, *islice(rows, buffer_size - 1)]
+            first = next(rows, _END)
+
+        # heapq.merge favours earlier iterables on equal keys, which keeps the sort stable
+        yield from heapq.merge(*[_read_run(f) for f in run_files], key=key)
+    finally:
+        for run_file in run_files:
+            run_file.close()
+
+
+def _spill_run(run: List[Any], temp_dir: Optional[str]) -> IO[bytes]:
+    run_file = tempfile.TemporaryFile(dir=temp_dir)
+    for i in range(0, len(run), SPILL_CHUNK_SIZE):
+        pickle.dump(run[i:i + SPILL_CHUNK_SIZE], run_file, protocol=pickle.HIGHEST_PROTOCOL)
+    run_file.seek(0)
+    return run_file
+
+
+def _read_run(run_file: IO[bytes]) -> Iterator[Any]:
+    while True:
+        try:
+            chunk = pickle.load(run_file)
+        except EOFError:
+            return
+        yield from chunk
+
+
+def write_run_file(rows: Iterable[Any], path: Path) -> int:
+    """ Pickles rows to path, in the same chunked format as spilled runs, e.g. so a sorted run can be
+    handed from a worker process to a merge in the parent. Returns the number of rows written
+    """
+    rows = iter(rows)
+    count = 0
+    with open(path, 'wb') as run_file:
+        while True:
+            chunk = list(islice(rows, SPILL_CHUNK_SIZE))
+            if not chunk:
+                return count
+            pickle.dump(chunk, run_file, protocol=pickle.HIGHEST_PROTOCOL)
+            count += len(chunk)
+
+
+def read_run_file(path: Path) -> Iterator[Any]:
+    """ Lazily yields the rows written by write_run_file
+    """
+    with open(path, 'rb') as run_file:
+        yield from _read_run(run_file)
@@ -1,65 +1,416 @@
+import heapq
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from functools import partial
+from operator import itemgetter
 from pathlib import Path
-from typing import List
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
 
 from capitalg.contstants import (
-    FIELD_ASSET_CODE,
-    FIELD_QTY,
-    FIELD_TRANSACTION_TYPE,
+    DEFAULT_SORT_BUFFER_SIZE,
+    FILE_BALANCE,
     TRANSACTION_BUY_LABEL,
     TRANSACTION_SELL_LABEL,
     FILE_TRANSACTIONS,
     FILE_CG_EVENTS,
     FILE_COST_BASE_TRANSACTION,
     FILE_FORMATTED_TRANSACTIONS,
+    FILE_QUEUE_SNAPSHOT,
     FILE_RATES,
+    FILE_RATES_CACHE,
+    FILE_RESULTS_DB,
     FILE_UNALLOCATED_COST_BASE_TRANSACTION,
+    OUTPUT_FORMAT_CSV,
 )
-from capitalg.CostBaseQueue import CostBaseQueue, QueueTypes
-from capitalg.TransactionLoader import TransactionLoader
-from capitalg.Writer import Writer
-from capitalg.cg_helpers import register_cg_event
-from capitalg.rates_loader import load_rates
-from capitalg.utils import get_tax_year_cutoff_date
+from capitalg.CostBaseQueue import COST_QUEUE_TYPES, CostBaseQueue, Lot, QueueTypes
+from capitalg.Profiler import (
+    COUNTER_LOTS_CONSUMED,
+    STAGE_MATCH,
+    STAGE_RATES,
+    STAGE_SNAPSHOT,
+    STAGE_WRITE,
+    Profiler,
+    profile_function,
+    profile_stage,
+    profiling,
+)
+from capitalg.ResultStore import ResultStore, open_result_store
+from capitalg.SpillingCostBaseQueue import SpillingCostBaseQueue
+from capitalg.Transaction import Transaction
+from capitalg.TransactionLoader import InputPaths, TransactionLoader
+from capitalg.Writer import Writer, output_paths
+from capitalg.cg_helpers import SequentialCostBaseIds, calculate_cg_event, write_cg_event
+from capitalg.pipeline import ThreadedConsumer, threaded_iter
+from capitalg.rate_providers import CachedRates, RateProvider
+from capitalg.rates_loader import load_rates_store
+from capitalg.snapshot import (
+    TransactionDigest,
+    delete_snapshot,
+    load_snapshot,
+    restore_queues,
+    resume_transactions,
+    save_snapshot,
+)
+from capitalg.utils import get_tax_year_cutoff_date, to_timestamp
+
+logger = logging.getLogger(__name__)
+
+
+def calculate_cg(file_dir: Path, tax_currency: str, queue_type_code: str, tax_timezone: str, tax_year_end: str,
+                 streaming: bool = False, sort_buffer_size: int = DEFAULT_SORT_BUFFER_SIZE, workers: int = 1,
+                 incremental: bool = False, profiler: Optional[Profiler] = None, output_format: str = OUTPUT_FORMAT_CSV,
+                 sqlite: bool = False, deterministic_ids: bool = False, input_paths: Optional[InputPaths] = None,
+                 pipelined: bool = False,
+                 lot_buffer_size: Optional[int] = None, coalesce_fills: bool = False,
+                 rate_provider: Optional[RateProvider] = None):
+    """ If streaming is True, transactions are loaded and matched lazily,
+    holding at most sort_buffer_size transactions in memory while sorting.
+
+    If workers > 1, each asset is matched in its own worker process (see process_transactions)
+
+    If incremental is True, the state of all queues at the tax year cutoff is saved to a snapshot file.
+    A later incremental run resumes from the snapshot, only matching transactions after it and appending
+    to the existing output files. If the transactions before the snapshot have changed, the full history is replayed.
+
+    If a profiler is given, the wall time and peak memory of each stage, and counters, are recorded to it (see Profiler)
+
+    output_format is one of OUTPUT_FORMATS, i.e. whether cg events, cost base and unallocated cost base files
+    are written as CSV, columnar files (see columnar.py) or both
+
+    If sqlite is True, the results (and the fee totals needed for balances) are also written to
+    FILE_RESULTS_DB, which summary and balance can query instead of scanning the output files (see ResultStore)
+
+    If deterministic_ids is True, cost base ids are numbered in date order (see SequentialCostBaseIds) instead of random,
+    so the same transactions always produce the same output files
+
+    input_paths are the transactions files (or glob patterns) to read, e.g. one per exchange, and default to
+    FILE_TRANSACTIONS in file_dir. With workers > 1, the files are also read and sorted in parallel (see TransactionLoader)
+
+    If pipelined is True, reading transactions, matching and writing the results run concurrently in threads
+    connected by bounded queues (see pipeline.py). Transactions are streamed, as if streaming were True.
+    Pipelined calculations can't be profiled, as the profiler times one stage at a time
 
+    If lot_buffer_size is given, each asset holds at most about lot_buffer_size open lots in memory,
+    and spills the rest to a temporary file (see SpillingCostBaseQueue). Only FIFO and LIFO queues
+    matched by a single process can be spilled.
 
-def calculate_cg(file_dir: Path, tax_currency: str, queue_type_code: str, tax_timezone: str, tax_year_end: str):
+    If coalesce_fills is True, consecutive fills of the same order are merged into one transaction before matching
+    (see TransactionLoader.merge_fills), so they make one lot or cg event
+
+    If a rate_provider is given, rates are fetched from it as they are needed, and cached, instead of
+    loading FILE_RATES (see rate_providers). Only the rates of the transactions' dates and currencies are fetched
+    """
+    if pipelined is True and profiler is not None:
+        raise ValueError('Pipelined calculations can not be profiled')
+    if lot_buffer_size is not None and (workers > 1 or QueueTypes(queue_type_code.upper()) in COST_QUEUE_TYPES):
+        raise ValueError('Open lots can only be spilled to disk by FIFO and LIFO queues, with one worker')
+
+    with profiling(profiler), open_result_store(file_dir / FILE_RESULTS_DB if sqlite is True else None) as result_store:
+        _calculate_cg(file_dir, tax_currency, queue_type_code, tax_timezone, tax_year_end, streaming or pipelined,
+                      sort_buffer_size, workers, incremental, profiler, output_format, result_store, deterministic_ids,
+                      input_paths, pipelined, lot_buffer_size, coalesce_fills, rate_provider)
+
+
+def _calculate_cg(file_dir: Path, tax_currency: str, queue_type_code: str, tax_timezone: str, tax_year_end: str,
+                  streaming: bool, sort_buffer_size: int, workers: int, incremental: bool, profiler: Optional[Profiler],
+                  output_format: str, result_store: Optional[ResultStore], deterministic_ids: bool,
+                  input_paths: Optional[InputPaths], pipelined: bool,
+                  lot_buffer_size: Optional[int], coalesce_fills: bool, rate_provider: Optional[RateProvider]):
+    tax_year_cutoff = get_tax_year_cutoff_date(tax_year_end, tax_timezone)
+    queue_type = QueueTypes(queue_type_code.upper())
+
+    with profile_stage(profiler, STAGE_RATES):
+        if rate_provider is None:
+            rates = load_rates_store(file_dir / FILE_RATES, cache_path=file_dir / FILE_RATES_CACHE)
+        else:
+            rates = CachedRates(rate_provider)
 
     loader = TransactionLoader(
-        input_path=file_dir / FILE_TRANSACTIONS,
+        input_path=file_dir / FILE_TRANSACTIONS if input_paths is None else input_paths,
         output_path=file_dir / FILE_FORMATTED_TRANSACTIONS,
         tax_currency=tax_currency,
-        tax_year_cutoff=get_tax_year_cutoff_date(tax_year_end, tax_timezone),
+        tax_year_cutoff=tax_year_cutoff,
         tax_timezone=tax_timezone,
-        rates=load_rates(file_dir / FILE_RATES)
+        rates=rates,
+        streaming=streaming,
+        sort_buffer_size=sort_buffer_size,
+        profiler=profiler,
+        track_fees=True,
+        workers=workers,
+        coalesce_fills=coalesce_fills,
     )
 
-    process_transactions(
+    transactions = loader.stream() if streaming is True else loader.transactions
+    make_id = SequentialCostBaseIds() if deterministic_ids is True else None
+
+    snapshot_path = file_dir / FILE_QUEUE_SNAPSHOT
+    if incremental is False:
+        # The output files are rewritten, so a previous snapshot can no longer be resumed from
+        delete_snapshot(snapshot_path)
+        queues = process_transactions(file_dir=file_dir, transactions=transactions, queue_type=queue_type,
+                                      workers=workers, profiler=profiler, output_format=output_format,
+                                      result_store=result_store, make_id=make_id, pipelined=pipelined,
+                                      lot_buffer_size=lot_buffer_size)
+        try:
+            _output_balance(file_dir, queues, loader.fee_totals, result_store, profiler)
+        finally:
+            _close_queues(queues)
+        return
+
+    snapshot_settings = {
+        'queue_type': queue_type.value,
+        'tax_currency': tax_currency,
+        'tax_timezone': tax_timezone,
+        'output_format': output_format,
+        'sqlite': result_store is not None,
+        'deterministic_ids': deterministic_ids,
+        'coalesce_fills': coalesce_fills,
+    }
+    cutoff_timestamp = to_timestamp(tax_year_cutoff)
+
+    digest = TransactionDigest()
+    queues = None
+    with profile_stage(profiler, STAGE_SNAPSHOT):
+        snapshot = load_snapshot(snapshot_path, snapshot_settings, cutoff_timestamp,
+                                 None if result_store is None else result_store.row_counts())
+        remaining_transactions = None if snapshot is None else resume_transactions(snapshot, transactions, digest)
+
+    if snapshot is not None:
+        if remaining_transactions is None:
+            logger.warning('Transactions have changed since the last snapshot, replaying full history')
+            if streaming is True:
+                transactions.close()
+            transactions = loader.stream() if streaming is True else loader.transactions
+            digest = TransactionDigest()
+        else:
+            transactions = remaining_transactions
+            with profile_stage(profiler, STAGE_SNAPSHOT):
+                queues = restore_queues(snapshot, queue_type, lot_buffer_size)
+                if result_store is not None:
+                    result_store.truncate(snapshot['result_row_counts'])
+            if make_id is not None:
+                # Ids continue from the cg events already written
+                make_id = SequentialCostBaseIds(snapshot['cost_base_id_count'])
+
+    queues = process_transactions(
         file_dir=file_dir,
-        transactions=loader.transactions,
-        queue_type=QueueTypes.FIFO if queue_type_code == 'fifo' else QueueTypes.LIFO
+        transactions=digest.passthrough(transactions),
+        queue_type=queue_type,
+        workers=workers,
+        queues=queues,
+        profiler=profiler,
+        output_format=output_format,
+        result_store=result_store,
+        make_id=make_id,
+        pipelined=pipelined,
+        lot_buffer_size=lot_buffer_size,
     )
+    try:
+        _output_balance(file_dir, queues, loader.fee_totals, result_store, profiler)
+
+        with profile_stage(profiler, STAGE_SNAPSHOT):
+            save_snapshot(
+                snapshot_path,
+                settings=snapshot_settings,
+                cutoff_timestamp=cutoff_timestamp,
+                digest=digest,
+                queues=queues,
+                output_files=output_paths(file_dir / FILE_CG_EVENTS, output_format)
+                + output_paths(file_dir / FILE_COST_BASE_TRANSACTION, output_format),
+                result_row_counts=None if result_store is None else result_store.row_counts(),
+                cost_base_id_count=0 if make_id is None else make_id.count,
+            )
+    finally:
+        _close_queues(queues)
+
+
+def _output_balance(file_dir: Path, queues: Dict[str, CostBaseQueue], fee_totals: dict,
+                    result_store: Optional[ResultStore], profiler: Optional[Profiler]):
+    """ Writes the open qty of each asset and the fee totals, so balances don't need to rescan the history
+    """
+    with profile_stage(profiler, STAGE_WRITE):
+        Writer.output_balance(file_dir / FILE_BALANCE, queues, fee_totals)
+        if result_store is not None:
+            result_store.replace_fees(fee_totals)
+
+
+def process_transactions(file_dir: Path, transactions: Iterable[Transaction], queue_type: QueueTypes,
+                         workers: int = 1, queues: Optional[Dict[str, CostBaseQueue]] = None,
+                         profiler: Optional[Profiler] = None,
+                         output_format: str = OUTPUT_FORMAT_CSV,
+                         result_store: Optional[ResultStore] = None,
+                         make_id: Optional[Callable[[], str]] = None,
+                         pipelined: bool = False,
+                         lot_buffer_size: Optional[int] = None) -> Dict[str, CostBaseQueue]:
+    """ Matches sales against their cost base and writes the results. Returns the queues of open lots by asset.
+
+    Each asset's queue is independent of every other asset, so if workers > 1 the transactions
+    are partitioned by asset and each asset is matched in a worker process.
+    The results are merged back into date order before writing, so the output is identical to a serial run.
+    NOTE with workers > 1 all transactions are held in memory, even if they are streamed in
+
+    If queues are given (e.g. restored from a snapshot), matching continues from them,
+    and cg events are appended to the existing output files (and result_store tables)
+
+    make_id makes cost base ids, see cg_helpers.write_cg_event
+
+    If pipelined is True, transactions are read in a thread ahead of matching, and cg events are written
+    in a thread behind it (see pipeline.py)
+
+    If lot_buffer_size is given, queues spill open lots beyond lot_buffer_size to disk (see SpillingCostBaseQueue),
+    including the queues given. Only supported when matching serially. The caller must close the queues returned
+    (see _close_queues), which are closed if matching fails
+    """
+    append = queues is not None
+    queues = {} if queues is None else queues
+    if lot_buffer_size is None:
+        make_queue = partial(CostBaseQueue, queue_type)
+    else:
+        make_queue = partial(SpillingCostBaseQueue, queue_type, lot_buffer_size)
+        # Queues restored from a snapshot with lot_buffer_size already spill
+        queues = {
+            asset_code: _copy_queue(queue, make_queue()) if type(queue) is CostBaseQueue else queue
+            for asset_code, queue in queues.items()
+        }
+
+    try:
+        with Writer(
+            cgt_events_path=file_dir / FILE_CG_EVENTS,
+            cost_base_path=file_dir / FILE_COST_BASE_TRANSACTION,
+            append=append,
+            output_format=output_format,
+            result_store=result_store,
+        ) as writer:
+
+            output = ThreadedConsumer(write_cg_event, name='write') if pipelined is True else nullcontext()
+            with profile_stage(profiler, STAGE_MATCH), output:
+                if pipelined is True:
+                    transactions = threaded_iter(transactions, name='read')
+                    write = output.submit
+                else:
+                    write = profile_function(profiler, STAGE_WRITE, write_cg_event)
+
+                if workers > 1:
+                    queues = _process_transactions_in_parallel(writer, transactions, queue_type, workers, queues, write,
+                                                               profiler, make_id)
+                else:
+                    _process_transactions_serially(writer, transactions, make_queue, queues, write, profiler, make_id)
+
+            with profile_stage(profiler, STAGE_WRITE):
+                # Record unfulfilled cost base transactions
+                # This will allow us to estimate our current asset balance
+                writer.output_unallocted_cost_base_transactions(
+                    file_dir / FILE_UNALLOCATED_COST_BASE_TRANSACTION, queues, output_format=output_format,
+                    result_store=result_store,
+                )
+                writer.flush()
+    except BaseException:
+        _close_queues(queues)
+        raise
+
+    return queues
+
+
+def _process_transactions_serially(writer: Writer, transactions: Iterable[Transaction],
+                                   make_queue: Callable[[], CostBaseQueue],
+                                   queues: Dict[str, CostBaseQueue], write: Callable,
+                                   profiler: Optional[Profiler] = None,
+                                   make_id: Optional[Callable[[], str]] = None):
+    """ make_queue makes the queue of each new asset.
+    write is write_cg_event, or a function that passes its arguments on to write_cg_event
+    """
+    for _, transaction in enumerate(transactions):
+
+        asset_code = transaction.asset_code
+        if asset_code not in queues:
+            queues[asset_code] = make_queue()
+
+        if transaction.type == TRANSACTION_BUY_LABEL:
+            queues[asset_code].add(transaction)
+            if profiler is not None:
+                profiler.record_queue_depth(asset_code, len(queues[asset_code]))
+
+        elif transaction.type == TRANSACTION_SELL_LABEL:
+            costs = queues[asset_code].get_transactions(transaction.qty)
+            write(writer, transaction, costs, calculate_cg_event(transaction, costs), make_id)
+            if profiler is not None:
+                profiler.count(COUNTER_LOTS_CONSUMED, len(costs))
+
+
+def _process_transactions_in_parallel(writer: Writer, transactions: Iterable[Transaction], queue_type: QueueTypes,
+                                      workers: int, queues: Dict[str, CostBaseQueue], write: Callable,
+                                      profiler: Optional[Profiler] = None,
+                                      make_id: Optional[Callable[[], str]] = None) -> Dict[str, CostBaseQueue]:
+    # Partition by asset, remembering each transaction's position in the date ordered stream
+    partitions = {}
+    for position, transaction in enumerate(transactions):
+        partitions.setdefault(transaction.asset_code, []).append((position, transaction))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            asset_code: executor.submit(
+                _match_asset, partition, queue_type,
+                list(queues[asset_code].get_queue) if asset_code in queues else []
+            )
+            for asset_code, partition in partitions.items()
+        }
+        results = {asset_code: future.result() for asset_code, future in futures.items()}
+
+    # Cost base ids are made while writing, in date order, just like a serial run
+    cg_events = heapq.merge(*[asset_cg_events for asset_cg_events, _, _ in results.values()], key=itemgetter(0))
+    for _, sale, costs, cost_base in cg_events:
+        write(writer, sale, costs, cost_base, make_id)
+        if profiler is not None:
+            profiler.count(COUNTER_LOTS_CONSUMED, len(costs))
+
+    # Assets without new transactions keep their queue, and keep their order with respect to new assets
+    queues = dict(queues)
+    for asset_code, (_, open_lots, max_queue_depth) in results.items():
+        if profiler is not None:
+            profiler.record_queue_depth(asset_code, max_queue_depth)
+        queues[asset_code] = CostBaseQueue(queue_type)
+        for lot in open_lots:
+            queues[asset_code].add_lot(lot)
+    return queues
+
 
+def _close_queues(queues: Dict[str, CostBaseQueue]):
+    """ Deletes the temporary files of queues that spill open lots to disk
+    """
+    for queue in queues.values():
+        queue.close()
 
-def process_transactions(file_dir: Path, transactions: List[dict], queue_type: QueueTypes):
-    queues = {}
 
-    with Writer(cgt_events_path=file_dir / FILE_CG_EVENTS, cost_base_path=file_dir / FILE_COST_BASE_TRANSACTION) as writer:
+def _copy_queue(queue: CostBaseQueue, copy: CostBaseQueue) -> CostBaseQueue:
+    """ Adds the lots of queue to copy, e.g. a queue of a different storage
+    """
+    for lot in queue.get_queue:
+        copy.add_lot(lot)
+    return copy
 
-        for _, transaction in enumerate(transactions):
 
-            asset_code = transaction[FIELD_ASSET_CODE]
-            if asset_code not in queues:
-                queues[asset_code] = CostBaseQueue(queue_type)
+def _match_asset(transactions: List[Tuple[int, Transaction]], queue_type: QueueTypes,
+                 open_lots: List[Lot]) -> Tuple[List[Tuple[int, Transaction, List[Lot], dict]], List[Lot], int]:
+    """ Matches the (position, transaction) pairs of a single asset, starting from its open_lots. Runs in a worker process.
+    Returns the asset's (position, sale, costs, cost_base) cg events, its remaining open lots
+    and the most lots its queue held at once
+    """
+    queue = CostBaseQueue(queue_type)
+    for lot in open_lots:
+        queue.add_lot(lot)
+    cg_events = []
+    max_queue_depth = len(queue)
 
-            if transaction[FIELD_TRANSACTION_TYPE] == TRANSACTION_BUY_LABEL:
-                queues[asset_code].add(transaction)
+    for position, transaction in transactions:
 
-            elif transaction[FIELD_TRANSACTION_TYPE] == TRANSACTION_SELL_LABEL:
-                costs = queues[asset_code].get_transactions(transaction[FIELD_QTY])
-                register_cg_event(writer=writer, costs=costs, sale=transaction)
+        if transaction.type == TRANSACTION_BUY_LABEL:
+            queue.add(transaction)
+            max_queue_depth = max(max_queue_depth, len(queue))
 
+        elif transaction.type == TRANSACTION_SELL_LABEL:
+            costs = queue.get_transactions(transaction.qty)
+            cg_events.append((position, transaction, costs, calculate_cg_event(transaction, costs)))
 
-        # Record unfulfilled cost base transactions
-        # This will allow us to estimate our current asset balance
-        writer.output_unallocted_cost_base_transactions(file_dir / FILE_UNALLOCATED_COST_BASE_TRANSACTION, queues)
+    return cg_events, list(queue.get_queue), max_queue_depth
 
@@ -0,0 +1,148 @@
+""" Runs the stages of a calculation concurrently, connected by bounded queues (see calculate_cg(pipelined=True)).
+
+Reading (parsing, rebasing, sorting and writing formatted transactions) runs in a thread ahead of matching,
+and writing cg events and cost bases runs in a thread behind it. Items are passed between threads in batches,
+so the cost of locking is paid once per batch rather than once per transaction, and at most QUEUE_SIZE batches
+wait between two stages, so memory stays bounded when one stage is slower than the others.
+
+The stages share the GIL, so stages only run at the same time while one of them is waiting on I/O.
+"""
+import queue
+import threading
+from typing import Callable, Iterable, Iterator, Optional
+
+# Items are passed between stages in batches of this many items
+BATCH_SIZE = 1000
+# Max number of batches waiting between two stages
+QUEUE_SIZE = 8
+
+# How often a blocked producer checks whether its consumer has stopped
+_POLL_SECONDS = 0.1
+
+_DONE = object()
+
+
+class _Error:
+    """ An exception raised in a producer thread, to be raised again by the consumer
+    """
+    __slots__ = ('exception',)
+
+    def __init__(self, exception: BaseException):
+        self.exception = exception
+
+
+def threaded_iter(iterable: Iterable, name: str, batch_size: int = BATCH_SIZE,
+                  queue_size: int = QUEUE_SIZE) -> Iterator:
+    """ Yields the items of iterable, which is iterated in a background thread, at most queue_size batches ahead.
+    An exception raised while iterating is raised here. If iteration stops early, the background thread
+    stops too, and closes iterable if it is a generator
+    """
+    batches = queue.Queue(maxsize=queue_size)
+    stopped = threading.Event()
+
+    def put(item) -> bool:
+        while not stopped.is_set():
+            try:
+                batches.put(item, timeout=_POLL_SECONDS)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        iterator = iter(iterable)
+        try:
+            batch = []
+            for item in iterator:
+                batch.append(item)
+                if len(batch) >= batch_size:
+                    if not put(batch):
+                        return
+                    batch = []
+            if put(batch):
+                put(_DONE)
+        except BaseException as e:
+            put(_Error(e))
+        finally:
+            close = getattr(iterator, 'close', None)
+            if close is not None:
+                close()
+
+    thread = threading.Thread(target=produce, name=name, daemon=True)
+    thread.start()
+    try:
+        while True:
+            batch = batches.get()
+            if batch is _DONE:
+                return
+            if isinstance(batch, _Error):
+                raise batch.exception
+            yield from batch
+    finally:
+        stopped.set()
+        thread.join()
+
+
+class ThreadedConsumer:
+    """ Calls function with each item submitted, in a background thread, in the order they were submitted.
+    submit blocks while queue_size batches are waiting, i.e. while the thread is behind.
+
+    An exception raised by function is raised by a later submit, or by close.
+    Once function has raised, the remaining items are dropped
+    """
+
+    def __init__(self, function: Callable, name: str, batch_size: int = BATCH_SIZE, queue_size: int = QUEUE_SIZE):
+        self.function = function
+        self.batch_size = batch_size
+        self.batch = []
+        self.batches = queue.Queue(maxsize=queue_size)
+        self.error: Optional[BaseException] = None
+        self.thread = threading.Thread(target=self._consume, name=name, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # The exception being raised takes precedence over one raised by function
+            self.batches.put(_DONE)
+            self.thread.join()
+
+    def _consume(self):
+        function = self.function
+        while True:
+            batch = self.batches.get()
+            if batch is _DONE:
+                return
+            # After an error, batches are still taken off the queue, so submit never blocks forever
+            if self.error is None:
+                try:
+                    for item in batch:
+                        function(*item)
+                except BaseException as e:
+                    self.error = e
+
+    def submit(self, *item):
+        self.batch.append(item)
+        if len(self.batch) >= self.batch_size:
+            self._put_batch()
+
+    def _put_batch(self):
+        if self.error is not None:
+            raise self.error
+        self.batches.put(self.batch)
+        self.batch = []
+
+    def close(self):
+        """ Waits for every item submitted to be consumed
+        """
+        if self.batch and self.error is None:
+            self.batches.put(self.batch)
+        self.batch = []
+        self.batches.put(_DONE)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
@@ -0,0 +1,273 @@
+""" Sources of daily exchange rates, as an alternative to loading every rate of rates.csv up front.
+
+A RateProvider fetches the rates of a batch of (day, asset_code) keys. CachedRates wraps a provider
+with a bounded LRU cache and has the same get_rate as RatesStore, so TransactionLoader can use either.
+TransactionLoader prefetches the keys its transactions need in batches (see CachedRates.prefetch),
+so only the rates that are referenced are fetched, a batch at a time.
+
+Providers:
+- FileRateProvider: a rates.csv file, loaded into a RatesStore on the first fetch
+- SqliteRateProvider: a table of (date, asset_code, rate) rows, see write_rates_db
+- HttpRateProvider: an HTTP service, see make_rate_server for a local stand-in
+
+python -m capitalg.rate_providers rates.csv --port 8765
+"""
+import logging
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import date
+from decimal import Decimal
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from capitalg.contstants import DATE_RATE_FORMAT, DEFAULT_RATES_BATCH_SIZE, DEFAULT_RATES_CACHE_SIZE
+from capitalg.errors import InputValidationError
+
+# The HTTP modules are imported when they are used, so importing this module (e.g. for every calculate) stays cheap
+if TYPE_CHECKING:
+    from http.server import ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+RateKey = Tuple[date, str]
+
+# Seconds to wait for a response from a rates service
+HTTP_TIMEOUT = 30
+
+# A batch of keys is split into GET requests with URLs of at most this many characters,
+# which servers and proxies generally accept
+HTTP_MAX_URL_LENGTH = 2000
+
+# Each key binds 2 parameters, and SQLite before 3.32 allows at most 999 per statement (SQLITE_MAX_VARIABLE_NUMBER)
+SQLITE_MAX_KEYS = 499
+
+
+class RateProvider(ABC):
+    """ Fetches daily rates. Subclasses implement fetch_rates
+    """
+
+    @abstractmethod
+    def fetch_rates(self, keys: Sequence[RateKey]) -> Dict[RateKey, Decimal]:
+        """ The rates of those (day, asset_code) keys that have one
+        """
+
+
+class CachedRates:
+    """ The rates of a provider, fetched in batches of batch_size keys and cached.
+    At most max_size rates (or missing rates) are cached, the least recently used are evicted first
+    """
+
+    def __init__(self, provider: RateProvider, max_size: int = DEFAULT_RATES_CACHE_SIZE,
+                 batch_size: int = DEFAULT_RATES_BATCH_SIZE):
+        if max_size < 1 or batch_size < 1:
+            raise ValueError(f'max_size and batch_size must be at least 1, got {max_size} and {batch_size}')
+
+        self.provider = provider
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.cache: 'OrderedDict[RateKey, Optional[Decimal]]' = OrderedDict()
+        self.fetches = 0
+
+    def get_rate(self, day: date, asset_code: str) -> Optional[Decimal]:
+        """ Returns None if there is no rate for asset_code on day
+        """
+        key = (day, asset_code)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        self._fetch([key])
+        return self.cache.get(key)
+
+    def prefetch(self, keys: Iterable[RateKey]):
+        """ Fetches the rates of keys that aren't cached, a batch at a time
+        """
+        missing = [key for key in dict.fromkeys(keys) if key not in self.cache]
+        for i in range(0, len(missing), self.batch_size):
+            self._fetch(missing[i:i + self.batch_size])
+
+    def _fetch(self, keys: List[RateKey]):
+        self.fetches += 1
+        rates = self.provider.fetch_rates(keys)
+        cache = self.cache
+        for key in keys:
+            # Missing rates are cached too, so they aren't fetched again
+            cache[key] = rates.get(key)
+            cache.move_to_end(key)
+        while len(cache) > self.max_size:
+            cache.popitem(last=False)
+
+
+class FileRateProvider(RateProvider):
+    """ Rates of a rates.csv file, loaded on the first fetch (see rates_loader.load_rates_store)
+    """
+
+    def __init__(self, path: Path, cache_path: Optional[Path] = None):
+        self.path = path
+        self.cache_path = cache_path
+        self.store = None
+
+    def fetch_rates(self, keys: Sequence[RateKey]) -> Dict[RateKey, Decimal]:
+        if self.store is None:
+            from capitalg.rates_loader import load_rates_store
+            self.store = load_rates_store(self.path, self.cache_path)
+
+        rates = {key: self.store.get_rate(*key) for key in keys}
+        return {key: rate for key, rate in rates.items() if rate is not None}
+
+
+class SqliteRateProvider(RateProvider):
+    """ Rates in a SQLite table of (date, asset_code, rate) rows, dates in DATE_RATE_FORMAT and rates as text.
+    The connection is opened on the first fetch, so the provider can be sent to worker processes.
+    Keys are looked up SQLITE_MAX_KEYS at a time
+    """
+
+    def __init__(self, path: Path, table: str = 'rates'):
+        self.path = path
+        self.table = table
+        self.connection = None
+
+    def __getstate__(self):
+        return {'path': self.path, 'table': self.table}
+
+    def __setstate__(self, state: dict):
+        self.__init__(**state)
+
+    def fetch_rates(self, keys: Sequence[RateKey]) -> Dict[RateKey, Decimal]:
+        if self.connection is None:
+            import sqlite3
+            self.connection = sqlite3.connect(self.path)
+
+        days = {day.strftime(DATE_RATE_FORMAT): day for day, _ in keys}
+        rates = {}
+        for i in range(0, len(keys), SQLITE_MAX_KEYS):
+            batch = keys[i:i + SQLITE_MAX_KEYS]
+            values = ', '.join(['(?, ?)'] * len(batch))
+            rows = self.connection.execute(
+                f'SELECT date, asset_code, rate FROM {self.table} WHERE (date, asset_code) IN (VALUES {values})',
+                [value for day, asset_code in batch for value in (day.strftime(DATE_RATE_FORMAT), asset_code)],
+            )
+            rates.update(((days[date_key], asset_code), Decimal(rate)) for date_key, asset_code, rate in rows)
+        return rates
+
+
+def write_rates_db(rates: dict, path: Path, table: str = 'rates'):
+    """ Writes the {date: {asset_code: rate}} dict returned by rates_loader.load_rates to a table for SqliteRateProvider
+    """
+    import sqlite3
+
+    with sqlite3.connect(path) as connection:
+        connection.execute(f'DROP TABLE IF EXISTS {table}')
+        connection.execute(f'CREATE TABLE {table} (date TEXT, asset_code TEXT, rate TEXT, PRIMARY KEY (date, asset_code))')
+        connection.executemany(
+            f'INSERT INTO {table} VALUES (?, ?, ?)',
+            [
+                (date_key, asset_code, rate)
+                for date_key, daily_rates in rates.items()
+                for asset_code, rate in daily_rates.items()
+                if asset_code != 'date' and rate
+            ],
+        )
+    connection.close()
+
+
+class HttpRateProvider(RateProvider):
+    """ Rates from an HTTP service. Keys are fetched with GET requests of url, with a key parameter per key,
+    e.g. ?key=2019-04-05:btc&key=2019-04-05:eth, and as many keys per request as fit in max_url_length characters.
+    The response is JSON in the shape of rates_loader.load_rates, i.e. {date: {asset_code: rate}},
+    with rates as strings so they are exact. Keys without a rate are left out
+    """
+
+    def __init__(self, url: str, timeout: float = HTTP_TIMEOUT, max_url_length: int = HTTP_MAX_URL_LENGTH):
+        self.url = url
+        self.timeout = timeout
+        self.max_url_length = max_url_length
+
+    def fetch_rates(self, keys: Sequence[RateKey]) -> Dict[RateKey, Decimal]:
+        import json
+        from urllib.request import urlopen
+
+        days = {day.strftime(DATE_RATE_FORMAT): day for day, _ in keys}
+        rates = {}
+        for url in self.urls(keys):
+            with urlopen(url, timeout=self.timeout) as response:
+                response_rates = json.load(response)
+
+            try:
+                rates.update(
+                    ((days[date_key], asset_code), Decimal(rate))
+                    for date_key, daily_rates in response_rates.items()
+                    for asset_code, rate in daily_rates.items()
+                )
+            except (KeyError, AttributeError, ArithmeticError) as e:
+                raise InputValidationError(f'Unexpected response from {self.url}: {e!r}') from e
+        return rates
+
+    def urls(self, keys: Sequence[RateKey]) -> Iterator[str]:
+        """ The request URLs for keys, each at most max_url_length characters unless it has a single key
+        """
+        from urllib.parse import urlencode, urlparse
+
+        separator = '&' if urlparse(self.url).query else '?'
+        url = None
+        for day, asset_code in keys:
+            parameter = urlencode([('key', f'{day.strftime(DATE_RATE_FORMAT)}:{asset_code}')])
+            if url is not None and len(url) + 1 + len(parameter) > self.max_url_length:
+                yield url
+                url = None
+            url = f'{self.url}{separator}{parameter}' if url is None else f'{url}&{parameter}'
+        if url is not None:
+            yield url
+
+
+def make_rate_server(rates: dict, host: str = '127.0.0.1', port: int = 0) -> 'ThreadingHTTPServer':
+    """ A local stand-in for a rates service, answering HttpRateProvider requests from the
+    {date: {asset_code: rate}} dict returned by rates_loader.load_rates. port 0 picks a free port,
+    see server.server_address. Call serve_forever to serve requests
+    """
+    import json
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import parse_qs, urlparse
+
+    class RatesRequestHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            response = {}
+            for key in parse_qs(urlparse(self.path).query).get('key', []):
+                date_key, _, asset_code = key.partition(':')
+                rate = rates.get(date_key, {}).get(asset_code)
+                if rate:
+                    response.setdefault(date_key, {})[asset_code] = str(rate)
+
+            body = json.dumps(response).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format, *args)
+
+    return ThreadingHTTPServer((host, port), RatesRequestHandler)
+
+
+def main():
+    import argparse
+
+    from capitalg.rates_loader import load_rates
+
+    parser = argparse.ArgumentParser(description='Serve a rates.csv file for calculate --rates_url')
+    parser.add_argument('rates_path', type=Path, help='Path to a rates.csv file')
+    parser.add_argument('--host', default='127.0.0.1', type=str)
+    parser.add_argument('--port', default=8765, type=int)
+    args = parser.parse_args()
+
+    server = make_rate_server(load_rates(args.rates_path), args.host, args.port)
+    host, port = server.server_address[:2]
+    print(f'Serving rates at http://{host}:{port}/')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,11 @@
 import csv
 from datetime import datetime
 from pathlib import Path
+from typing import Optional
 
 from capitalg.contstants import DATE_RATE_FORMAT
 from capitalg.errors import InputValidationError
+from capitalg.RatesStore import RatesStore
 
 
 def load_rates(input_path: Path) -> dict:
@@ -25,3 +27,22 @@ def load_rates(input_path: Path) -> dict:
             }
 
     return rates
+
+
+def load_rates_store(input_path: Path, cache_path: Optional[Path] = None) -> RatesStore:
+    """ Loads the rates file into a RatesStore.
+    If cache_path is given, the store is read from (or written to) a binary cache of the rates file,
+    which is rebuilt whenever the rates file changes
+    """
+    if input_path.exists() is False:
+        return RatesStore.from_rates({})
+
+    if cache_path is not None:
+        store = RatesStore.read_cache(cache_path, input_path)
+        if store is not None:
+            return store
+
+    store = RatesStore.from_rates(load_rates(input_path))
+    if cache_path is not None:
+        store.write_cache(cache_path, input_path)
+    return store
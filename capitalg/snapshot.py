@@ -0,0 +1,219 @@
+""" Snapshots of all cost base queues at a tax year cutoff.
+
+A later calculation can resume from a snapshot instead of replaying the whole history,
+provided the transactions before the snapshot's cutoff have not changed since it was taken.
+
+The spilled lots of SpillingCostBaseQueues are copied, still pickled, to a second file next to the snapshot
+(see spilled_lots_path), so saving and restoring a snapshot holds no more lots in memory than the queues do.
+"""
+import hashlib
+import itertools
+import logging
+import os
+import pickle
+from contextlib import nullcontext
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional
+
+from capitalg.CostBaseQueue import CostBaseQueue, QueueTypes
+from capitalg.SpillingCostBaseQueue import SpillingCostBaseQueue, read_chunk
+from capitalg.Transaction import Transaction
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 3
+
+# Output files are hashed in blocks of this many bytes
+_HASH_BLOCK_SIZE = 1 << 20
+
+
+class TransactionDigest:
+    """ Order sensitive hash of a stream of formatted transactions
+    """
+
+    def __init__(self):
+        self._hash = hashlib.sha256()
+        self.count = 0
+
+    def update(self, transaction: Transaction):
+        values = tuple(getattr(transaction, field) for field in Transaction.__slots__)
+        self._hash.update(repr(values).encode())
+        self.count += 1
+
+    def passthrough(self, transactions: Iterable[Transaction]) -> Iterator[Transaction]:
+        for transaction in transactions:
+            self.update(transaction)
+            yield transaction
+
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
+
+
+def file_prefix_digest(path: Path, size: int) -> str:
+    """ sha256 of the first size bytes of path
+    """
+    file_hash = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while size > 0:
+            block = f.read(min(size, _HASH_BLOCK_SIZE))
+            if not block:
+                break
+            file_hash.update(block)
+            size -= len(block)
+    return file_hash.hexdigest()
+
+
+def spilled_lots_path(snapshot_path: Path) -> Path:
+    return snapshot_path.with_name(snapshot_path.name + '.lots')
+
+
+def delete_snapshot(snapshot_path: Path):
+    """ Deletes the snapshot at snapshot_path, if there is one, and its spilled lots
+    """
+    for path in (snapshot_path, spilled_lots_path(snapshot_path)):
+        if path.exists():
+            path.unlink()
+
+
+def save_snapshot(snapshot_path: Path, settings: dict, cutoff_timestamp: int,
+                  digest: TransactionDigest, queues: Dict[str, CostBaseQueue], output_files: List[Path],
+                  result_row_counts: Optional[Dict[str, int]] = None, cost_base_id_count: int = 0):
+    """ settings are the calculation settings the queues depend on (e.g. queue type, tax currency)
+    The sizes and sha256 digests of output_files (which must be in the same folder as the snapshot) are recorded,
+    so a resumed calculation can check they haven't been rewritten since, and append to them.
+    Likewise result_row_counts, the row counts of a ResultStore, and cost_base_id_count, the number of deterministic cost base ids made (see cg_helpers.SequentialCostBaseIds)
+    """
+    # Each queue is saved as (lots before its spilled chunks, (offset, number of lots) of each chunk, lots after them)
+    lots_path = spilled_lots_path(snapshot_path)
+    lots_tmp_path = lots_path.with_name(lots_path.name + '.tmp')
+    with open(lots_tmp_path, 'wb') as f:
+        queue_states = {
+            asset_code: queue.dump(f) if isinstance(queue, SpillingCostBaseQueue) else (list(queue.get_queue), [], [])
+            for asset_code, queue in queues.items()
+        }
+    lots_size = lots_tmp_path.stat().st_size
+
+    snapshot = {
+        'version': SNAPSHOT_VERSION,
+        'settings': settings,
+        'cutoff_timestamp': cutoff_timestamp,
+        'digest': digest.hexdigest(),
+        'transaction_count': digest.count,
+        'output_sizes': {output_file.name: output_file.stat().st_size for output_file in output_files},
+        'output_digests': {
+            output_file.name: file_prefix_digest(output_file, output_file.stat().st_size) for output_file in output_files
+        },
+        'result_row_counts': result_row_counts or {},
+        'cost_base_id_count': cost_base_id_count,
+        'queues': queue_states,
+        'spilled_lots_size': lots_size,
+        'spilled_lots_digest': file_prefix_digest(lots_tmp_path, lots_size),
+    }
+
+    # Write then rename, so an interrupted write never leaves a truncated snapshot behind.
+    # If the spilled lots are replaced but the snapshot isn't, their digest no longer matches the old snapshot's
+    tmp_path = snapshot_path.with_name(snapshot_path.name + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+    if lots_size > 0:
+        os.replace(lots_tmp_path, lots_path)
+    else:
+        lots_tmp_path.unlink()
+    os.replace(tmp_path, snapshot_path)
+    if lots_size == 0 and lots_path.exists():
+        lots_path.unlink()
+
+
+def load_snapshot(snapshot_path: Path, settings: dict, cutoff_timestamp: int,
+                  result_row_counts: Optional[Dict[str, int]] = None) -> Optional[dict]:
+    """ Returns the snapshot at snapshot_path if it can be resumed from, otherwise None
+    result_row_counts are the current row counts of the ResultStore, if one is written to
+    """
+    if snapshot_path.exists() is False:
+        return None
+
+    try:
+        with open(snapshot_path, 'rb') as f:
+            snapshot = pickle.load(f)
+    except Exception as e:
+        logger.warning(f'Ignoring unreadable snapshot {snapshot_path}: {e}')
+        return None
+
+    if snapshot.get('version') != SNAPSHOT_VERSION or snapshot['settings'] != settings:
+        logger.warning(f'Ignoring snapshot {snapshot_path}, it was made with different settings')
+        return None
+
+    if snapshot['cutoff_timestamp'] > cutoff_timestamp:
+        logger.warning(f'Ignoring snapshot {snapshot_path}, it is later than the tax year end')
+        return None
+
+    snapshot['output_sizes'] = {
+        snapshot_path.parent / file_name: size for file_name, size in snapshot['output_sizes'].items()
+    }
+    for output_file, size in snapshot['output_sizes'].items():
+        # The files are only appended to after the snapshot, so their first size bytes must be unchanged
+        if (output_file.exists() is False or output_file.stat().st_size < size
+                or file_prefix_digest(output_file, size) != snapshot['output_digests'][output_file.name]):
+            logger.warning(f'Ignoring snapshot {snapshot_path}, output file {output_file} is missing or has changed')
+            return None
+
+    lots_path = spilled_lots_path(snapshot_path)
+    if snapshot['spilled_lots_size'] > 0 and (
+            lots_path.exists() is False or lots_path.stat().st_size != snapshot['spilled_lots_size']
+            or file_prefix_digest(lots_path, snapshot['spilled_lots_size']) != snapshot['spilled_lots_digest']):
+        logger.warning(f'Ignoring snapshot {snapshot_path}, its spilled lots {lots_path} are missing or have changed')
+        return None
+    snapshot['spilled_lots_path'] = lots_path
+
+    for table, count in snapshot.get('result_row_counts', {}).items():
+        if (result_row_counts or {}).get(table, 0) < count:
+            logger.warning(f'Ignoring snapshot {snapshot_path}, result table {table} is missing rows')
+            return None
+
+    return snapshot
+
+
+def resume_transactions(snapshot: dict, transactions: Iterable[Transaction],
+                        digest: TransactionDigest) -> Optional[Iterator[Transaction]]:
+    """ Consumes the (date ordered) transactions covered by the snapshot, adding them to digest.
+    Returns the transactions after the snapshot, or None if the transactions covered by the snapshot
+    are not the ones it was taken from (e.g. history was edited)
+    """
+    transactions = iter(transactions)
+    remaining = iter(())
+
+    for transaction in transactions:
+        if transaction.timestamp >= snapshot['cutoff_timestamp']:
+            remaining = itertools.chain([transaction], transactions)
+            break
+        digest.update(transaction)
+
+    if digest.count != snapshot['transaction_count'] or digest.hexdigest() != snapshot['digest']:
+        return None
+
+    return remaining
+
+
+def restore_queues(snapshot: dict, queue_type: QueueTypes,
+                   lot_buffer_size: Optional[int] = None) -> Dict[str, CostBaseQueue]:
+    """ Restores the snapshot's queues, and truncates its output files to their size when it was taken
+    If lot_buffer_size is given, the queues are SpillingCostBaseQueues, and spilled lots are read a chunk at a time
+    """
+    for output_file, size in snapshot['output_sizes'].items():
+        os.truncate(output_file, size)
+
+    queues = {}
+    with open(snapshot['spilled_lots_path'], 'rb') if snapshot['spilled_lots_size'] > 0 else nullcontext() as f:
+        for asset_code, (head, chunks, tail) in snapshot['queues'].items():
+            if lot_buffer_size is None:
+                queues[asset_code] = CostBaseQueue(queue_type)
+            else:
+                queues[asset_code] = SpillingCostBaseQueue(queue_type, lot_buffer_size)
+            for lot in head:
+                queues[asset_code].add_lot(lot)
+            for offset, _ in chunks:
+                for lot in read_chunk(f, offset):
+                    queues[asset_code].add_lot(lot)
+            for lot in tail:
+                queues[asset_code].add_lot(lot)
+    return queues
@@ -1,14 +1,65 @@
+import calendar
 from datetime import datetime, timedelta
+from functools import lru_cache
+from pathlib import Path
+from typing import Iterable, List, Optional
 
-import pytz
+from capitalg.contstants import DATE_INPUT_FORMAT, TAX_YEAR_INPUT_FORMAT
 
-from capitalg.contstants import TAX_YEAR_INPUT_FORMAT
+# Max number of (date_str, source_tz, dest_tz) conversions remembered by convert_timezone
+CONVERT_TIMEZONE_CACHE_SIZE = 2 ** 16
+# Max number of formatted timestamps remembered by format_timestamp
+FORMAT_TIMESTAMP_CACHE_SIZE = 2 ** 16
 
+EPOCH = datetime(1970, 1, 1)
 
+
+@lru_cache(maxsize=None)
+def get_timezone(tz: str):
+    # Imported on first use, so commands that never convert dates (e.g. summary) don't pay for importing pytz
+    import pytz
+    return pytz.timezone(tz)
+
+
+@lru_cache(maxsize=CONVERT_TIMEZONE_CACHE_SIZE)
 def convert_timezone(date_str: str, source_tz: str, dest_tz: str) -> datetime:
+    """ Memoised, since exchange exports often have many fills with the same timestamp
+    """
     dt = datetime.fromisoformat(date_str)
-    dt_source_tz = pytz.timezone(source_tz).localize(dt)
-    return dt_source_tz.astimezone(pytz.timezone(dest_tz))
+    dt_source_tz = get_timezone(source_tz).localize(dt)
+    return dt_source_tz.astimezone(get_timezone(dest_tz))
+
+
+def convert_timezones(date_strs: Iterable[str], source_tz: str, dest_tz: str) -> List[datetime]:
+    """ Converts a column of date strings that share the same source timezone.
+    Each distinct date string is only converted once.
+    """
+    source = get_timezone(source_tz)
+    dest = get_timezone(dest_tz)
+    converted = {}
+    dates = []
+    for date_str in date_strs:
+        dt = converted.get(date_str)
+        if dt is None:
+            dt = source.localize(datetime.fromisoformat(date_str)).astimezone(dest)
+            converted[date_str] = dt
+        dates.append(dt)
+    return dates
+
+def to_timestamp(dt: datetime) -> int:
+    """ Wall clock time of dt (in its own timezone) as whole seconds since 1970-01-01T00:00:00.
+    Unlike a POSIX timestamp, this ignores the UTC offset, so differences between timestamps
+    are the same as differences between the wall clock dates (e.g. across daylight saving changes)
+    """
+    return calendar.timegm(dt.timetuple())
+
+
+@lru_cache(maxsize=FORMAT_TIMESTAMP_CACHE_SIZE)
+def format_timestamp(timestamp: int, date_format: str = DATE_INPUT_FORMAT) -> str:
+    """ Inverse of to_timestamp
+    """
+    return (EPOCH + timedelta(seconds=timestamp)).strftime(date_format)
+
 
 def get_tax_year_cutoff_date(tax_year_end: str, tz: str, tax_year_end_format: str = TAX_YEAR_INPUT_FORMAT) -> datetime:
     """ Parse and localize the tax year's end date.
@@ -16,4 +67,20 @@ def get_tax_year_cutoff_date(tax_year_end: str, tz: str, tax_year_end_format: st
     This allows for easier date comparisons: All relevant transactions are less than this this cutoff date.
     """
     dt = datetime.strptime(tax_year_end, tax_year_end_format) + timedelta(days=1)
-    return pytz.timezone(tz).localize(dt)
+    return get_timezone(tz).localize(dt)
+
+
+def latest_file(paths: Iterable[Path]) -> Optional[Path]:
+    """ The most recently modified of the paths that exist (the last of them, if several were modified at the same time),
+    or None if none exist
+    """
+    latest = None
+    latest_mtime = None
+    for path in paths:
+        path = Path(path)
+        if path.exists() is False:
+            continue
+        mtime = path.stat().st_mtime_ns
+        if latest is None or mtime >= latest_mtime:
+            latest, latest_mtime = path, mtime
+    return latest
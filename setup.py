@@ -28,11 +28,11 @@ setuptools.setup(
     license = "GNU",
     long_description=long_description,
     long_description_content_type="text/markdown",
-    packages=setuptools.find_packages(exclude=["tests"]),
+    packages=setuptools.find_packages(exclude=["tests", "benchmarks"]),
     project_urls={
         "Bug Tracker": "https://github.com/dleber/capitalg/issues",
     },
     # https://docs.python.org/3/distutils/setupscript.html#listing-whole-packages
-    python_requires=">=3.6",
+    python_requires=">=3.7",
     url="https://github.com/dleber/capitalg",
 )
\ No newline at end of file
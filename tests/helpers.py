@@ -0,0 +1,31 @@
+from datetime import datetime
+from decimal import Decimal
+
+from capitalg.contstants import DATE_INPUT_FORMAT
+from capitalg.Transaction import Transaction
+from capitalg.utils import to_timestamp
+
+
+def timestamp(date: str) -> int:
+    return to_timestamp(datetime.strptime(date, DATE_INPUT_FORMAT))
+
+
+def make_transaction(**fields) -> Transaction:
+    """ Transaction with defaults for any fields a test doesn't care about
+    """
+    defaults = dict(
+        id='',
+        exchange='',
+        timestamp=0,
+        tz='UTC',
+        type='buy',
+        base_currency='usd',
+        asset_code='btc',
+        price=Decimal(0),
+        qty=Decimal(0),
+        fee_currency='usd',
+        fee=Decimal(0),
+        fee_unit=Decimal(0),
+        note='',
+    )
+    return Transaction(**{**defaults, **fields})
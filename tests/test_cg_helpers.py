@@ -2,49 +2,48 @@ import unittest
 from decimal import Decimal
 
 from capitalg.contstants import (
-    FIELD_FEE,
-    FIELD_FEE_UNIT,
     FIELD_CAPITAL_GAIN_LT,
     FIELD_CAPITAL_GAIN_TOTAL,
     FIELD_COST_BASE_AMOUNT,
-    FIELD_DATE,
-    FIELD_PRICE,
     FIELD_QTY
 )
 from capitalg import cg_helpers
+from capitalg.CostBaseQueue import Lot
+from tests.helpers import make_transaction, timestamp
 
 
 class TestCgHelpers(unittest.TestCase):
 
     def test_calculate_cg_transaction(self):
-        sale = {
-            FIELD_QTY: Decimal('0.7'),
-            FIELD_PRICE: Decimal('12000'),
-            FIELD_DATE: '2019-05-01T00:00:00',
-            FIELD_FEE: Decimal('10'),
-            FIELD_FEE_UNIT: Decimal('14.2'),
-        }
-        cost_base_transactions = [
-            {
-                FIELD_QTY: Decimal('0.4'),
-                FIELD_PRICE: Decimal('10000.00'),
-                FIELD_FEE_UNIT: Decimal('100'),
-                FIELD_DATE: '2018-05-01T00:00:00',  # note long term!
-            },
-            {
-                FIELD_QTY: Decimal('0.1'),
-                FIELD_PRICE: Decimal('12000.00'),
-                FIELD_FEE_UNIT: Decimal('100'),
-                FIELD_DATE: '2019-05-01T00:00:00',
-            },
-            {
-                FIELD_QTY: Decimal('0.2'),
-                FIELD_PRICE: Decimal('9000.00'),
-                FIELD_FEE_UNIT: Decimal('100'),
-                FIELD_DATE: '2019-05-01T00:00:00',
-            },
-
-        ]
+        sale = make_transaction(
+            type='sell',
+            qty=Decimal('0.7'),
+            price=Decimal('12000'),
+            timestamp=timestamp('2019-05-01T00:00:00'),
+            fee=Decimal('10'),
+            fee_unit=Decimal('14.2'),
+        )
+        cost_base_transactions = [Lot.from_transaction(cost) for cost in [
+            make_transaction(
+                qty=Decimal('0.4'),
+                price=Decimal('10000.00'),
+                fee_unit=Decimal('100'),
+                timestamp=timestamp('2018-05-01T00:00:00'),  # note long term!
+            ),
+            make_transaction(
+                qty=Decimal('0.1'),
+                price=Decimal('12000.00'),
+                fee_unit=Decimal('100'),
+                timestamp=timestamp('2019-05-01T00:00:00'),
+            ),
+            make_transaction(
+                qty=Decimal('0.2'),
+                price=Decimal('9000.00'),
+                fee_unit=Decimal('100'),
+                timestamp=timestamp('2019-05-01T00:00:00'),
+            ),
+
+        ]]
 
         cg = cg_helpers.calculate_cg_transaction(sale, cost_base_transactions)
         self.assertEqual(cg[FIELD_QTY], Decimal('0.7'))
@@ -75,14 +74,24 @@ class TestCgHelpers(unittest.TestCase):
 
     def test_is_long_term(self):
         self.assertFalse(cg_helpers.is_long_term(
-            '2019-05-01T00:00:00', '2019-04-01T00:00:00'))
+            timestamp('2019-05-01T00:00:00'), timestamp('2019-04-01T00:00:00')))
         self.assertTrue(cg_helpers.is_long_term(
-            '2019-05-01T00:00:00', '2018-04-01T00:00:00'))
+            timestamp('2019-05-01T00:00:00'), timestamp('2018-04-01T00:00:00')))
         self.assertTrue(cg_helpers.is_long_term(
-            '2019-05-01T00:00:00', '2018-05-01T00:00:00'))
+            timestamp('2019-05-01T00:00:00'), timestamp('2018-05-01T00:00:00')))
         self.assertFalse(cg_helpers.is_long_term(
-            '2019-05-01T00:00:00', '2018-05-02T00:00:00'))
+            timestamp('2019-05-01T00:00:00'), timestamp('2018-05-01T00:00:01')))
+
+
+    def test_sequential_cost_base_ids(self):
+        ids = cg_helpers.SequentialCostBaseIds()
+        first = [ids() for _ in range(3)]
+        self.assertEqual(len(set(first)), 3)
+        self.assertEqual(ids.count, 3)
 
+        # The same sequence always makes the same ids, and can be continued from a count
+        self.assertEqual(cg_helpers.SequentialCostBaseIds()(), first[0])
+        self.assertEqual(cg_helpers.SequentialCostBaseIds(start=2)(), first[2])
 
 if __name__ == '__main__':
     unittest.main()
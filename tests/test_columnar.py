@@ -0,0 +1,74 @@
+import tempfile
+import unittest
+from decimal import Decimal
+from pathlib import Path
+
+from capitalg.columnar import TYPE_DECIMAL, TYPE_STR, ColumnarReader, ColumnarWriter, columnar_path, latest_output
+
+
+SCHEMA = [('asset_code', TYPE_STR), ('qty', TYPE_DECIMAL), ('note', TYPE_STR)]
+
+
+class TestColumnar(unittest.TestCase):
+
+    def test_round_trip(self):
+        rows = [
+            ('btc', Decimal('0.50'), ''),
+            ('eth', Decimal('-1E+3'), 'comma, "quote" and\nnew line'),
+            ('ltc', 0, 'ünïcödé'),
+        ]
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = Path(tempdir, 'test.cgcol')
+            with ColumnarWriter(path, SCHEMA) as writer:
+                writer.write_rows(rows[:2])
+                writer.write_rows([])
+                writer.write_rows(rows[2:])
+
+            reader = ColumnarReader(path)
+            self.assertEqual(reader.columns, ['asset_code', 'qty', 'note'])
+            self.assertEqual(reader.num_rows, 3)
+            self.assertEqual(len(reader.row_groups), 2)
+
+            result = list(reader.read_columns(['qty', 'asset_code']))
+            self.assertEqual([str(qty) for qty, _ in result], ['0.50', '-1E+3', '0'])
+            self.assertIsInstance(result[0][0], Decimal)
+            self.assertEqual(list(reader.read_column('note')), [row[2] for row in rows])
+
+            with self.assertRaises(KeyError):
+                list(reader.read_columns(['price']))
+
+    def test_append(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = Path(tempdir, 'test.cgcol')
+            with ColumnarWriter(path, SCHEMA) as writer:
+                writer.write_rows([('btc', Decimal('1'), 'a')])
+
+            with ColumnarWriter(path, SCHEMA, append=True) as writer:
+                writer.write_rows([('eth', Decimal('2'), 'b')])
+
+            self.assertEqual(list(ColumnarReader(path).read_column('asset_code')), ['btc', 'eth'])
+
+            with self.assertRaises(ValueError):
+                ColumnarWriter(path, SCHEMA[:2], append=True)
+
+            # A file that was never closed has no footer
+            writer = ColumnarWriter(path, SCHEMA)
+            writer.handler.close()
+            with self.assertRaises(ValueError):
+                ColumnarReader(path)
+
+    def test_latest_output(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            csv_path = Path(tempdir, 'cg_events.csv')
+            self.assertEqual(latest_output(csv_path), csv_path)
+
+            csv_path.write_text('')
+            self.assertEqual(latest_output(csv_path), csv_path)
+
+            columnar_path(csv_path).write_text('')
+            self.assertEqual(latest_output(csv_path), Path(tempdir, 'cg_events.cgcol'))
+
+
+if __name__ == '__main__':
+    unittest.main()
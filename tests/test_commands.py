@@ -0,0 +1,55 @@
+import subprocess
+import sys
+import unittest
+
+import capitalg
+import capitalg.analysis as analysis
+from capitalg.main import calculate_cg
+
+
+def imported_modules(code: str) -> set:
+    """ The modules imported by code, in a fresh interpreter
+    """
+    result = subprocess.run(
+        [sys.executable, '-c', f'import sys; {code}; print(" ".join(sys.modules))'],
+        capture_output=True, text=True, check=True,
+    )
+    return set(result.stdout.split())
+
+
+class TestCommands(unittest.TestCase):
+
+    def test_lazy_imports(self):
+        # The calculation isn't imported until the calculate subcommand runs
+        modules = imported_modules('import capitalg.commands')
+        for module in ('pytz', 'sqlite3', 'decimal', 'capitalg.main', 'capitalg.TransactionLoader', 'capitalg.analysis.summary'):
+            self.assertNotIn(module, modules)
+
+        # Summaries don't need the calculation or balances
+        modules = imported_modules('from capitalg.analysis import cg_summary')
+        for module in ('pytz', 'sqlite3', 'capitalg.main', 'capitalg.analysis.balance'):
+            self.assertNotIn(module, modules)
+
+    def test_cg_invalid_options(self):
+        # Invalid combinations are reported as usage errors, before anything is calculated
+        required = ['-c', 'aud', '-d', '2021-06-30']
+        for options in (['-q', 'fifo', '--pipelined', '--profile'], ['-q', 'hifo', '--lot_buffer_size', '3'],
+                        ['-q', 'fifo', '--lot_buffer_size', '3', '-w', '2']):
+            result = subprocess.run(
+                [sys.executable, '-m', 'capitalg.commands', 'calculate', *required, *options],
+                capture_output=True, text=True,
+            )
+            self.assertEqual(result.returncode, 2)
+            self.assertIn('capitalg calculate: error:', result.stderr)
+            self.assertNotIn('Traceback', result.stderr)
+
+    def test_lazy_exports(self):
+        self.assertIs(capitalg.calculate_cg, calculate_cg)
+        self.assertEqual(analysis.get_balance.__module__, 'capitalg.analysis.balance')
+        self.assertEqual(analysis.cg_rollup.__module__, 'capitalg.analysis.summary')
+        with self.assertRaises(AttributeError):
+            analysis.missing
+
+
+if __name__ == '__main__':
+    unittest.main()
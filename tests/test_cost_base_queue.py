@@ -1,251 +1,247 @@
 from decimal import Decimal
+import random
 import unittest
 
 from capitalg.CostBaseQueue import CostBaseQueue, QueueTypes
+from tests.helpers import make_transaction, timestamp
 
 
 class TestCostBaseQueue(unittest.TestCase):
 
+    @staticmethod
+    def _to_tuples(lots):
+        return [(lot.qty, lot.price, lot.transaction.id) for lot in lots]
+
     def test_add_queue(self):
-        row1 = {
-            'qty': Decimal('0.5'),
-            'price': Decimal('6000.1'),
-            'brokerage': Decimal('2')
-        }
-
-        row2 = {
-            'qty': Decimal('0.4'),
-            'price': Decimal('7000.56'),
-            'brokerage': Decimal('4')
-        }
+        row1 = make_transaction(
+            qty=Decimal('0.5'),
+            price=Decimal('6000.1'),
+            fee=Decimal('2'),
+        )
+
+        row2 = make_transaction(
+            qty=Decimal('0.4'),
+            price=Decimal('7000.56'),
+            fee=Decimal('4'),
+        )
 
         cbq = CostBaseQueue(queue_type=QueueTypes.FIFO)
         cbq.add(row1)
         cbq.add(row2)
-        self.assertEqual(cbq.queue, [row1, row2])
+        self.assertEqual([lot.transaction for lot in cbq.get_queue], [row1, row2])
 
     def test_fifo_big_purchase_small_sale(self):
         # test fifo where entire queue is empty at the end
 
         # test query 1st transaction qty really big and small sale
         cbq = CostBaseQueue(queue_type='FIFO')
-        cbq.add({
-            'qty': Decimal('100.4'),
-            'price': Decimal('2000'),
-            'id': 'abc213',
-        })
+        cbq.add(make_transaction(qty=Decimal('100.4'), price=Decimal('2000'), id='abc213'))
 
         result = cbq.get_transactions(Decimal('20.1'))
-        self.assertEqual(result, [
-            {
-                'qty': Decimal('20.1'),
-                'price': Decimal('2000'),
-                'id': 'abc213',
-            },
+        self.assertEqual(self._to_tuples(result), [
+            (Decimal('20.1'), Decimal('2000'), 'abc213'),
         ])
 
-        self.assertEqual(cbq.queue, [
-            {
-                'qty': Decimal('80.3'),
-                'price': Decimal('2000'),
-                'id': 'abc213',
-            },
+        self.assertEqual(self._to_tuples(cbq.get_queue), [
+            (Decimal('80.3'), Decimal('2000'), 'abc213'),
         ])
 
         result = cbq.get_transactions(Decimal('80.3'))
-        self.assertEqual(result, [
-            {
-                'qty': Decimal('80.3'),
-                'price': Decimal('2000'),
-                'id': 'abc213',
-            },
+        self.assertEqual(self._to_tuples(result), [
+            (Decimal('80.3'), Decimal('2000'), 'abc213'),
         ])
 
-        self.assertEqual(cbq.queue, [])
+        self.assertEqual(self._to_tuples(cbq.get_queue), [])
 
     def test_fifo_small_purchase_big_sale(self):
         cbq = CostBaseQueue(queue_type=QueueTypes.FIFO)
-        cbq.add({
-            'qty': Decimal('10.22'),
-            'price': Decimal('2000'),
-            'id': 'abc111',
-        })
-        cbq.add({
-            'qty': Decimal('10.22'),
-            'price': Decimal('2000'),
-            'id': 'abc222',
-        })
-        cbq.add({
-            'qty': Decimal('10.22'),
-            'price': Decimal('2000'),
-            'id': 'abc333',
-        })
-        cbq.add({
-            'qty': Decimal('10.22'),
-            'price': Decimal('2000'),
-            'id': 'abc444',
-        })
+        cbq.add(make_transaction(qty=Decimal('10.22'), price=Decimal('2000'), id='abc111'))
+        cbq.add(make_transaction(qty=Decimal('10.22'), price=Decimal('2000'), id='abc222'))
+        cbq.add(make_transaction(qty=Decimal('10.22'), price=Decimal('2000'), id='abc333'))
+        cbq.add(make_transaction(qty=Decimal('10.22'), price=Decimal('2000'), id='abc444'))
 
         result = cbq.get_transactions(Decimal('30'))
-        self.assertEqual(result, [
-            {
-                'qty': Decimal('10.22'),
-                'price': Decimal('2000'),
-                'id': 'abc111',
-            },
-            {
-                'qty': Decimal('10.22'),
-                'price': Decimal('2000'),
-                'id': 'abc222',
-            },
-            {
-                'qty': Decimal('9.56'),
-                'price': Decimal('2000'),
-                'id': 'abc333',
-            },
+        self.assertEqual(self._to_tuples(result), [
+            (Decimal('10.22'), Decimal('2000'), 'abc111'),
+            (Decimal('10.22'), Decimal('2000'), 'abc222'),
+            (Decimal('9.56'), Decimal('2000'), 'abc333'),
         ])
 
         result = cbq.get_transactions(Decimal('10.88'))
-        self.assertEqual(result, [
-            {
-                'qty': Decimal('0.66'),
-                'price': Decimal('2000'),
-                'id': 'abc333',
-            },
-            {
-                'qty': Decimal('10.22'),
-                'price': Decimal('2000'),
-                'id': 'abc444',
-            },
+        self.assertEqual(self._to_tuples(result), [
+            (Decimal('0.66'), Decimal('2000'), 'abc333'),
+            (Decimal('10.22'), Decimal('2000'), 'abc444'),
         ])
 
-        self.assertEqual(cbq.queue, [])
+        self.assertEqual(self._to_tuples(cbq.get_queue), [])
 
     def test_fifo_unsold(self):
         # The queue returns what it has and depletes
         # Separate validation steps need to detect this
         cbq = CostBaseQueue(queue_type=QueueTypes.FIFO)
-        cbq.add({
-            'qty': Decimal('10.22'),
-            'price': Decimal('2000'),
-            'id': 'abc111',
-        })
+        cbq.add(make_transaction(qty=Decimal('10.22'), price=Decimal('2000'), id='abc111'))
 
         result = cbq.get_transactions(Decimal('20'))
-        self.assertEqual(result, [{
-            'qty': Decimal('10.22'),
-            'price': Decimal('2000'),
-            'id': 'abc111',
-        }])
+        self.assertEqual(self._to_tuples(result), [
+            (Decimal('10.22'), Decimal('2000'), 'abc111'),
+        ])
 
-        self.assertEqual(cbq.queue, [])
+        self.assertEqual(self._to_tuples(cbq.get_queue), [])
 
     def test_lifo_big_purchase_small_sale(self):
         # test fifo where entire queue is empty at the end
 
         # test query 1st transaction qty really big and small sale
         cbq = CostBaseQueue(queue_type=QueueTypes.LIFO)
-        cbq.add({
-            'qty': Decimal('100.4'),
-            'price': Decimal('2000'),
-            'id': 'abc213',
-        })
+        cbq.add(make_transaction(qty=Decimal('100.4'), price=Decimal('2000'), id='abc213'))
 
         result = cbq.get_transactions(sale_qty=Decimal('20.1'))
-        self.assertEqual(result, [
-            {
-                'qty': Decimal('20.1'),
-                'price': Decimal('2000'),
-                'id': 'abc213',
-            },
+        self.assertEqual(self._to_tuples(result), [
+            (Decimal('20.1'), Decimal('2000'), 'abc213'),
         ])
 
-        self.assertEqual(cbq.queue, [
-            {
-                'qty': Decimal('80.3'),
-                'price': Decimal('2000'),
-                'id': 'abc213',
-            },
+        self.assertEqual(self._to_tuples(cbq.get_queue), [
+            (Decimal('80.3'), Decimal('2000'), 'abc213'),
         ])
 
         result = cbq.get_transactions(Decimal('80.3'))
 
-        self.assertEqual(result, [
-            {
-                'qty': Decimal('80.3'),
-                'price': Decimal('2000'),
-                'id': 'abc213',
-            },
+        self.assertEqual(self._to_tuples(result), [
+            (Decimal('80.3'), Decimal('2000'), 'abc213'),
         ])
 
-        self.assertEqual(cbq.queue, [])
+        self.assertEqual(self._to_tuples(cbq.get_queue), [])
 
     def test_lifo_small_purchase_big_sale(self):
         cbq = CostBaseQueue(queue_type=QueueTypes.LIFO)
-        cbq.add({
-            'qty': Decimal('4.22'),
-            'price': Decimal('2000'),
-            'id': 'abc111',
-        })
-        cbq.add({
-            'qty': Decimal('6.22'),
-            'price': Decimal('2000'),
-            'id': 'abc222',
-        })
-        cbq.add({
-            'qty': Decimal('10.22'),
-            'price': Decimal('2000'),
-            'id': 'abc333',
-        })
+        cbq.add(make_transaction(qty=Decimal('4.22'), price=Decimal('2000'), id='abc111'))
+        cbq.add(make_transaction(qty=Decimal('6.22'), price=Decimal('2000'), id='abc222'))
+        cbq.add(make_transaction(qty=Decimal('10.22'), price=Decimal('2000'), id='abc333'))
 
         result = cbq.get_transactions(Decimal('18'))
-        self.assertEqual(result, [
-            {
-                'qty': Decimal('10.22'),
-                'price': Decimal('2000'),
-                'id': 'abc333',
-            },
-            {
-                'qty': Decimal('6.22'),
-                'price': Decimal('2000'),
-                'id': 'abc222',
-            },
-            {
-                'qty': Decimal('1.56'),
-                'price': Decimal('2000'),
-                'id': 'abc111',
-            },
+        self.assertEqual(self._to_tuples(result), [
+            (Decimal('10.22'), Decimal('2000'), 'abc333'),
+            (Decimal('6.22'), Decimal('2000'), 'abc222'),
+            (Decimal('1.56'), Decimal('2000'), 'abc111'),
         ])
 
         result = cbq.get_transactions(Decimal('2.66'))
-        self.assertEqual(result, [
-            {
-                'qty': Decimal('2.66'),
-                'price': Decimal('2000'),
-                'id': 'abc111',
-            },
+        self.assertEqual(self._to_tuples(result), [
+            (Decimal('2.66'), Decimal('2000'), 'abc111'),
         ])
 
-        self.assertEqual(cbq.queue, [])
+        self.assertEqual(self._to_tuples(cbq.get_queue), [])
 
     def test_lifo_unsold(self):
         # The queue returns what it has and depletes
         # Separate validation steps need to detect this
         cbq = CostBaseQueue(queue_type=QueueTypes.LIFO)
-        cbq.add({
-            'qty': Decimal('10.22'),
-            'price': Decimal('2000'),
-            'id': 'abc111',
-        })
+        cbq.add(make_transaction(qty=Decimal('10.22'), price=Decimal('2000'), id='abc111'))
 
         result = cbq.get_transactions(Decimal('20'))
-        self.assertEqual(result, [{
-            'qty': Decimal('10.22'),
-            'price': Decimal('2000'),
-            'id': 'abc111',
-        }])
+        self.assertEqual(self._to_tuples(result), [
+            (Decimal('10.22'), Decimal('2000'), 'abc111'),
+        ])
 
-        self.assertEqual(cbq.queue, [])
+        self.assertEqual(self._to_tuples(cbq.get_queue), [])
+
+    def test_lots_reference_transaction(self):
+        transaction = make_transaction(
+            qty=Decimal('3'),
+            price=Decimal('2000'),
+            fee_unit=Decimal('1.5'),
+            timestamp=timestamp('2019-04-05T00:00:00'),
+            id='abc111',
+        )
+        cbq = CostBaseQueue(queue_type=QueueTypes.FIFO)
+        cbq.add(transaction)
+        lot = cbq.get_queue[0]
+
+        # Partially consumed lots stay in the queue, the consumed qty is returned as a new lot
+        partial, = cbq.get_transactions(Decimal('1'))
+        self.assertIsNot(partial, lot)
+        self.assertEqual(partial.qty, Decimal('1'))
+        self.assertEqual(lot.qty, Decimal('2'))
+        self.assertEqual(
+            (partial.price, partial.fee_unit, partial.timestamp),
+            (Decimal('2000'), Decimal('1.5'), timestamp('2019-04-05T00:00:00'))
+        )
+        self.assertEqual(partial.to_dict()['qty'], Decimal('1'))
+        self.assertEqual(partial.to_dict()['date'], '2019-04-05T00:00:00')
+
+        # Fully consumed lots are returned without copying
+        full, = cbq.get_transactions(Decimal('2'))
+        self.assertIs(full, lot)
+
+        # The source transaction is never copied or modified
+        self.assertIs(partial.transaction, transaction)
+        self.assertIs(full.transaction, transaction)
+        self.assertEqual(transaction.qty, Decimal('3'))
+
+    def test_hifo_lofo(self):
+        for queue_type, expected in (
+            (QueueTypes.HIFO, [
+                (Decimal('2'), Decimal('3000'), 'abc222'),
+                (Decimal('1'), Decimal('2000'), 'abc333'),
+                (Decimal('0.5'), Decimal('1999'), 'abc444'),
+            ]),
+            (QueueTypes.LOFO, [
+                (Decimal('1'), Decimal('1000'), 'abc111'),
+                (Decimal('2'), Decimal('2000'), 'abc333'),
+                (Decimal('0.5'), Decimal('1999'), 'abc444'),
+            ]),
+        ):
+            cbq = CostBaseQueue(queue_type=queue_type)
+            cbq.add(make_transaction(qty=Decimal('1'), price=Decimal('1000'), id='abc111'))
+            cbq.add(make_transaction(qty=Decimal('2'), price=Decimal('3000'), id='abc222'))
+            # Equal unit costs are consumed first in, first out. Unit cost includes the fee per unit
+            cbq.add(make_transaction(qty=Decimal('1' if queue_type == QueueTypes.HIFO else '2'), price=Decimal('2000'), id='abc333'))
+            cbq.add(make_transaction(qty=Decimal('1'), price=Decimal('1999'), fee_unit=Decimal('1'), id='abc444'))
+
+            result = cbq.get_transactions(Decimal('3.5'))
+            self.assertEqual(self._to_tuples(result), expected)
+
+            # The open lots are in the order they were added, with the partially consumed lot's qty reduced
+            self.assertEqual(self._to_tuples(cbq.get_queue)[-1], (Decimal('0.5'), Decimal('1999'), 'abc444'))
+            self.assertEqual(len(cbq), 2)
+
+    def test_hifo_lofo_random(self):
+        # Same lots as scanning every open lot for the highest or lowest unit cost
+        rng = random.Random(0)
+        for queue_type in (QueueTypes.HIFO, QueueTypes.LOFO):
+            cbq = CostBaseQueue(queue_type=queue_type)
+            open_lots = []
+            for i in range(500):
+                if rng.random() < 0.6 or not open_lots:
+                    transaction = make_transaction(
+                        qty=Decimal(rng.randrange(1, 10)),
+                        price=Decimal(rng.randrange(1, 50)),
+                        fee_unit=Decimal(rng.randrange(0, 3)),
+                        id=str(i),
+                    )
+                    cbq.add(transaction)
+                    open_lots.append([transaction.qty, transaction])
+                    continue
+
+                expected = []
+                sale_qty = qty = Decimal(rng.randrange(1, 15))
+                while open_lots:
+                    unit_costs = [lot[1].price + lot[1].fee_unit for lot in open_lots]
+                    best = (max if queue_type == QueueTypes.HIFO else min)(unit_costs)
+                    lot = open_lots[unit_costs.index(best)]
+                    if qty < lot[0]:
+                        expected.append((qty, lot[1].id))
+                        lot[0] -= qty
+                        break
+                    qty -= lot[0]
+                    expected.append((lot[0], lot[1].id))
+                    open_lots.remove(lot)
+
+                result = cbq.get_transactions(sale_qty)
+                self.assertEqual([(lot.qty, lot.transaction.id) for lot in result], expected)
+
+            self.assertEqual([(lot.qty, lot.transaction.id) for lot in cbq.get_queue],
+                             [(lot_qty, transaction.id) for lot_qty, transaction in open_lots])
 
 
 if __name__ == '__main__':
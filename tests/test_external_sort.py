@@ -0,0 +1,57 @@
+import random
+import unittest
+from operator import itemgetter
+from unittest import mock
+
+from capitalg import external_sort as es
+
+
+class TestExternalSort(unittest.TestCase):
+
+    def test_sort_in_memory(self):
+        rows = [3, 1, 2]
+        self.assertEqual(list(es.external_sort(rows, key=None, buffer_size=10)), [1, 2, 3])
+        self.assertEqual(list(es.external_sort([], key=None, buffer_size=10)), [])
+
+    def test_sort_spills_runs(self):
+        random.seed(7)
+        rows = [{'date': random.randint(0, 50), 'id': i} for i in range(2500)]
+
+        # Stable, i.e. same order as sorted()
+        expected = sorted(rows, key=itemgetter('date'))
+        for buffer_size in (1, 7, 1000, 1250, 2499, 2500):
+            result = list(es.external_sort(rows, key=itemgetter('date'), buffer_size=buffer_size))
+            self.assertEqual(result, expected)
+
+    def test_sort_memory_bound(self):
+        read = 0
+
+        def rows():
+            nonlocal read
+            for i in range(100, 0, -1):
+                read += 1
+                yield i
+
+        # Rows read but not yet spilled, each time a run is spilled
+        spilled = 0
+        held = []
+        spill_run = es._spill_run
+
+        def record_spill(run, temp_dir):
+            nonlocal spilled
+            held.append(read - spilled)
+            spilled += len(run)
+            return spill_run(run, temp_dir)
+
+        with mock.patch.object(es, '_spill_run', record_spill):
+            self.assertEqual(list(es.external_sort(rows(), key=None, buffer_size=10)), list(range(1, 101)))
+        self.assertEqual(len(held), 10)
+        self.assertLessEqual(max(held), 11)
+
+    def test_invalid_buffer_size(self):
+        with self.assertRaises(ValueError):
+            list(es.external_sort([1], key=None, buffer_size=0))
+
+
+if __name__ == '__main__':
+    unittest.main()
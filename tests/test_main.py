@@ -1,11 +1,24 @@
 import csv
+import itertools
 import shutil
 import unittest
+from decimal import Decimal, InvalidOperation
 from pathlib import Path
 from tempfile import TemporaryDirectory
+from unittest import mock
 
 import capitalg.contstants as contstants
+from capitalg.analysis import cg_rollup, cg_summary, get_balance
+from capitalg.columnar import ColumnarReader, columnar_path
 from capitalg.main import calculate_cg
+from capitalg.Profiler import Profiler
+from capitalg.rate_providers import SqliteRateProvider, write_rates_db
+from capitalg.rates_loader import load_rates
+from capitalg.ResultStore import TABLE_CG_EVENTS, TABLE_COST_BASE, TABLE_UNALLOCATED_COST_BASE, ResultStore
+from capitalg.snapshot import restore_queues, spilled_lots_path
+from capitalg.SpillingCostBaseQueue import SpillingCostBaseQueue
+from capitalg.Writer import output_paths
+
 
 class TestMain(unittest.TestCase):
 
@@ -89,6 +102,461 @@ class TestMain(unittest.TestCase):
             self.assertEqual(
                 rows[2][contstants.FIELD_CAPITAL_GAIN_TOTAL], '-20.70')
 
+    def test_main_cg_streaming(self):
+
+        outputs = []
+        for streaming in (False, True):
+            with TemporaryDirectory() as tempdir:
+
+                shutil.copyfile('tests/fixtures/transactions.csv', f'{tempdir}/transactions.csv')
+
+                calculate_cg(
+                    Path(tempdir),
+                    'usd',
+                    'fifo',
+                    'UTC',
+                    '2019-06-30',
+                    streaming=streaming,
+                    sort_buffer_size=2,
+                )
+
+                with open(f'{tempdir}/{contstants.FILE_CG_EVENTS}') as csvfile:
+                    reader = csv.DictReader(csvfile)
+                    rows = [row for row in reader]
+
+                with open(f'{tempdir}/{contstants.FILE_FORMATTED_TRANSACTIONS}') as f:
+                    formatted_transactions = f.read()
+
+                for row in rows:
+                    del row[contstants.FIELD_COST_BASE_ID]
+                outputs.append((rows, formatted_transactions))
+
+        self.assertEqual(outputs[0], outputs[1])
+
+    def test_main_cg_workers(self):
+        output_files = (
+            contstants.FILE_CG_EVENTS,
+            contstants.FILE_COST_BASE_TRANSACTION,
+            contstants.FILE_UNALLOCATED_COST_BASE_TRANSACTION,
+        )
+
+        for queue_type_code in ('fifo', 'lifo'):
+            outputs = []
+            for workers in (1, 3):
+                with TemporaryDirectory() as tempdir:
+
+                    shutil.copyfile('tests/fixtures/transactions.csv', f'{tempdir}/transactions.csv')
+
+                    # Cost base ids are random, so number them for comparison
+                    ids = (str(i) for i in itertools.count())
+                    with mock.patch('capitalg.cg_helpers.make_cost_base_id', side_effect=lambda: next(ids)):
+                        calculate_cg(
+                            Path(tempdir),
+                            'usd',
+                            queue_type_code,
+                            'UTC',
+                            '2019-06-30',
+                            workers=workers,
+                        )
+
+                    outputs.append([Path(tempdir, f).read_bytes() for f in output_files])
+
+            self.assertEqual(outputs[0], outputs[1])
+
+    def _calculate_with_numbered_ids(self, file_dir, tax_year_end, **kwargs):
+        """ Cost base ids are random, so number them for comparison. Returns the contents of the output files
+        """
+        ids = (str(i) for i in itertools.count())
+        with mock.patch('capitalg.cg_helpers.make_cost_base_id', side_effect=lambda: next(ids)):
+            calculate_cg(Path(file_dir), 'usd', 'fifo', 'UTC', tax_year_end, **kwargs)
+
+        return [
+            Path(file_dir, f).read_bytes()
+            for f in (
+                contstants.FILE_CG_EVENTS,
+                contstants.FILE_COST_BASE_TRANSACTION,
+                contstants.FILE_UNALLOCATED_COST_BASE_TRANSACTION,
+            )
+        ]
+
+    def test_main_cg_incremental(self):
+        with TemporaryDirectory() as full_dir, TemporaryDirectory() as incremental_dir:
+            for tempdir in (full_dir, incremental_dir):
+                shutil.copyfile('tests/fixtures/transactions.csv', f'{tempdir}/transactions.csv')
+
+            expected = self._calculate_with_numbered_ids(full_dir, '2019-06-30')
+
+            # The first run has no snapshot to resume from, the btc sale is after its tax year end
+            self._calculate_with_numbered_ids(incremental_dir, '2019-04-06', incremental=True)
+            self.assertTrue(Path(incremental_dir, contstants.FILE_QUEUE_SNAPSHOT).exists())
+
+            with mock.patch('capitalg.main.restore_queues', wraps=restore_queues) as restore:
+                # Cost base ids continue from the first run, which had no cg events
+                result = self._calculate_with_numbered_ids(incremental_dir, '2019-06-30', incremental=True)
+                restore.assert_called_once()
+            self.assertEqual(result, expected)
+
+            # Resuming from a snapshot at the same tax year end doesn't change the output
+            result = self._calculate_with_numbered_ids(incremental_dir, '2019-06-30', incremental=True)
+            self.assertEqual(result, expected)
+
+            # Editing history before the snapshot replays the full history
+            for tempdir in (full_dir, incremental_dir):
+                transactions = Path(tempdir, 'transactions.csv')
+                transactions.write_text(transactions.read_text().replace(',9000,', ',8000,'))
+
+            expected = self._calculate_with_numbered_ids(full_dir, '2019-06-30')
+            with mock.patch('capitalg.main.restore_queues', wraps=restore_queues) as restore:
+                result = self._calculate_with_numbered_ids(incremental_dir, '2019-06-30', incremental=True, streaming=True)
+                restore.assert_not_called()
+            self.assertEqual(result, expected)
+
+    def test_main_cg_incremental_outputs_rewritten(self):
+        for output_format in (contstants.OUTPUT_FORMAT_CSV, contstants.OUTPUT_FORMAT_BOTH):
+            with TemporaryDirectory() as full_dir, TemporaryDirectory() as incremental_dir:
+                for tempdir in (full_dir, incremental_dir):
+                    shutil.copyfile('tests/fixtures/transactions.csv', f'{tempdir}/transactions.csv')
+                expected = self._calculate_with_numbered_ids(full_dir, '2019-06-30', output_format=output_format)
+
+                # A non-incremental run rewrites the output files, so the snapshot can't be resumed from
+                self._calculate_with_numbered_ids(incremental_dir, '2019-04-07', incremental=True, output_format=output_format)
+                self._calculate_with_numbered_ids(incremental_dir, '2019-06-30', output_format=output_format)
+                self.assertFalse(Path(incremental_dir, contstants.FILE_QUEUE_SNAPSHOT).exists())
+
+                with mock.patch('capitalg.main.restore_queues', wraps=restore_queues) as restore:
+                    result = self._calculate_with_numbered_ids(incremental_dir, '2019-06-30', incremental=True,
+                                                               output_format=output_format)
+                    restore.assert_not_called()
+                self.assertEqual(result, expected)
+
+                # Output files rewritten some other way, but no shorter, aren't resumed from either
+                self._calculate_with_numbered_ids(incremental_dir, '2019-04-07', incremental=True, output_format=output_format)
+                for output_file in output_paths(Path(incremental_dir, contstants.FILE_CG_EVENTS), output_format):
+                    content = output_file.read_bytes()
+                    output_file.write_bytes(content[:-1] + bytes([content[-1] ^ 1]))
+                with mock.patch('capitalg.main.restore_queues', wraps=restore_queues) as restore:
+                    self._calculate_with_numbered_ids(incremental_dir, '2019-06-30', incremental=True,
+                                                      output_format=output_format)
+                    restore.assert_not_called()
+
+    def test_main_cg_columnar(self):
+        output_files = (contstants.FILE_CG_EVENTS, contstants.FILE_COST_BASE_TRANSACTION)
+
+        def read_columnar(file_dir):
+            rows = []
+            for f in output_files:
+                reader = ColumnarReader(columnar_path(Path(file_dir, f)))
+                rows.append([tuple(str(value) for value in row) for row in reader.read_columns(reader.columns)])
+            return rows
+
+        with TemporaryDirectory() as full_dir, TemporaryDirectory() as incremental_dir:
+            for tempdir in (full_dir, incremental_dir):
+                shutil.copyfile('tests/fixtures/transactions.csv', f'{tempdir}/transactions.csv')
+
+            expected = self._calculate_with_numbered_ids(full_dir, '2019-06-30', output_format='both')
+
+            # Columnar files hold the same rows as the CSV files
+            for f, rows in zip(output_files, read_columnar(full_dir)):
+                with open(Path(full_dir, f)) as csvfile:
+                    self.assertEqual(rows, [tuple(row) for row in list(csv.reader(csvfile))[1:]])
+
+            # Resuming from a snapshot appends to the columnar files
+            self._calculate_with_numbered_ids(incremental_dir, '2019-04-06', incremental=True, output_format='both')
+            result = self._calculate_with_numbered_ids(incremental_dir, '2019-06-30', incremental=True, output_format='both')
+            self.assertEqual(result, expected)
+            self.assertEqual(read_columnar(incremental_dir), read_columnar(full_dir))
+
+            self.assertEqual(
+                cg_summary(Path(full_dir, contstants.FILE_CG_EVENTS), '2019-06-30'),
+                cg_summary(columnar_path(Path(full_dir, contstants.FILE_CG_EVENTS)), '2019-06-30'),
+            )
+
+    def test_main_cg_sqlite(self):
+        def read_tables(file_dir):
+            with ResultStore(Path(file_dir, contstants.FILE_RESULTS_DB)) as store:
+                return [
+                    store.connection.execute(f'SELECT * FROM {table} ORDER BY rowid').fetchall()
+                    for table in (TABLE_CG_EVENTS, TABLE_COST_BASE, TABLE_UNALLOCATED_COST_BASE)
+                ]
+
+        with TemporaryDirectory() as full_dir, TemporaryDirectory() as incremental_dir:
+            for tempdir in (full_dir, incremental_dir):
+                shutil.copyfile('tests/fixtures/transactions.csv', f'{tempdir}/transactions.csv')
+
+            expected = self._calculate_with_numbered_ids(full_dir, '2019-06-30', sqlite=True)
+
+            # Tables hold the same rows as the CSV files
+            output_files = (
+                contstants.FILE_CG_EVENTS,
+                contstants.FILE_COST_BASE_TRANSACTION,
+                contstants.FILE_UNALLOCATED_COST_BASE_TRANSACTION,
+            )
+            for f, rows in zip(output_files, read_tables(full_dir)):
+                with open(Path(full_dir, f)) as csvfile:
+                    self.assertEqual(rows, [tuple(row) for row in list(csv.reader(csvfile))[1:]])
+
+            db_path = Path(full_dir, contstants.FILE_RESULTS_DB)
+            self.assertEqual(
+                cg_summary(Path(full_dir, contstants.FILE_CG_EVENTS), '2019-06-30'),
+                cg_summary(db_path, '2019-06-30'),
+            )
+            self.assertEqual(
+                get_balance('usd', Path(full_dir, contstants.FILE_TRANSACTIONS),
+                            Path(full_dir, contstants.FILE_UNALLOCATED_COST_BASE_TRANSACTION)),
+                get_balance('usd', None, db_path),
+            )
+            self.assertEqual(
+                cg_rollup(Path(full_dir, contstants.FILE_CG_EVENTS), '06-30'),
+                cg_rollup(db_path, '06-30'),
+            )
+
+            # Resuming from a snapshot appends to the tables
+            self._calculate_with_numbered_ids(incremental_dir, '2019-04-06', incremental=True, sqlite=True)
+            result = self._calculate_with_numbered_ids(incremental_dir, '2019-06-30', incremental=True, sqlite=True)
+            self.assertEqual(result, expected)
+            self.assertEqual(read_tables(incremental_dir), read_tables(full_dir))
+
+    def test_main_cg_balance_file(self):
+        for kwargs in ({}, {'workers': 2}, {'streaming': True}):
+            with TemporaryDirectory() as tempdir:
+                shutil.copyfile('tests/fixtures/transactions.csv', f'{tempdir}/transactions.csv')
+                calculate_cg(Path(tempdir), 'usd', 'fifo', 'UTC', '2019-04-06', **kwargs)
+
+                expected = get_balance('usd', Path(tempdir, contstants.FILE_TRANSACTIONS),
+                                       Path(tempdir, contstants.FILE_UNALLOCATED_COST_BASE_TRANSACTION))
+                self.assertEqual(get_balance('usd', None, Path(tempdir, contstants.FILE_BALANCE)), expected)
+                self.assertEqual(list(expected), ['btc', 'ltc', 'eth'])
+
+        with TemporaryDirectory() as tempdir:
+            shutil.copyfile('tests/fixtures/transactions.csv', f'{tempdir}/transactions.csv')
+            calculate_cg(Path(tempdir), 'usd', 'fifo', 'UTC', '2019-04-06', incremental=True)
+            calculate_cg(Path(tempdir), 'usd', 'fifo', 'UTC', '2019-06-30', incremental=True)
+
+            # Fees in other currencies are deducted, and a fully sold asset has no balance
+            self.assertEqual(get_balance('eur', None, Path(tempdir, contstants.FILE_BALANCE)), {
+                'btc': Decimal('0.3'),
+                'eth': Decimal('4'),
+            })
+
+    def test_main_cg_deterministic_ids(self):
+        output_files = (contstants.FILE_CG_EVENTS, contstants.FILE_COST_BASE_TRANSACTION)
+
+        def calculate(file_dir, tax_year_end, **kwargs):
+            calculate_cg(Path(file_dir), 'usd', 'fifo', 'UTC', tax_year_end, deterministic_ids=True, **kwargs)
+            return [Path(file_dir, f).read_bytes() for f in output_files]
+
+        outputs = []
+        for kwargs in ({}, {}, {'workers': 2}, {'streaming': True}):
+            with TemporaryDirectory() as tempdir:
+                shutil.copyfile('tests/fixtures/transactions.csv', f'{tempdir}/transactions.csv')
+                outputs.append(calculate(tempdir, '2019-06-30', **kwargs))
+
+        # Identical inputs give identical outputs, without numbering ids in the test
+        for output in outputs[1:]:
+            self.assertEqual(output, outputs[0])
+
+        # Resuming from a snapshot continues the sequence
+        with TemporaryDirectory() as tempdir:
+            shutil.copyfile('tests/fixtures/transactions.csv', f'{tempdir}/transactions.csv')
+            calculate(tempdir, '2019-04-07', incremental=True)
+            with mock.patch('capitalg.main.restore_queues', wraps=restore_queues) as restore:
+                self.assertEqual(calculate(tempdir, '2019-06-30', incremental=True), outputs[0])
+            restore.assert_called_once()
+
+    def test_main_cg_pipelined(self):
+        output_files = (contstants.FILE_CG_EVENTS, contstants.FILE_COST_BASE_TRANSACTION,
+                        contstants.FILE_UNALLOCATED_COST_BASE_TRANSACTION, contstants.FILE_FORMATTED_TRANSACTIONS)
+
+        for queue_type_code in ('fifo', 'lifo'):
+            with TemporaryDirectory() as tempdir:
+                shutil.copyfile('tests/fixtures/transactions.csv', f'{tempdir}/transactions.csv')
+                calculate_cg(Path(tempdir), 'usd', queue_type_code, 'UTC', '2019-06-30', deterministic_ids=True)
+                expected = [Path(tempdir, f).read_bytes() for f in output_files]
+
+            for kwargs in ({}, {'workers': 2}, {'sqlite': True}, {'output_format': contstants.OUTPUT_FORMAT_BOTH}):
+                with TemporaryDirectory() as tempdir:
+                    shutil.copyfile('tests/fixtures/transactions.csv', f'{tempdir}/transactions.csv')
+                    calculate_cg(Path(tempdir), 'usd', queue_type_code, 'UTC', '2019-06-30', deterministic_ids=True,
+                                 pipelined=True, **kwargs)
+                    self.assertEqual([Path(tempdir, f).read_bytes() for f in output_files], expected)
+                    if kwargs.get('sqlite'):
+                        with ResultStore(Path(tempdir, contstants.FILE_RESULTS_DB)) as store:
+                            self.assertEqual(store.row_counts()[TABLE_COST_BASE], 5)
+
+        with TemporaryDirectory() as full_dir, TemporaryDirectory() as incremental_dir:
+            for tempdir in (full_dir, incremental_dir):
+                shutil.copyfile('tests/fixtures/transactions.csv', f'{tempdir}/transactions.csv')
+            expected = self._calculate_with_numbered_ids(full_dir, '2019-06-30')
+
+            self._calculate_with_numbered_ids(incremental_dir, '2019-04-06', incremental=True, pipelined=True)
+            with mock.patch('capitalg.main.restore_queues', wraps=restore_queues) as restore:
+                result = self._calculate_with_numbered_ids(incremental_dir, '2019-06-30', incremental=True,
+                                                           pipelined=True)
+                restore.assert_called_once()
+            self.assertEqual(result, expected)
+
+        # Errors reading and matching are raised as usual
+        for replacement, error in ((',x,10000,', InvalidOperation), (',70,10000,', Exception)):
+            with TemporaryDirectory() as tempdir:
+                Path(tempdir, 'transactions.csv').write_text(
+                    Path('tests/fixtures/transactions.csv').read_text().replace(',0.7,10000,', replacement)
+                )
+                with self.assertRaises(error):
+                    calculate_cg(Path(tempdir), 'usd', 'fifo', 'UTC', '2019-06-30', pipelined=True)
+
+        with self.assertRaises(ValueError):
+            calculate_cg(Path('.'), 'usd', 'fifo', 'UTC', '2019-06-30', pipelined=True, profiler=Profiler())
+
+    def test_main_cg_lot_buffer_size(self):
+        output_files = (contstants.FILE_CG_EVENTS, contstants.FILE_COST_BASE_TRANSACTION,
+                        contstants.FILE_UNALLOCATED_COST_BASE_TRANSACTION, contstants.FILE_BALANCE)
+
+        def calculate(queue_type_code, **kwargs):
+            with TemporaryDirectory() as tempdir:
+                shutil.copyfile('tests/fixtures/transactions.csv', f'{tempdir}/transactions.csv')
+                calculate_cg(Path(tempdir), 'usd', queue_type_code, 'UTC', '2019-06-30', deterministic_ids=True, **kwargs)
+                return [Path(tempdir, f).read_bytes() for f in output_files]
+
+        for queue_type_code in ('fifo', 'lifo'):
+            for kwargs in ({}, {'pipelined': True}):
+                expected = calculate(queue_type_code, **kwargs)
+                # A buffer of 1 lot spills every other lot
+                with mock.patch('capitalg.main.SpillingCostBaseQueue', wraps=SpillingCostBaseQueue) as spilling, \
+                        mock.patch.object(SpillingCostBaseQueue, 'close', autospec=True,
+                                          side_effect=SpillingCostBaseQueue.close) as close:
+                    self.assertEqual(calculate(queue_type_code, lot_buffer_size=1, **kwargs), expected)
+                spilling.assert_called()
+                # Every queue's temporary file is deleted
+                self.assertEqual(close.call_count, 3)
+                self.assertTrue(all(queue.file is None for (queue,), _ in close.call_args_list))
+
+        with TemporaryDirectory() as full_dir, TemporaryDirectory() as incremental_dir:
+            for tempdir in (full_dir, incremental_dir):
+                shutil.copyfile('tests/fixtures/transactions.csv', f'{tempdir}/transactions.csv')
+            expected = self._calculate_with_numbered_ids(full_dir, '2019-06-30')
+
+            # Spilled lots are copied to a file next to the snapshot, not loaded into it
+            snapshot_path = Path(incremental_dir, contstants.FILE_QUEUE_SNAPSHOT)
+            for lot_buffer_size in (1, None):
+                self._calculate_with_numbered_ids(incremental_dir, '2019-04-06', incremental=True, lot_buffer_size=1)
+                self.assertTrue(spilled_lots_path(snapshot_path).exists())
+                with mock.patch('capitalg.main.restore_queues', wraps=restore_queues) as restore:
+                    result = self._calculate_with_numbered_ids(incremental_dir, '2019-06-30', incremental=True,
+                                                               lot_buffer_size=lot_buffer_size)
+                restore.assert_called_once()
+                self.assertEqual(result, expected)
+
+            # Changed spilled lots can't be resumed from
+            self._calculate_with_numbered_ids(incremental_dir, '2019-04-06', incremental=True, lot_buffer_size=1)
+            with open(spilled_lots_path(snapshot_path), 'r+b') as f:
+                f.write(b'\0')
+            with mock.patch('capitalg.main.restore_queues', wraps=restore_queues) as restore:
+                result = self._calculate_with_numbered_ids(incremental_dir, '2019-06-30', incremental=True,
+                                                           lot_buffer_size=1)
+            restore.assert_not_called()
+            self.assertEqual(result, expected)
+
+            # A run without incremental deletes the snapshot and its spilled lots
+            self._calculate_with_numbered_ids(incremental_dir, '2019-06-30', lot_buffer_size=1)
+            self.assertFalse(snapshot_path.exists())
+            self.assertFalse(spilled_lots_path(snapshot_path).exists())
+
+        for kwargs in ({'workers': 2}, {'queue_type_code': 'hifo'}):
+            with self.assertRaises(ValueError):
+                calculate_cg(**{'file_dir': Path('.'), 'tax_currency': 'usd', 'queue_type_code': 'fifo', 'tax_timezone': 'UTC',
+                                'tax_year_end': '2019-06-30', 'lot_buffer_size': 1, **kwargs})
+
+    def test_main_cg_coalesce_fills(self):
+        with TemporaryDirectory() as tempdir:
+            shutil.copyfile('tests/fixtures/transactions.csv', f'{tempdir}/transactions.csv')
+            calculate_cg(Path(tempdir), 'usd', 'fifo', 'UTC', '2019-06-30', deterministic_ids=True)
+            expected_cg_events = Path(tempdir, contstants.FILE_CG_EVENTS).read_text()
+            expected_cost_base = Path(tempdir, contstants.FILE_COST_BASE_TRANSACTION).read_text()
+
+        with TemporaryDirectory() as tempdir:
+            # The first btc buy and the eth sale as 2 fills each
+            lines = Path('tests/fixtures/transactions.csv').read_text().splitlines(keepends=True)
+            buy, sale = lines[1], lines[7]
+            lines[1:2] = [buy.replace(',1,', ',1a,').replace(',0.5,9000,10,', ',0.2,9000,4,'),
+                          buy.replace(',1,', ',1b,').replace(',0.5,9000,10,', ',0.3,9000,6,')]
+            lines[8:9] = [sale.replace(',6,', ',6a,').replace(',20,510,5.2,', ',5,510,1.3,'),
+                          sale.replace(',6,', ',6b,').replace(',20,510,5.2,', ',15,510,3.9,')]
+            Path(tempdir, 'transactions.csv').write_text(''.join(lines))
+
+            calculate_cg(Path(tempdir), 'usd', 'fifo', 'UTC', '2019-06-30', deterministic_ids=True, coalesce_fills=True)
+            self.assertIn(',1a;1b,buy,', Path(tempdir, contstants.FILE_COST_BASE_TRANSACTION).read_text())
+            self.assertEqual(Path(tempdir, contstants.FILE_CG_EVENTS).read_text(), expected_cg_events.replace(',6\n', ',6a;6b\n'))
+            self.assertEqual(Path(tempdir, contstants.FILE_COST_BASE_TRANSACTION).read_text(),
+                             expected_cost_base.replace(',1,buy,', ',1a;1b,buy,'))
+
+    def test_main_cg_rate_provider(self):
+        # The rebased transactions need a btc rate
+        with TemporaryDirectory() as tempdir:
+            shutil.copyfile('tests/fixtures/rates.csv', f'{tempdir}/rates.csv')
+            calculate_cg(Path(tempdir), 'usd', 'fifo', 'UTC', '2018-12-31', deterministic_ids=True,
+                         input_paths='tests/fixtures/transactions_2.csv')
+            expected_cg_events = Path(tempdir, contstants.FILE_CG_EVENTS).read_text()
+
+        with TemporaryDirectory() as tempdir:
+            write_rates_db(load_rates(Path('tests/fixtures/rates.csv')), Path(tempdir, 'rates.sqlite'))
+            for kwargs in ({}, {'streaming': True}, {'workers': 2}):
+                calculate_cg(Path(tempdir), 'usd', 'fifo', 'UTC', '2018-12-31', deterministic_ids=True,
+                             input_paths='tests/fixtures/transactions_2.csv',
+                             rate_provider=SqliteRateProvider(Path(tempdir, 'rates.sqlite')), **kwargs)
+                self.assertEqual(Path(tempdir, contstants.FILE_CG_EVENTS).read_text(), expected_cg_events)
+
+    def test_main_cg_hifo_lofo(self):
+        # In the fixture, later lots always cost more, so HIFO sells as LIFO does and LOFO as FIFO does
+        def read_outputs(file_dir):
+            return [
+                Path(file_dir, output_file).read_bytes()
+                for output_file in (contstants.FILE_CG_EVENTS, contstants.FILE_COST_BASE_TRANSACTION,
+                                    contstants.FILE_UNALLOCATED_COST_BASE_TRANSACTION)
+            ]
+
+        for queue_type_code, equivalent in (('hifo', 'lifo'), ('lofo', 'fifo')):
+            with TemporaryDirectory() as tempdir:
+                shutil.copyfile('tests/fixtures/transactions.csv', f'{tempdir}/transactions.csv')
+                calculate_cg(Path(tempdir), 'usd', equivalent, 'UTC', '2019-06-30', deterministic_ids=True)
+                expected = read_outputs(tempdir)
+
+            for kwargs in ({}, {'workers': 2}, {'streaming': True}):
+                with TemporaryDirectory() as tempdir:
+                    shutil.copyfile('tests/fixtures/transactions.csv', f'{tempdir}/transactions.csv')
+                    calculate_cg(Path(tempdir), 'usd', queue_type_code, 'UTC', '2019-06-30', deterministic_ids=True, **kwargs)
+                    self.assertEqual(read_outputs(tempdir), expected)
+
+            # Open lots restored from a snapshot are consumed in the same order
+            with TemporaryDirectory() as tempdir:
+                shutil.copyfile('tests/fixtures/transactions.csv', f'{tempdir}/transactions.csv')
+                calculate_cg(Path(tempdir), 'usd', queue_type_code, 'UTC', '2019-04-06', deterministic_ids=True, incremental=True)
+                with mock.patch('capitalg.main.restore_queues', wraps=restore_queues) as restore:
+                    calculate_cg(Path(tempdir), 'usd', queue_type_code, 'UTC', '2019-06-30', deterministic_ids=True,
+                                 incremental=True)
+                restore.assert_called_once()
+                self.assertEqual(read_outputs(tempdir), expected)
+
+    def test_main_cg_profile(self):
+        for workers, streaming in ((1, False), (1, True), (2, False)):
+            with TemporaryDirectory() as tempdir:
+                shutil.copyfile('tests/fixtures/transactions.csv', f'{tempdir}/transactions.csv')
+
+                profiler = Profiler()
+                calculate_cg(Path(tempdir), 'usd', 'fifo', 'UTC', '2019-06-30',
+                             workers=workers, streaming=streaming, profiler=profiler)
+                report = profiler.report()
+
+            self.assertEqual(report['counters'], {
+                'rows_read': 8,
+                'rows_rebased': 0,
+                'rate_lookups': 0,
+                'lots_consumed': 5,
+            })
+            self.assertEqual(report['max_queue_depth'], {'btc': 2, 'ltc': 1, 'eth': 2})
+            for stage in ('rates', 'parse', 'convert_timezone', 'rebase', 'sort', 'match', 'write'):
+                self.assertGreater(report['stages'][stage]['seconds'], 0)
+                self.assertGreater(report['stages'][stage]['peak_memory_mib'], 0)
+
 
 if __name__ == '__main__':
     unittest.main()
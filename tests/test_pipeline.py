@@ -0,0 +1,73 @@
+import threading
+import unittest
+
+from capitalg.pipeline import ThreadedConsumer, threaded_iter
+
+
+class TestPipeline(unittest.TestCase):
+
+    def test_threaded_iter(self):
+        for batch_size, count in ((1, 0), (1, 5), (3, 10), (1000, 2500)):
+            self.assertEqual(list(threaded_iter(range(count), 'test', batch_size=batch_size, queue_size=2)),
+                             list(range(count)))
+
+        # Items are produced in another thread
+        threads = set(threaded_iter((threading.current_thread().name for _ in range(3)), 'test'))
+        self.assertEqual(threads, {'test'})
+
+    def test_threaded_iter_error(self):
+        def fail():
+            yield 1
+            raise KeyError('bad row')
+
+        with self.assertRaises(KeyError):
+            list(threaded_iter(fail(), 'test'))
+
+    def test_threaded_iter_stops_early(self):
+        closed = threading.Event()
+
+        def numbers():
+            try:
+                i = 0
+                while True:
+                    yield i
+                    i += 1
+            finally:
+                closed.set()
+
+        iterator = threaded_iter(numbers(), 'test', batch_size=10, queue_size=2)
+        self.assertEqual([next(iterator) for _ in range(25)], list(range(25)))
+        # The producer is blocked on a full queue until the consumer stops
+        iterator.close()
+        self.assertTrue(closed.is_set())
+
+    def test_threaded_consumer(self):
+        consumed = []
+        with ThreadedConsumer(lambda a, b: consumed.append((a, b, threading.current_thread().name)), 'test',
+                              batch_size=3, queue_size=1) as consumer:
+            for i in range(10):
+                consumer.submit(i, -i)
+        self.assertEqual(consumed, [(i, -i, 'test') for i in range(10)])
+
+    def test_threaded_consumer_error(self):
+        def consume(i):
+            if i == 5:
+                raise ValueError('bad event')
+
+        # The queue holds one batch, so submit raises soon after the error
+        with self.assertRaises(ValueError):
+            with ThreadedConsumer(consume, 'test', batch_size=2, queue_size=1) as consumer:
+                for i in range(1000):
+                    consumer.submit(i)
+        self.assertFalse(consumer.thread.is_alive())
+
+        # An exception raised while submitting takes precedence
+        with self.assertRaises(KeyError):
+            with ThreadedConsumer(consume, 'test', batch_size=1) as consumer:
+                consumer.submit(5)
+                raise KeyError('matching failed')
+        self.assertFalse(consumer.thread.is_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import json
+import tempfile
+import time
+import tracemalloc
+import unittest
+from unittest import mock
+from pathlib import Path
+
+from capitalg.Profiler import Profiler, profile_function, profile_iter
+
+
+class TestProfiler(unittest.TestCase):
+
+    def test_nested_stages(self):
+        profiler = Profiler(trace_memory=False)
+        sleep = profiler.timed('inner', time.sleep)
+
+        with profiler.stage('outer'):
+            time.sleep(0.02)
+            sleep(0.05)
+            items = list(profiler.timed_iter('inner', [1, 2]))
+
+        report = profiler.report()
+        self.assertEqual(items, [1, 2])
+        # Time is exclusive of nested stages
+        self.assertGreaterEqual(report['stages']['inner']['seconds'], 0.05)
+        self.assertLess(report['stages']['outer']['seconds'], 0.05)
+        self.assertIsNone(report['stages']['outer']['peak_memory_mib'])
+
+    def test_counters(self):
+        profiler = Profiler()
+        profiler.count('rows_read', 3)
+        profiler.count('rows_read')
+        profiler.record_queue_depth('btc', 2)
+        profiler.record_queue_depth('btc', 1)
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            report_path = Path(tempdir, 'profile.json')
+            profiler.write_report(report_path)
+            report = json.loads(report_path.read_text())
+
+        self.assertEqual(report['counters']['rows_read'], 4)
+        self.assertEqual(report['counters']['lots_consumed'], 0)
+        self.assertEqual(report['max_queue_depth'], {'btc': 2})
+
+    def test_without_reset_peak(self):
+        # tracemalloc.reset_peak is new in Python 3.9
+        without_reset_peak = mock.Mock(wraps=tracemalloc, spec=['start', 'stop', 'is_tracing', 'get_traced_memory'])
+        with mock.patch('capitalg.Profiler.tracemalloc', without_reset_peak):
+            with Profiler() as profiler:
+                with profiler.stage('allocate'):
+                    data = bytes(1 << 20)
+
+        self.assertGreaterEqual(profiler.report()['stages']['allocate']['peak_memory_mib'], 1)
+        del data
+
+    def test_not_profiling(self):
+        self.assertIs(profile_function(None, 'stage', len), len)
+        items = [1, 2]
+        self.assertIs(profile_iter(None, 'stage', items), items)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,173 @@
+import os
+import pickle
+import sqlite3
+import tempfile
+import threading
+import unittest
+from datetime import date, timedelta
+from decimal import Decimal
+from pathlib import Path
+
+from capitalg.rate_providers import (
+    CachedRates,
+    FileRateProvider,
+    HttpRateProvider,
+    RateProvider,
+    SQLITE_MAX_KEYS,
+    SqliteRateProvider,
+    make_rate_server,
+    write_rates_db,
+)
+from capitalg.rates_loader import load_rates
+from capitalg.TransactionLoader import TransactionLoader
+from capitalg.utils import get_tax_year_cutoff_date
+
+RATES = {
+    '2018-05-01': {'date': '2018-05-01', 'btc': '6000.5', 'eth': ''},
+    '2018-05-02': {'date': '2018-05-02', 'btc': '6100', 'eth': '700.25'},
+}
+
+
+class DictRateProvider(RateProvider):
+    """ Records the keys of each fetch
+    """
+
+    def __init__(self, rates: dict):
+        self.rates = rates
+        self.requests = []
+
+    def fetch_rates(self, keys):
+        self.requests.append(list(keys))
+        rates = {(day, asset_code): self.rates.get(day.isoformat(), {}).get(asset_code) for day, asset_code in keys}
+        return {key: Decimal(rate) for key, rate in rates.items() if rate}
+
+
+class TestRateProviders(unittest.TestCase):
+
+    def _assert_fetches_rates(self, provider: RateProvider):
+        self.assertEqual(provider.fetch_rates([
+            (date(2018, 5, 1), 'btc'), (date(2018, 5, 1), 'eth'), (date(2018, 5, 2), 'eth'), (date(2018, 5, 3), 'btc'),
+        ]), {
+            (date(2018, 5, 1), 'btc'): Decimal('6000.5'),
+            (date(2018, 5, 2), 'eth'): Decimal('700.25'),
+        })
+
+    def test_rate_provider_is_abstract(self):
+        with self.assertRaises(TypeError):
+            RateProvider()
+
+    def test_cached_rates(self):
+        provider = DictRateProvider(RATES)
+        rates = CachedRates(provider, max_size=2)
+        may_1, may_2 = date(2018, 5, 1), date(2018, 5, 2)
+
+        self.assertEqual(rates.get_rate(may_1, 'btc'), Decimal('6000.5'))
+        self.assertEqual(rates.get_rate(may_1, 'btc'), Decimal('6000.5'))
+        # Missing rates are cached too
+        self.assertIsNone(rates.get_rate(may_1, 'eth'))
+        self.assertIsNone(rates.get_rate(may_1, 'eth'))
+        self.assertEqual(provider.requests, [[(may_1, 'btc')], [(may_1, 'eth')]])
+
+        # The least recently used rate is evicted
+        rates.get_rate(may_1, 'btc')
+        rates.get_rate(may_2, 'btc')
+        self.assertEqual(list(rates.cache), [(may_1, 'btc'), (may_2, 'btc')])
+
+        with self.assertRaises(ValueError):
+            CachedRates(provider, max_size=0)
+
+    def test_prefetch(self):
+        provider = DictRateProvider(RATES)
+        rates = CachedRates(provider, batch_size=2)
+        may_1, may_2 = date(2018, 5, 1), date(2018, 5, 2)
+        rates.get_rate(may_1, 'btc')
+
+        # Only keys that aren't cached are fetched, once each, a batch at a time
+        rates.prefetch([(may_1, 'btc'), (may_1, 'eth'), (may_2, 'btc'), (may_1, 'eth'), (may_2, 'eth')])
+        self.assertEqual(provider.requests[1:], [[(may_1, 'eth'), (may_2, 'btc')], [(may_2, 'eth')]])
+        self.assertEqual(rates.get_rate(may_2, 'eth'), Decimal('700.25'))
+        self.assertEqual(rates.fetches, 3)
+
+    def test_file_rate_provider(self):
+        provider = FileRateProvider(Path('tests/fixtures/rates.csv'))
+        self.assertEqual(provider.fetch_rates([(date(2018, 5, 2), 'btc'), (date(2018, 5, 3), 'btc')]),
+                         {(date(2018, 5, 2), 'btc'): Decimal('6100')})
+
+    def test_sqlite_rate_provider(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = Path(temp_dir, 'rates.sqlite')
+            write_rates_db(RATES, path)
+            provider = SqliteRateProvider(path)
+            self._assert_fetches_rates(provider)
+
+            # The connection isn't pickled, so the provider can be sent to worker processes
+            copy = pickle.loads(pickle.dumps(provider))
+            self.assertIsNone(copy.connection)
+            self._assert_fetches_rates(copy)
+            provider.connection.close()
+            copy.connection.close()
+
+    def test_sqlite_rate_provider_many_keys(self):
+        # More keys than SQLite before 3.32 can bind in one statement
+        days = [date(2018, 1, 1) + timedelta(days=i) for i in range(SQLITE_MAX_KEYS * 2 + 1)]
+        rates = {day.isoformat(): {'btc': str(i)} for i, day in enumerate(days)}
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = Path(temp_dir, 'rates.sqlite')
+            write_rates_db(rates, path)
+            provider = SqliteRateProvider(path)
+            provider.connection = sqlite3.connect(path)
+            if hasattr(provider.connection, 'setlimit'):
+                provider.connection.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 999)
+            self.assertEqual(provider.fetch_rates([(day, 'btc') for day in days]),
+                             {(day, 'btc'): Decimal(i) for i, day in enumerate(days)})
+            provider.connection.close()
+
+    def test_http_rate_provider(self):
+        server = make_rate_server(RATES)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            host, port = server.server_address[:2]
+            self._assert_fetches_rates(HttpRateProvider(f'http://{host}:{port}/rates'))
+            # A request per key
+            self._assert_fetches_rates(HttpRateProvider(f'http://{host}:{port}/rates', max_url_length=1))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_http_rate_provider_urls(self):
+        provider = HttpRateProvider('http://localhost/rates?source=test', max_url_length=100)
+        keys = [(date(2018, 5, 1) + timedelta(days=i), 'btc') for i in range(50)]
+        urls = list(provider.urls(keys))
+
+        self.assertGreater(len(urls), 1)
+        self.assertTrue(all(len(url) <= 100 for url in urls))
+        self.assertEqual(urls[0].split('&')[:2], ['http://localhost/rates?source=test', 'key=2018-05-01%3Abtc'])
+        self.assertEqual(sum(url.count('key=') for url in urls), 50)
+        self.assertEqual(list(provider.urls([])), [])
+
+    def test_loader_rate_provider(self):
+        formatted_transactions_path = Path('tests/output/formatted_transactions.csv')
+        settings = {
+            'input_path': Path('tests/fixtures/transactions_2.csv'),
+            'output_path': formatted_transactions_path,
+            'tax_currency': 'usd',
+            'tax_year_cutoff': get_tax_year_cutoff_date('2018-12-31', 'America/New_York'),
+            'tax_timezone': 'utc',
+        }
+        expected = TransactionLoader(rates=load_rates(Path('tests/fixtures/rates.csv')), **settings).transactions
+
+        provider = DictRateProvider(load_rates(Path('tests/fixtures/rates.csv')))
+        loader = TransactionLoader(rates=provider, **settings)
+        self.assertEqual(loader.transactions, expected)
+        # Only the btc rate of the day of the btc based transactions is fetched, in one batch
+        self.assertEqual(provider.requests, [[(date(2018, 5, 2), 'btc')]])
+
+        loader = TransactionLoader(rates=DictRateProvider(load_rates(Path('tests/fixtures/rates.csv'))),
+                                   streaming=True, sort_buffer_size=1, **settings)
+        self.assertEqual(list(loader.stream()), expected)
+        os.unlink(formatted_transactions_path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import os
+import tempfile
+import unittest
+from datetime import date
+from decimal import Decimal
+from pathlib import Path
+
+from capitalg.RatesStore import CACHE_HEADER, RatesStore
+from capitalg.rates_loader import load_rates, load_rates_store
+
+
+RATES_CSV = """date,btc,eth
+2020-01-01,10000.50,150
+2020-01-02,,150.250
+2020-01-04,-0.00012300,1E+3
+"""
+
+
+class TestRatesStore(unittest.TestCase):
+
+    def test_get_rate(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            rates_path = Path(tempdir, 'rates.csv')
+            rates_path.write_text(RATES_CSV)
+            store = RatesStore.from_rates(load_rates(rates_path))
+
+        self.assertEqual(str(store.get_rate(date(2020, 1, 1), 'btc')), '10000.50')
+        self.assertEqual(str(store.get_rate(date(2020, 1, 2), 'eth')), '150.250')
+        self.assertEqual(str(store.get_rate(date(2020, 1, 4), 'btc')), '-0.00012300')
+        self.assertEqual(str(store.get_rate(date(2020, 1, 4), 'eth')), '1E+3')
+
+        # Blank cell, missing day, out of range days and unknown asset
+        self.assertIsNone(store.get_rate(date(2020, 1, 2), 'btc'))
+        self.assertIsNone(store.get_rate(date(2020, 1, 3), 'eth'))
+        self.assertIsNone(store.get_rate(date(2019, 12, 31), 'btc'))
+        self.assertIsNone(store.get_rate(date(2020, 1, 5), 'btc'))
+        self.assertIsNone(store.get_rate(date(2020, 1, 1), 'ltc'))
+
+        self.assertIsNone(RatesStore.from_rates({}).get_rate(date(2020, 1, 1), 'btc'))
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            rates_path = Path(tempdir, 'rates.csv')
+            cache_path = Path(tempdir, 'rates.cache')
+            rates_path.write_text(RATES_CSV)
+
+            store = load_rates_store(rates_path, cache_path)
+            self.assertTrue(cache_path.exists())
+
+            cached = RatesStore.read_cache(cache_path, rates_path)
+            self.assertIsNotNone(cached)
+            for day in range(1, 6):
+                for asset_code in ('btc', 'eth'):
+                    rate = cached.get_rate(date(2020, 1, day), asset_code)
+                    self.assertEqual(str(rate), str(store.get_rate(date(2020, 1, day), asset_code)))
+
+            # Editing the rates file invalidates the cache
+            rates_path.write_text(RATES_CSV.replace('10000.50', '20000.50'))
+            os.utime(rates_path, ns=(0, 0))
+            self.assertIsNone(RatesStore.read_cache(cache_path, rates_path))
+            store = load_rates_store(rates_path, cache_path)
+            self.assertEqual(str(store.get_rate(date(2020, 1, 1), 'btc')), '20000.50')
+            self.assertIsNotNone(RatesStore.read_cache(cache_path, rates_path))
+
+            # Missing rates file
+            store = load_rates_store(Path(tempdir, 'missing.csv'))
+            self.assertIsNone(store.get_rate(date(2020, 1, 1), 'btc'))
+
+    def test_corrupt_cache(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            rates_path = Path(tempdir, 'rates.csv')
+            cache_path = Path(tempdir, 'rates.cache')
+            rates_path.write_text(RATES_CSV)
+            load_rates_store(rates_path, cache_path)
+            data = cache_path.read_bytes()
+
+            # Truncated, or with trailing bytes, the cache is rebuilt from the rates file
+            for corrupt in (data[:-1], data[:-100], data[:CACHE_HEADER.size + 1], data + b'\0'):
+                cache_path.write_bytes(corrupt)
+                self.assertIsNone(RatesStore.read_cache(cache_path, rates_path))
+                store = load_rates_store(rates_path, cache_path)
+                self.assertEqual(str(store.get_rate(date(2020, 1, 4), 'eth')), '1E+3')
+                self.assertEqual(cache_path.read_bytes(), data)
+
+    def test_overflow_not_cached(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            rates_path = Path(tempdir, 'rates.csv')
+            cache_path = Path(tempdir, 'rates.cache')
+            rates_path.write_text('date,btc\n2020-01-01,1' + '0' * 30 + '.5\n')
+
+            store = load_rates_store(rates_path, cache_path)
+            self.assertEqual(store.get_rate(date(2020, 1, 1), 'btc'), Decimal('1' + '0' * 30 + '.5'))
+            self.assertFalse(cache_path.exists())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import tempfile
+import unittest
+from decimal import Decimal
+from pathlib import Path
+
+from capitalg.contstants import FIELD_CAPITAL_GAIN_LT, FIELD_CAPITAL_GAIN_ST, FIELD_CAPITAL_GAIN_TOTAL
+from capitalg.ResultStore import (
+    TABLE_CG_EVENTS,
+    TABLE_COST_BASE,
+    TABLE_UNALLOCATED_COST_BASE,
+    ResultStore,
+    SqliteSink,
+)
+
+
+def cg_event(asset_code, date, lt, st):
+    # OUTPUT_FIELDS_CGT_EVENTS order
+    return (asset_code, lt, st, Decimal(lt) + Decimal(st), '0', 'id', date, 'na', '', '1', '1', '1', '0', 'sale')
+
+
+def unallocated(asset_code, qty):
+    # OUTPUT_FIELDS_UNALLOCATED_COST_BASE order
+    return ('1', 'na', '2019-01-01T00:00:00', 'UTC', 'buy', 'usd', asset_code, qty, '1', 'usd', '0', '')
+
+
+class TestResultStore(unittest.TestCase):
+
+    def test_cg_summary(self):
+        with tempfile.TemporaryDirectory() as tempdir, ResultStore(Path(tempdir, 'results.sqlite')) as store:
+            sink = SqliteSink(store, TABLE_CG_EVENTS)
+            sink.write_rows([
+                cg_event('eth', '2019-06-30T23:59:59', '0.1', '0'),
+                cg_event('btc', '2019-07-01T00:00:00', '100', '100'),
+                cg_event('btc', '2018-07-01T00:00:00', '0', '-1.5'),
+                cg_event('eth', '2019-01-01T00:00:00', '0.2', '0'),
+                cg_event('ltc', '2018-06-30T23:59:59', '7', '7'),
+            ])
+            sink.close()
+
+            summary = store.cg_summary('2018-07-01T00:00:00', '2019-07-01T00:00:00')
+
+            # Assets are in order of their first cg event, and totals are exact
+            self.assertEqual(list(summary), ['eth', 'btc'])
+            self.assertEqual(summary['eth'], {
+                FIELD_CAPITAL_GAIN_TOTAL: Decimal('0.3'),
+                FIELD_CAPITAL_GAIN_LT: Decimal('0.3'),
+                FIELD_CAPITAL_GAIN_ST: Decimal('0'),
+            })
+            self.assertEqual(summary['btc'][FIELD_CAPITAL_GAIN_ST], Decimal('-1.5'))
+
+            plan = store.connection.execute(
+                f'EXPLAIN QUERY PLAN SELECT * FROM {TABLE_CG_EVENTS} WHERE date >= ? AND date < ?', ('', '')
+            ).fetchall()
+            self.assertIn('INDEX', ' '.join(str(row[-1]) for row in plan))
+
+    def test_balance_queries(self):
+        with tempfile.TemporaryDirectory() as tempdir, ResultStore(Path(tempdir, 'results.sqlite')) as store:
+            SqliteSink(store, TABLE_UNALLOCATED_COST_BASE).write_rows([
+                unallocated('btc', Decimal('0.5')),
+                unallocated('eth', '2'),
+                unallocated('btc', '0.25'),
+            ])
+            store.replace_fees({'usd': Decimal('10'), 'bnb': Decimal('0.01')})
+
+            self.assertEqual(store.unallocated_cost_base(), {'btc': Decimal('0.75'), 'eth': Decimal('2')})
+            self.assertEqual(store.fees(exclude_currency='usd'), {'bnb': Decimal('0.01')})
+
+            # Fees are replaced, not added to
+            store.replace_fees({'bnb': Decimal('1')})
+            self.assertEqual(store.fees(), {'bnb': Decimal('1')})
+
+    def test_truncate(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = Path(tempdir, 'results.sqlite')
+            with ResultStore(path) as store:
+                self.assertEqual(store.row_counts(), {TABLE_CG_EVENTS: 0, TABLE_COST_BASE: 0})
+                SqliteSink(store, TABLE_CG_EVENTS).write_rows([cg_event('btc', '2019-01-01T00:00:00', '1', '0')])
+                row_counts = store.row_counts()
+
+            with ResultStore(path) as store:
+                SqliteSink(store, TABLE_CG_EVENTS, append=True).write_rows([cg_event('eth', '2019-01-02T00:00:00', '1', '0')])
+                self.assertEqual(store.row_counts()[TABLE_CG_EVENTS], 2)
+
+                store.truncate(row_counts)
+                self.assertEqual(list(store.cg_summary('2019', '2020')), ['btc'])
+
+            # Not appending replaces the table
+            with ResultStore(path) as store:
+                SqliteSink(store, TABLE_CG_EVENTS).write_rows([cg_event('ltc', '2019-01-01T00:00:00', '1', '0')])
+                self.assertEqual(list(store.cg_summary('2019', '2020')), ['ltc'])
+
+
+if __name__ == '__main__':
+    unittest.main()
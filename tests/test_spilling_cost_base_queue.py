@@ -0,0 +1,106 @@
+import io
+import random
+import unittest
+from decimal import Decimal
+from unittest import mock
+
+from capitalg.CostBaseQueue import CostBaseQueue, QueueTypes
+from capitalg.SpillingCostBaseQueue import SpillingCostBaseQueue, read_chunk
+from tests.helpers import make_transaction
+
+
+class TestSpillingCostBaseQueue(unittest.TestCase):
+
+    @staticmethod
+    def _to_tuples(lots):
+        return [(lot.qty, lot.price, lot.transaction.id) for lot in lots]
+
+    def test_same_as_cost_base_queue(self):
+        # Whole quantities often use up lots exactly, including at the end of a chunk read back from disk
+        rng = random.Random(0)
+        for queue_type in (QueueTypes.FIFO, QueueTypes.LIFO):
+            for buffer_size in (1, 2, 5, 40):
+                queue = CostBaseQueue(queue_type)
+                spilling_queue = SpillingCostBaseQueue(queue_type, buffer_size)
+                held = 0
+                for i in range(1000):
+                    if rng.random() < 0.55 or held == 0:
+                        transaction = make_transaction(qty=Decimal(rng.randrange(1, 4)), price=Decimal(i), id=str(i))
+                        queue.add(transaction)
+                        spilling_queue.add(transaction)
+                        held += transaction.qty
+                    else:
+                        sale_qty = Decimal(rng.randrange(1, 12))
+                        held = max(held - sale_qty, 0)
+                        self.assertEqual(self._to_tuples(spilling_queue.get_transactions(sale_qty)),
+                                         self._to_tuples(queue.get_transactions(sale_qty)))
+
+                    self.assertEqual(len(spilling_queue), len(queue))
+                    self.assertLessEqual(len(spilling_queue.queue) + len(spilling_queue.tail), buffer_size + 1)
+
+                self.assertEqual(self._to_tuples(spilling_queue.get_queue), self._to_tuples(queue.get_queue))
+                spilling_queue.close()
+
+    def test_spills_to_disk(self):
+        queue = SpillingCostBaseQueue(QueueTypes.FIFO, 8)
+        for i in range(100):
+            queue.add(make_transaction(qty=Decimal('1'), price=Decimal(i), id=str(i)))
+        self.assertEqual((len(queue.queue), len(queue.tail), queue.spilled), (6, 0, 94))
+
+        # Lots are read back a chunk at a time, oldest first
+        self.assertEqual(self._to_tuples(queue.get_transactions(Decimal('7.5'))), [
+            *[(Decimal('1'), Decimal(i), str(i)) for i in range(7)],
+            (Decimal('0.5'), Decimal(7), '7'),
+        ])
+        self.assertEqual((len(queue.queue), queue.spilled), (1, 92))
+
+        self.assertEqual(self._to_tuples(queue.empty_like().get_queue), [])
+        self.assertEqual(queue.empty_like().buffer_size, 8)
+
+    def test_compact(self):
+        # Buy 3 lots for every 2 sold, so the queue keeps growing and chunks are read while others are spilled
+        with mock.patch('capitalg.SpillingCostBaseQueue.COMPACT_MIN_BYTES', 0):
+            queue = CostBaseQueue(QueueTypes.FIFO)
+            spilling_queue = SpillingCostBaseQueue(QueueTypes.FIFO, 8)
+            for i in range(2000):
+                transaction = make_transaction(qty=Decimal('1'), price=Decimal(i), id=str(i))
+                queue.add(transaction)
+                spilling_queue.add(transaction)
+                if i % 3 != 0:
+                    self.assertEqual(self._to_tuples(spilling_queue.get_transactions(Decimal('1'))),
+                                     self._to_tuples(queue.get_transactions(Decimal('1'))))
+                    # The file holds the chunks still to be read, and at most as many bytes of chunks already read
+                    if spilling_queue.chunks:
+                        read_bytes = spilling_queue.chunks[0][0]
+                        self.assertLessEqual(read_bytes, spilling_queue.file_end - read_bytes)
+
+            self.assertEqual(self._to_tuples(spilling_queue.get_queue), self._to_tuples(queue.get_queue))
+            self.assertGreater(spilling_queue.spilled, 600)
+            self.assertEqual(spilling_queue.file.seek(0, io.SEEK_END), spilling_queue.file_end)
+            spilling_queue.close()
+
+    def test_dump(self):
+        for queue_type in (QueueTypes.FIFO, QueueTypes.LIFO):
+            queue = SpillingCostBaseQueue(queue_type, 8)
+            for i in range(50):
+                queue.add(make_transaction(qty=Decimal('1'), price=Decimal(i), id=str(i)))
+            queue.get_transactions(Decimal('10.5'))
+
+            f = io.BytesIO(b'header')
+            f.seek(0, io.SEEK_END)
+            head, chunks, tail = queue.dump(f)
+            self.assertEqual(sum(count for _, count in chunks), queue.spilled)
+            lots = [*head, *[lot for offset, _ in chunks for lot in read_chunk(f, offset)], *tail]
+            self.assertEqual(self._to_tuples(lots), self._to_tuples(queue.get_queue))
+            self.assertTrue(f.getvalue().startswith(b'header'))
+            queue.close()
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            SpillingCostBaseQueue(QueueTypes.FIFO, 0)
+        with self.assertRaises(ValueError):
+            SpillingCostBaseQueue(QueueTypes.HIFO, 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
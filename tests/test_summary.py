@@ -1,8 +1,9 @@
 import tempfile
 import unittest
+from datetime import date
 from decimal import Decimal
 
-from capitalg.analysis.summary import cg_summary
+from capitalg.analysis.summary import cg_rollup, cg_summary, get_periods, parse_tax_year_end
 
 
 class TestSummary(unittest.TestCase):
@@ -25,5 +26,44 @@ class TestSummary(unittest.TestCase):
             'total': {'captial_gain_lt': Decimal('0'), 'captial_gain_st': Decimal('3.57'), 'captial_gain_total': Decimal('3.57')}
         })
 
+    def test_rollup(self):
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            with open(f'{tempdir}/test.csv', 'w') as f:
+                f.writelines([
+                    'date,asset_code,captial_gain_total,captial_gain_lt,captial_gain_st',
+                    '\n2020-05-19T15:10:07,asset1,1.23,0,1.23',
+                    '\n2020-06-30T23:59:59,asset2,2.34,0,2.34',
+                    '\n2020-06-30T01:00:00,asset2,0.1,0.1,0',
+                    '\n2021-07-01T00:00:00,asset2,328.324,0,328.324',
+                ])
+            results = cg_rollup(f'{tempdir}/test.csv', '06-30')
+
+            self.assertEqual(results['tax_year']['2020'], cg_summary(f'{tempdir}/test.csv', '2020-06-30'))
+            self.assertEqual(list(results['tax_year']), ['2020', '2022'])
+            self.assertEqual(list(results['quarter']), ['2020-Q4', '2022-Q1'])
+            self.assertEqual(list(results['month']), ['2020-05', '2020-06', '2021-07'])
+            self.assertEqual(results['month']['2020-06'], {
+                'asset2': {'captial_gain_total': Decimal('2.44'), 'captial_gain_lt': Decimal('0.1'), 'captial_gain_st': Decimal('2.34')},
+                'total': {'captial_gain_total': Decimal('2.44'), 'captial_gain_lt': Decimal('0.1'), 'captial_gain_st': Decimal('2.34')},
+            })
+
+            self.assertEqual(list(cg_rollup(f'{tempdir}/test.csv', '2020-12-31', ['quarter'])), ['quarter'])
+            with self.assertRaises(ValueError):
+                cg_rollup(f'{tempdir}/test.csv', '12-31', ['week'])
+
+    def test_periods(self):
+        # UK tax years run from 6 April to 5 April
+        uk = parse_tax_year_end('2021-04-05')
+        self.assertEqual(get_periods(date(2021, 4, 5), uk), {'tax_year': '2021', 'quarter': '2021-Q4', 'month': '2021-04'})
+        self.assertEqual(get_periods(date(2021, 4, 6), uk), {'tax_year': '2022', 'quarter': '2022-Q1', 'month': '2021-04'})
+        self.assertEqual(get_periods(date(2021, 7, 5), uk)['quarter'], '2022-Q1')
+        self.assertEqual(get_periods(date(2021, 7, 6), uk)['quarter'], '2022-Q2')
+
+        calendar = parse_tax_year_end('12-31')
+        self.assertEqual(get_periods(date(2020, 12, 31), calendar), {'tax_year': '2020', 'quarter': '2020-Q4', 'month': '2020-12'})
+        self.assertEqual(get_periods(date(2021, 1, 1), calendar)['quarter'], '2021-Q1')
+
+
 if __name__ == '__main__':
     unittest.main()
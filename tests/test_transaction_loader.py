@@ -1,12 +1,26 @@
 import csv
 import os
+import tempfile
+from datetime import datetime
 from pathlib import Path
 import unittest
 from decimal import Decimal
 from operator import itemgetter
 
-from capitalg.contstants import FIELD_DATE, FIELD_FEE, FIELD_PRICE, FIELD_QTY, FIELD_TRANSACTION_TYPE
-from capitalg.TransactionLoader import TransactionLoader
+from capitalg.contstants import (
+    FIELD_ASSET_CODE,
+    FIELD_BASE_CURRENCY,
+    FIELD_DATE,
+    FIELD_EXCHANGE,
+    FIELD_FEE,
+    FIELD_FEE_CURRENCY,
+    FIELD_PRICE,
+    FIELD_QTY,
+    FIELD_RAW_ID,
+    FIELD_TRANSACTION_TYPE,
+)
+from capitalg.errors import InputValidationError
+from capitalg.TransactionLoader import TransactionLoader, merge_fills, resolve_input_paths
 from capitalg.rates_loader import load_rates
 from capitalg.utils import get_tax_year_cutoff_date
 
@@ -67,6 +81,150 @@ class TestTransactionLoader(unittest.TestCase):
         self.assertEqual(output_transactions[2][FIELD_FEE], '0')
         self.assertEqual(output_transactions[2][FIELD_TRANSACTION_TYPE], 'buy')
 
+    def test_loader_streaming(self):
+        loader = TransactionLoader(
+            input_path=self.input_path,
+            output_path=self.formatted_transactions_path,
+            tax_currency=self.tax_currency,
+            tax_year_cutoff=get_tax_year_cutoff_date('2018-12-31', 'America/New_York'),
+            tax_timezone='utc',
+            rates=load_rates(Path('tests/fixtures/rates.csv')),
+            streaming=True,
+            sort_buffer_size=1,
+        )
+        self.assertEqual(loader.transactions, [])
+
+        # Streamed output matches the in-memory loader, including the formatted transactions file
+        self.assertEqual(list(loader.stream()), self.loader.transactions)
+        self.assertEqual(self._get_output_rows(), [
+            {k: str(v) for k, v in row.to_dict().items()} for row in self.loader.transactions
+        ])
+
+    def test_loader_multiple_files(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            # One file per exchange, each out of order
+            with open(self.input_path) as f:
+                lines = f.readlines()
+            for name, rows in (('a.csv', [lines[1], lines[4]]), ('b.csv', [lines[3], lines[2]])):
+                with open(Path(tempdir, name), 'w') as f:
+                    f.writelines([lines[0], *rows])
+
+            self.assertEqual(resolve_input_paths(f'{tempdir}/*.csv'), [Path(tempdir, 'a.csv'), Path(tempdir, 'b.csv')])
+            with self.assertRaises(InputValidationError):
+                resolve_input_paths(f'{tempdir}/*.json')
+
+            for workers, streaming in ((1, False), (2, False), (1, True), (2, True)):
+                loader = TransactionLoader(
+                    input_path=[Path(tempdir, 'a.csv'), f'{tempdir}/b*.csv'],
+                    output_path=self.formatted_transactions_path,
+                    tax_currency=self.tax_currency,
+                    tax_year_cutoff=get_tax_year_cutoff_date('2018-12-31', 'America/New_York'),
+                    tax_timezone='utc',
+                    rates=load_rates(Path('tests/fixtures/rates.csv')),
+                    streaming=streaming,
+                    sort_buffer_size=1,
+                    track_fees=True,
+                    workers=workers,
+                )
+                transactions = list(loader.stream()) if streaming else loader.transactions
+
+                self.assertEqual(transactions, self.loader.transactions)
+                self.assertEqual(loader.fee_totals, {'btc': Decimal('0.0004'), 'usd': Decimal('20')})
+
+    def test_merge_fills(self):
+        def fill(id, date=datetime(2019, 1, 1), **fields):
+            return 0, {FIELD_RAW_ID: id, FIELD_ASSET_CODE: 'btc', FIELD_BASE_CURRENCY: 'usd', FIELD_TRANSACTION_TYPE: 'buy',
+                       FIELD_PRICE: '100', FIELD_EXCHANGE: 'na', FIELD_FEE_CURRENCY: 'usd', FIELD_QTY: '1', FIELD_FEE: '0.1',
+                       **fields}, date
+
+        rows = [
+            fill('a'),
+            fill('b', qty='2', fee='0.2', price='100.0'),
+            fill('c', asset_code='eth'),
+            fill('d'),
+            fill('e', price='101'),
+            fill('f', base_currency='btc'),
+            fill('g', type='sell'),
+            fill('h', exchange='other'),
+            fill('i', fee_currency='btc'),
+            fill('j', fee=''),
+            fill('k', fee=''),
+            fill('l', date=datetime(2019, 1, 2)),
+        ]
+        merged = list(merge_fills(rows))
+
+        # Only consecutive fills are merged, so rows keep their order
+        self.assertEqual([row[FIELD_RAW_ID] for _, row, _ in merged], ['a;b', 'c', 'd', 'e', 'f', 'g', 'h', 'i', 'j;k', 'l'])
+        self.assertEqual((merged[0][1][FIELD_QTY], merged[0][1][FIELD_FEE], merged[0][1][FIELD_PRICE]), ('3', '0.3', '100'))
+        self.assertEqual(merged[-2][1][FIELD_FEE], '')
+        self.assertIs(merged[1], rows[2])
+        self.assertEqual(list(merge_fills([])), [])
+
+    def test_loader_coalesce_fills(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            input_path = Path(tempdir, 'transactions.csv')
+            lines = Path('tests/fixtures/transactions.csv').read_text().splitlines(keepends=True)
+            # The first btc buy as 2 fills
+            buy = lines[1]
+            lines[1:2] = [buy.replace(',1,', ',1a,').replace(',0.5,9000,10,', ',0.2,9000,4,'),
+                          buy.replace(',1,', ',1b,').replace(',0.5,9000,10,', ',0.3,9000,6,')]
+            input_path.write_text(''.join(lines))
+
+            for streaming, workers in ((False, 1), (True, 1), (False, 2)):
+                loader = TransactionLoader(
+                    input_path=[input_path, Path('tests/fixtures/transactions.csv')],
+                    output_path=self.formatted_transactions_path,
+                    tax_currency=self.tax_currency,
+                    tax_year_cutoff=get_tax_year_cutoff_date('2019-06-30', 'UTC'),
+                    streaming=streaming,
+                    workers=workers,
+                    coalesce_fills=True,
+                )
+                transactions = list(loader.stream()) if streaming else loader.transactions
+
+                # The fills aren't merged with the same buy in the other file
+                self.assertEqual(len(transactions), 16)
+                self.assertEqual(
+                    (transactions[0].id, transactions[0].qty, transactions[0].fee, transactions[0].fee_unit),
+                    ('1a;1b', Decimal('0.5'), Decimal('10'), Decimal('20'))
+                )
+                self.assertEqual(transactions[1].id, '1')
+                self.assertEqual(self._get_output_rows()[0][FIELD_QTY], '0.5')
+
+    def test_loader_coalesce_rebased_fills(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            input_path = Path(tempdir, 'transactions.csv')
+            lines = self.input_path.read_text().splitlines(keepends=True)
+            # The btc priced eth buy as 2 fills, the second with its fee in usd, then a different order on the same date
+            buy = lines[4]
+            lines[4:5] = [buy.replace('2,', '2a,', 1).replace(',5,0.025,0.0002,', ',2,0.025,0.0001,'),
+                          buy.replace('2,', '2b,', 1).replace(',5,0.025,0.0002,', ',1,0.025,0.0001,'),
+                          buy.replace('2,', '2c,', 1).replace(',5,0.025,0.0002,', ',2,0.025,0.61,').replace(',btc,btc,', ',btc,usd,'),
+                          buy.replace('2,', '5,', 1).replace(',5,0.025,0.0002,', ',1,0.027,0.0001,')]
+            input_path.write_text(''.join(lines))
+
+            loader = TransactionLoader(
+                input_path=input_path,
+                output_path=self.formatted_transactions_path,
+                tax_currency=self.tax_currency,
+                tax_year_cutoff=get_tax_year_cutoff_date('2018-12-31', 'America/New_York'),
+                tax_timezone='utc',
+                rates=load_rates(Path('tests/fixtures/rates.csv')),
+                coalesce_fills=True,
+            )
+
+            # Each order is rebased into a btc sale and an eth buy, in file order
+            self.assertEqual(
+                [(t.id, t.type, t.asset_code, t.qty, t.fee) for t in loader.transactions[1:7]],
+                [
+                    ('2a;2b', 'sell', 'btc', Decimal('0.075'), Decimal('1.22')),
+                    ('2a;2b', 'buy', 'eth', Decimal('3'), Decimal('0')),
+                    ('2c', 'sell', 'btc', Decimal('0.050'), Decimal('0.61')),
+                    ('2c', 'buy', 'eth', Decimal('2'), Decimal('0')),
+                    ('5', 'sell', 'btc', Decimal('0.027'), Decimal('0.61')),
+                    ('5', 'buy', 'eth', Decimal('1'), Decimal('0')),
+                ]
+            )
 
 if __name__ == '__main__':
     unittest.main()
@@ -36,7 +36,25 @@ def test_convert_timezone():
     )
     assert d.strftime(DATE_INPUT_FORMAT) == '2020-06-01T00:00:00'
     assert str(d.tzinfo) == 'Europe/London'
-    
+
+    # Repeated conversions are cached
+    utils.convert_timezone.cache_clear()
+    utils.convert_timezone('2020-06-01T00:00:00', 'UTC', 'Europe/London')
+    utils.convert_timezone('2020-06-01T00:00:00', 'UTC', 'Europe/London')
+    assert utils.convert_timezone.cache_info().hits == 1
+
+
+def test_convert_timezones():
+    DATE_INPUT_FORMAT = "%Y-%m-%dT%H:%M:%S"
+    date_strs = ['2020-01-01T00:00:00', '2020-06-01T00:00:00', '2020-01-01T00:00:00']
+    dates = utils.convert_timezones(date_strs, 'UTC', 'Europe/London')
+
+    assert [d.strftime(DATE_INPUT_FORMAT) for d in dates] == [
+        '2020-01-01T00:00:00', '2020-06-01T01:00:00', '2020-01-01T00:00:00'
+    ]
+    assert dates == [utils.convert_timezone(d, 'UTC', 'Europe/London') for d in date_strs]
+    assert utils.convert_timezones([], 'UTC', 'Europe/London') == []
+
 def test_get_tax_year_cutoff_date():
     DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
     
@@ -49,4 +67,14 @@ def test_get_tax_year_cutoff_date():
     dt = utils.get_tax_year_cutoff_date('2021-12-31', tz)
     assert dt.strftime(DATE_FORMAT) == '2022-01-01T00:00:00'
     assert str(dt.tzinfo) == tz
-    
\ No newline at end of file
+    
+
+def test_timestamps():
+    # Wall clock time, so a DST change doesn't shift the difference between dates
+    winter = utils.convert_timezone('2021-01-01T12:00:00', 'Europe/London', 'Europe/London')
+    summer = utils.convert_timezone('2021-07-01T12:00:00', 'Europe/London', 'Europe/London')
+    assert utils.to_timestamp(summer) - utils.to_timestamp(winter) == 181 * 24 * 60 * 60
+
+    assert utils.to_timestamp(winter) == 1609502400
+    assert utils.format_timestamp(utils.to_timestamp(summer)) == '2021-07-01T12:00:00'
+    assert utils.format_timestamp(-1) == '1969-12-31T23:59:59'
@@ -5,22 +5,17 @@ from decimal import Decimal
 
 from capitalg.contstants import (
     FIELD_AMOUNT,
-    FIELD_ASSET_CODE,
     FIELD_COST_BASE_AMOUNT,
     FIELD_COST_BASE_ID,
     FIELD_DATE,
-    FIELD_EXCHANGE,
-    FIELD_FEE_UNIT,
-    FIELD_FEE,
-    FIELD_NOTE,
-    FIELD_PRICE,
     FIELD_QTY,
-    FIELD_RAW_ID,
     OUTPUT_FIELDS_CGT_EVENTS,
     OUTPUT_FIELDS_COST_BASE
 )
 from capitalg.cg_helpers import calculate_cg_transaction
+from capitalg.CostBaseQueue import Lot
 from capitalg.Writer import Writer
+from tests.helpers import make_transaction, timestamp
 
 
 class TestWriter(unittest.TestCase):
@@ -32,10 +27,11 @@ class TestWriter(unittest.TestCase):
         os.unlink(self.cgt_events_path)
         os.unlink(self.cost_base_path)
 
-    def _make_writer(self):
+    def _make_writer(self, **kwargs):
         return Writer(
             self.cgt_events_path,
-            self.cost_base_path
+            self.cost_base_path,
+            **kwargs
         )
 
     def test_writer_no_data(self):
@@ -53,43 +49,45 @@ class TestWriter(unittest.TestCase):
             self.assertEqual(reader.fieldnames, OUTPUT_FIELDS_COST_BASE)
 
     def test_writer_cgt_event(self):
-        sale1 = {
-            FIELD_DATE: '2019-04-05T00:12:54',
-            FIELD_RAW_ID: 'raw_123',
-            FIELD_ASSET_CODE: 'BTC',
-            FIELD_QTY: Decimal('0.4'),
-            FIELD_PRICE: Decimal('13000'),
-            FIELD_FEE_UNIT: Decimal('50'),
-            FIELD_FEE: Decimal('20'),
-            FIELD_NOTE: 'hello btc',
-            FIELD_EXCHANGE: 'test',
-        }
-
-        cost_base_1 = calculate_cg_transaction(sale1, [{
-            FIELD_QTY: Decimal('0.4'),
-            FIELD_PRICE: Decimal('10000.00'),
-            FIELD_FEE_UNIT: Decimal('100'),
-            FIELD_DATE: '2018-05-01T00:00:00',  # note long term
-            FIELD_EXCHANGE: 'test',
-        }])
-
-        sale2 = {
-            FIELD_DATE: '2019-06-05T00:12:54',
-            FIELD_RAW_ID: 'raw_999',
-            FIELD_ASSET_CODE: 'ETH',
-            FIELD_QTY: Decimal('20'),
-            FIELD_PRICE: Decimal('400.00'),
-            FIELD_FEE_UNIT: Decimal('0.1'),
-            FIELD_FEE: Decimal('2'),
-            FIELD_NOTE: 'hello eth',
-            FIELD_EXCHANGE: 'test',
-        }
-        cost_base_2 = calculate_cg_transaction(sale2, [{
-            FIELD_QTY: Decimal('20'),
-            FIELD_PRICE: Decimal('350'),
-            FIELD_FEE_UNIT: Decimal('100'),
-            FIELD_DATE: '2018-05-01T00:00:00',  # note long term
-        }])
+        sale1 = make_transaction(
+            timestamp=timestamp('2019-04-05T00:12:54'),
+            id='raw_123',
+            type='sell',
+            asset_code='BTC',
+            qty=Decimal('0.4'),
+            price=Decimal('13000'),
+            fee_unit=Decimal('50'),
+            fee=Decimal('20'),
+            note='hello btc',
+            exchange='test',
+        )
+
+        cost_base_1 = calculate_cg_transaction(sale1, [Lot.from_transaction(make_transaction(
+            qty=Decimal('0.4'),
+            price=Decimal('10000.00'),
+            fee_unit=Decimal('100'),
+            timestamp=timestamp('2018-05-01T00:00:00'),  # note long term
+            exchange='test',
+        ))])
+
+        sale2 = make_transaction(
+            timestamp=timestamp('2019-06-05T00:12:54'),
+            id='raw_999',
+            type='sell',
+            asset_code='ETH',
+            qty=Decimal('20'),
+            price=Decimal('400.00'),
+            fee_unit=Decimal('0.1'),
+            fee=Decimal('2'),
+            note='hello eth',
+            exchange='test',
+        )
+        cost_base_2 = calculate_cg_transaction(sale2, [Lot.from_transaction(make_transaction(
+            qty=Decimal('20'),
+            price=Decimal('350'),
+            fee_unit=Decimal('100'),
+            timestamp=timestamp('2018-05-01T00:00:00'),  # note long term
+        ))])
 
         with self._make_writer() as writer:
             writer.write_cgt_event(
@@ -120,35 +118,36 @@ class TestWriter(unittest.TestCase):
             self.assertEqual(rows[1][FIELD_COST_BASE_AMOUNT],
                              str(cost_base_2[FIELD_COST_BASE_AMOUNT]))  # + sale2[FIELD_FEE]
 
+            # Dates are formatted when written
+            self.assertEqual(rows[0][FIELD_DATE], '2019-04-05T00:12:54')
+
     def test_write_cost_base_transactions(self):
         cost_transactions_1 = [
-            {
-                FIELD_RAW_ID: 'abc123',
-                FIELD_ASSET_CODE: 'BTC',
-                FIELD_DATE: '2019-04-05T00:12:54',
-                FIELD_QTY: Decimal('1.12'),
-                FIELD_PRICE: Decimal('9843.87'),
-                FIELD_AMOUNT: Decimal('11025.1344'),
-                FIELD_FEE_UNIT: Decimal('65.134'),
-                FIELD_NOTE: 'hello btc',
-            },
-            {
-                FIELD_RAW_ID: 'abc345',
-                FIELD_ASSET_CODE: 'BTC',
-                FIELD_DATE: '2019-04-05T00:12:14',
-                FIELD_QTY: Decimal('0.005'),
-                FIELD_PRICE: Decimal('9813.07'),
-                FIELD_AMOUNT: Decimal('49.06535'),
-                FIELD_FEE_UNIT: Decimal('0.37'),
-                FIELD_NOTE: 'topping up',
-            },
+            make_transaction(
+                id='abc123',
+                asset_code='BTC',
+                timestamp=timestamp('2019-04-05T00:12:54'),
+                qty=Decimal('1.12'),
+                price=Decimal('9843.87'),
+                fee_unit=Decimal('65.134'),
+                note='hello btc',
+            ),
+            make_transaction(
+                id='abc345',
+                asset_code='BTC',
+                timestamp=timestamp('2019-04-05T00:12:14'),
+                qty=Decimal('0.005'),
+                price=Decimal('9813.07'),
+                fee_unit=Decimal('0.37'),
+                note='topping up',
+            ),
         ]
 
         cost_base_id = 'cost_base_12345'
         with self._make_writer() as writer:
             writer.write_cost_base_transactions(
                 cost_base_id=cost_base_id,
-                cost_transactions=cost_transactions_1
+                cost_transactions=[Lot.from_transaction(row) for row in cost_transactions_1]
             )
 
         with open(self.cost_base_path) as csvfile:
@@ -158,6 +157,40 @@ class TestWriter(unittest.TestCase):
             self.assertEqual(reader.fieldnames, OUTPUT_FIELDS_COST_BASE)
             self.assertEqual(rows[0][FIELD_COST_BASE_ID], cost_base_id)
             self.assertEqual(rows[1][FIELD_COST_BASE_ID], cost_base_id)
+            self.assertEqual(rows[1][FIELD_QTY], '0.005')
+            self.assertEqual(rows[1][FIELD_DATE], '2019-04-05T00:12:14')
+
+            # Every other column comes from the cost transaction
+            expected = {key: str(value) for key, value in cost_transactions_1[0].to_dict().items()}
+            self.assertEqual({key: rows[0][key] for key in expected}, expected)
+            self.assertEqual(rows[0][FIELD_AMOUNT], '')
+
+    def test_buffer_size(self):
+        lots = [
+            Lot.from_transaction(make_transaction(id=f'raw_{i}', qty=Decimal(i), timestamp=timestamp('2019-04-05T00:12:54') + i))
+            for i in range(1, 6)
+        ]
+
+        outputs = []
+        for buffer_size in (1, 2, 1000):
+            with self._make_writer(buffer_size=buffer_size) as writer:
+                for i, lot in enumerate(lots):
+                    writer.write_cost_base_transactions(cost_base_id=f'cost_base_{i}', cost_transactions=[lot])
+
+                    # Rows are only written once the buffer is full
+                    if buffer_size == 1000:
+                        with open(self.cost_base_path) as csvfile:
+                            self.assertEqual(len(list(csv.DictReader(csvfile))), 0)
+
+            with open(self.cost_base_path) as csvfile:
+                outputs.append(csvfile.read())
+
+        self.assertEqual(len(outputs[0].splitlines()), len(lots) + 1)
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(outputs[0], outputs[2])
+
+        with self.assertRaises(ValueError):
+            self._make_writer(buffer_size=0)
 
 
 if __name__ == '__main__':